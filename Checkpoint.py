@@ -0,0 +1,154 @@
+"""
+Helpers to write and read checkpoint files for the jitted KMC and MC carriers.
+"""
+import numpy as np
+import os
+import tempfile
+import hashlib
+import queue
+import threading
+
+
+def atomicWrite(fileName, writeFunc):
+    """
+    Write a file so that it is either the old version or the complete new one, even if the process is killed during
+    the write - the data is written to a temporary file in the same directory, which is then renamed.
+    :param fileName: name of the file to write to.
+    :param writeFunc: function that writes the data to the open (binary) file object it is given.
+    """
+    dirName = os.path.dirname(os.path.abspath(fileName))
+    fd, tmpName = tempfile.mkstemp(dir=dirName, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fl:
+            writeFunc(fl)
+            fl.flush()
+            os.fsync(fl.fileno())
+        os.replace(tmpName, fileName)
+    except BaseException:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise
+
+
+def atomicSavez(fileName, compressed=False, **arrays):
+    """
+    Write arrays to a .npz file atomically (see atomicWrite).
+    :param fileName: name of the file to write to.
+    :param compressed: whether to compress the arrays (see np.savez_compressed).
+    :param arrays: the arrays to store, as keyword arguments.
+    """
+    if compressed:
+        atomicWrite(fileName, lambda fl: np.savez_compressed(fl, **arrays))
+    else:
+        atomicWrite(fileName, lambda fl: np.savez(fl, **arrays))
+
+
+def atomicSave(fileName, arr):
+    """
+    Write an array to a .npy file atomically (see atomicWrite) - the file can be memory mapped when read back.
+    """
+    atomicWrite(fileName, lambda fl: np.save(fl, arr))
+
+
+def saveFields(obj, fields, fileName):
+    """
+    Save the given attributes of an object (e.g, a jitclass carrier) to a checkpoint file.
+    :param obj: the object to save
+    :param fields: list of attribute names to save
+    :param fileName: name of the .npz file to write to.
+    """
+    atomicSavez(fileName, **{field: np.asarray(getattr(obj, field)) for field in fields})
+
+
+def loadFields(fileName, fields):
+    """
+    Read back the attributes saved with saveFields
+    :param fileName: name of the .npz file to read from.
+    :param fields: list of the attribute names to read.
+    :return: dictionary of field name to array (0-d arrays are converted to python scalars)
+    """
+    data = {}
+    with np.load(fileName) as fl:
+        for field in fields:
+            arr = fl[field]
+            data[field] = arr.item() if arr.ndim == 0 else arr.copy()
+    return data
+
+
+def hashArrays(arrays):
+    """
+    Hash a sequence of arrays, to check that a checkpoint is restored with the same data it was written with.
+    :param arrays: the arrays to hash (their dtypes and shapes are included).
+    :return: hex digest (sha256) of the arrays.
+    """
+    h = hashlib.sha256()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(str(arr.dtype).encode())
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+class BackgroundWriter(object):
+    """
+    Writes checkpoint files (with atomicSavez, or any other function) from a background thread, so that the caller
+    only waits for the arrays to be copied. Writes are done in the order they are submitted. An error in a write is
+    raised on the next call to submit, wait or close.
+    """
+
+    def __init__(self, maxPending=2):
+        """
+        :param maxPending: the largest number of writes waiting in the queue - submit blocks beyond that, so that a
+        slow disk cannot make the snapshots pile up in memory.
+        """
+        self.queue = queue.Queue(maxsize=maxPending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                func, args, kwargs = item
+                if self.error is None:
+                    func(*args, **kwargs)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def checkError(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submitCall(self, func, *args, **kwargs):
+        """
+        Queue a call of func(*args, **kwargs) - e.g, atomicSave. The arguments are not copied, so they must not be
+        modified until the call is done.
+        """
+        self.checkError()
+        self.queue.put((func, args, kwargs))
+
+    def submit(self, fileName, compressed=False, **arrays):
+        """
+        Queue a write of arrays to a .npz file. The arrays are copied, so they may be modified as soon as this returns.
+        """
+        self.submitCall(atomicSavez, fileName, compressed=compressed,
+                        **{key: np.array(arr, copy=True) for key, arr in arrays.items()})
+
+    def wait(self):
+        """
+        Block until all the submitted writes are done.
+        """
+        self.queue.join()
+        self.checkError()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.checkError()
@@ -342,6 +342,147 @@ class VectorClusterExpansion(object):
                VecGroupInteracts, numInteractsSiteSpec, SiteSpecInterArray, vacSiteInd, InteractionIndexDict, InteractionRepClusDict,\
                Index2InteractionDict, repClustCounter
 
+    def makeInteractionOrbits(self, InteractionIndexDict, InteractionRepClusDict):
+        """
+        Map every interaction to its orbit - the symmetry-grouped species cluster it belongs to, which is also the
+        index of its energy in the Energies array given to makeJitInteractionsData.
+        :param InteractionIndexDict, InteractionRepClusDict: as returned by makeJitInteractionsData.
+        :return: Interaction2Orbit - (Ninteracts) the orbit of each interaction.
+        """
+        Interaction2Orbit = np.full(len(InteractionIndexDict), -1, dtype=int)
+        for interaction, repClus in InteractionRepClusDict.items():
+            Interaction2Orbit[InteractionIndexDict[interaction]] = self.clust2SpecClus[repClus][0]
+        return Interaction2Orbit
+
+    def makeTransInvariantInteractionsData(self, Energies):
+        """
+        Translation-symmetric alternative to makeJitInteractionsData. Every species cluster is stored once, as
+        lattice offsets of its sites from an anchor, instead of once for every translation in the supercell. The
+        interaction made by placing cluster "rep" at anchor site "a" has its sites at siteIndtoR[a] + offsets (with
+        PBC), and its off site count is indexed by (rep, a) (see MC_Kernels.countOffSitesTrans). None of the arrays
+        depend on the size of the supercell.
+        :param Energies: energy of each symmetry-grouped species cluster (same as in makeJitInteractionsData).
+        :return: numSitesReps - (Nreps) the number of sites in each cluster.
+                 RepSiteOffsets - (Nreps x maxOrder x 3) lattice offsets of the sites of each cluster.
+                 RepSpecs - (Nreps x maxOrder) the species on the sites of each cluster.
+                 Rep2En - (Nreps) the energy of each cluster.
+                 numSpecRefs - (Nspec) the number of cluster sites that each species occupies.
+                 SpecRefs - (Nspec x maxRefs x 2) the (cluster, site) pairs that each species occupies. The
+                 interactions containing a site with a given species are those of these clusters anchored so that
+                 the site is at the given position in them.
+        """
+        allSpCl = [self.Num2Clus[i] for i in range(len(self.Num2Clus))]
+        Nreps = len(allSpCl)
+        Nspec = len(self.mobCountList)
+
+        numSitesReps = np.zeros(Nreps, dtype=int)
+        RepSiteOffsets = np.zeros((Nreps, self.maxOrder, 3), dtype=int)
+        RepSpecs = np.full((Nreps, self.maxOrder), -1, dtype=int)
+        Rep2En = np.zeros(Nreps, dtype=float)
+        specRefList = [[] for spec in range(Nspec)]
+
+        for rep, SpCl in enumerate(allSpCl):
+            numSitesReps[rep] = len(SpCl.transPairs)
+            Rep2En[rep] = Energies[self.clust2SpecClus[SpCl][0]]
+            for k, (site, spec) in enumerate(SpCl.transPairs):
+                RepSiteOffsets[rep, k, :] = site.R
+                RepSpecs[rep, k] = spec
+                specRefList[spec].append((rep, k))
+
+        numSpecRefs = np.array([len(refs) for refs in specRefList], dtype=int)
+        SpecRefs = np.full((Nspec, max(1, max(numSpecRefs)), 2), -1, dtype=int)
+        for spec, refs in enumerate(specRefList):
+            for i, ref in enumerate(refs):
+                SpecRefs[spec, i, :] = ref
+
+        return numSitesReps, RepSiteOffsets, RepSpecs, Rep2En, numSpecRefs, SpecRefs
+
+    def makePatternInteractionsData(self, Energies):
+        """
+        Species-pattern-encoded alternative to makeJitInteractionsData. Instead of one interaction for every labeling
+        of a site cluster with species, every site cluster in the supercell (a "site tuple") is stored once, and the
+        species on its sites are encoded as a single mixed-radix code - sum over k of spec_k * Nspec^k. The energy
+        of a site tuple is then a lookup of its code in the energy table of its geometry (the site cluster up to
+        translation), where the species clusters not in the expansion have zero energy.
+        :param Energies: energy of each symmetry-grouped species cluster (same as in makeJitInteractionsData).
+        :return: numSitesTuples - (Ntuples) the number of sites in each site tuple.
+                 TupleSites - (Ntuples x maxOrder) the supercell sites in each site tuple.
+                 TupleGeom - (Ntuples) the geometry of each site tuple.
+                 GeomPatternEn - (Ngeom x Nspec^maxOrder) the energy of each species pattern on each geometry.
+                 numTuplesSite - (Nsites) the number of site tuples containing each site.
+                 SiteTuples - (Nsites x maxTuples x 2) the (site tuple, Nspec^k) pairs of each site, where k is the
+                 position of the site in the tuple - changing the species on the site from a to b changes the code of
+                 the tuple by (b - a) * Nspec^k.
+        """
+        Nspec = len(self.mobCountList)
+
+        # group the species clusters by their sites (already translated to the origin by ClusterSpecies), and order
+        # the sites of each geometry in the same way for all the labelings of it.
+        geomIndex = {}
+        geomSites = []
+        geomPatterns = []
+        for rep in range(len(self.Num2Clus)):
+            SpCl = self.Num2Clus[rep]
+            siteSpec = sorted(SpCl.transPairs, key=lambda x: tuple(x[0].R))
+            sites = tuple(site for site, spec in siteSpec)
+            if sites not in geomIndex:
+                geomIndex[sites] = len(geomSites)
+                geomSites.append(sites)
+                geomPatterns.append([])
+            code = sum(spec * Nspec**k for k, (site, spec) in enumerate(siteSpec))
+            geomPatterns[geomIndex[sites]].append((code, Energies[self.clust2SpecClus[SpCl][0]]))
+
+        Ngeom = len(geomSites)
+        GeomPatternEn = np.zeros((Ngeom, Nspec**self.maxOrder), dtype=float)
+        for geom, patterns in enumerate(geomPatterns):
+            for code, En in patterns:
+                GeomPatternEn[geom, code] = En
+
+        # place every geometry at every unit cell of the supercell
+        Ntuples = Ngeom * self.Nsites
+        numSitesTuples = np.zeros(Ntuples, dtype=int)
+        TupleSites = np.full((Ntuples, self.maxOrder), -1, dtype=int)
+        TupleGeom = np.zeros(Ntuples, dtype=int)
+        siteTupleList = [[] for siteInd in range(self.Nsites)]
+        for geom, sites in enumerate(geomSites):
+            for siteInd in range(self.Nsites):
+                ci, R = self.sup.ciR(siteInd)
+                tup = geom * self.Nsites + siteInd
+                numSitesTuples[tup] = len(sites)
+                TupleGeom[tup] = geom
+                for k, site in enumerate(sites):
+                    supSite = self.sup.index(site.R + R, site.ci)[0]
+                    TupleSites[tup, k] = supSite
+                    siteTupleList[supSite].append((tup, Nspec**k))
+
+        numTuplesSite = np.array([len(tups) for tups in siteTupleList], dtype=int)
+        SiteTuples = np.full((self.Nsites, max(numTuplesSite), 2), -1, dtype=int)
+        for siteInd, tups in enumerate(siteTupleList):
+            for i, tup in enumerate(tups):
+                SiteTuples[siteInd, i, :] = tup
+
+        return numSitesTuples, TupleSites, TupleGeom, GeomPatternEn, numTuplesSite, SiteTuples
+
+    def makeVacSitePerms(self):
+        """
+        Function to represent the point group operations that leave the vacancy site unchanged as permutations
+        of the supercell sites - used to reduce states by symmetry (see MC_JIT.makeShellsJit).
+        :return: sitePerms - (Ng x Nsites) array, sitePerms[g, i] is the site that site i is taken to by operation g.
+        """
+        sitePerms = []
+        for g in self.crys.G:
+            if self.vacSite.g(self.crys, g) != self.vacSite:
+                continue
+            perm = np.zeros(self.Nsites, dtype=int)
+            for siteInd in range(self.Nsites):
+                ci, R = self.sup.ciR(siteInd)
+                siteNew = cluster.ClusterSite(ci=ci, R=R).g(self.crys, g)
+                perm[siteInd] = self.sup.index(siteNew.R, siteNew.ci)[0]
+            if len(set(perm)) != self.Nsites:
+                raise ValueError("The supercell is not compatible with the point group of the vacancy site")
+            sitePerms.append(perm)
+        return np.array(sitePerms, dtype=int)
+
     def makeSiteIndToSite(self):
         Nsites = self.Nsites
         N_units = self.sup.superlatt[0, 0]
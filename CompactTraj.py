@@ -0,0 +1,225 @@
+"""
+Compact on-disk storage of single vacancy lattice gas KMC trajectories (see LatGas.LatGasKMCTraj).
+Instead of the displacements at every step, only the selected jump (uint8) and the residence time increment (float32)
+of each step are stored, along with keyframes of the state, vacancy site, displacements and time every
+keyframeInterval steps. The steps are written in compressed chunks, each starting at a keyframe, so that the
+displacements or state after any number of steps can be reconstructed by replaying at most keyframeInterval jumps
+from a single chunk.
+
+Layout of a trajectory directory:
+    meta.npz - the starting state, the neighbor table and jump displacements, and the format parameters.
+    chunk_XXXXXX.npz - the jumps, time increments and keyframes of chunkSteps consecutive steps.
+Steps at which the vacancy could not move (zero escape rate - the drivers record jump -1 and infinite time) are
+stored as the jump BLOCKED with an infinite time increment, and are skipped when replaying.
+"""
+import numpy as np
+import os
+from numba import jit
+import Checkpoint
+
+BLOCKED = 255  # stored in place of the jump index at steps where the vacancy is blocked
+
+
+@jit(nopython=True)
+def replayJumps(state, X, vacSite, jumps, nbrTable, dxList, NSpec):
+    """
+    Function to apply a sequence of vacancy jumps to a state.
+    :param state: the state to start from - updated in place.
+    :param X: (NSpec x 3) displacements of the species - updated in place.
+    :param vacSite: the site of the vacancy in the state.
+    :param jumps: the indices of the jumps (into the rows of nbrTable) to apply - BLOCKED (or any negative index)
+    for a step where the vacancy did not move.
+    :param nbrTable: (Nsites x z) table of final sites of the vacancy jumps (see LatGas.makeNeighborTable).
+    :param dxList: array containing the displacement of each jump.
+    :param NSpec: the number of species (including the vacancy).
+    :return: the site of the vacancy after the jumps.
+    """
+    for step in range(jumps.shape[0]):
+        jmp = jumps[step]
+        if jmp < 0 or jmp == BLOCKED:
+            continue
+        siteB = nbrTable[vacSite, jmp]
+        specB = state[siteB]
+        X[NSpec - 1, :] += dxList[jmp]
+        X[specB, :] -= dxList[jmp]
+        state[siteB] = state[vacSite]
+        state[vacSite] = specB
+        vacSite = siteB
+    return vacSite
+
+
+def chunkFileName(dirName, chunk):
+    return os.path.join(dirName, "chunk_{:06d}.npz".format(chunk))
+
+
+class CompactTrajWriter(object):
+    """
+    Writer of compact trajectories. The steps are fed in any number of pieces (e.g, the outputs of successive
+    LatGas.LatGasKMCTrajChunk calls), and the keyframes are generated by replaying the jumps.
+    """
+
+    def __init__(self, dirName, state0, vacSite0, nbrTable, dxList, NSpec, keyframeInterval=1000,
+                 chunkSteps=100000):
+        """
+        :param dirName: directory to write the trajectory to (created if it does not exist).
+        :param state0: the starting state of the trajectory.
+        :param vacSite0: the site of the vacancy in the starting state.
+        :param nbrTable: (Nsites x z) table of final sites of the vacancy jumps (see LatGas.makeNeighborTable).
+        :param dxList: array containing the displacement of each jump.
+        :param NSpec: the number of species (including the vacancy).
+        :param keyframeInterval: the number of steps between keyframes.
+        :param chunkSteps: the number of steps in each chunk - must be a multiple of keyframeInterval.
+        """
+        if chunkSteps % keyframeInterval != 0:
+            raise ValueError("chunkSteps must be a multiple of keyframeInterval")
+        if nbrTable.shape[1] > BLOCKED:
+            raise ValueError("jump indices must fit in uint8 (with {} reserved for blocked steps)".format(BLOCKED))
+        if NSpec > 256:
+            raise ValueError("species indices must fit in uint8")
+
+        self.dirName = dirName
+        os.makedirs(dirName, exist_ok=True)
+        self.nbrTable = nbrTable
+        self.dxList = dxList
+        self.NSpec = NSpec
+        self.keyframeInterval = keyframeInterval
+        self.chunkSteps = chunkSteps
+        self.state0 = state0.copy()
+        self.vacSite0 = vacSite0
+
+        # the state after all the steps written so far
+        self.state = state0.copy()
+        self.X = np.zeros((NSpec, 3))
+        self.t = 0.
+        self.vacSite = vacSite0
+        self.Nsteps = 0
+        self.chunk = 0
+
+        self.jumpBuf = []
+        self.dtBuf = []
+        self.keyStates, self.keyX, self.keyT, self.keyVacSites = [], [], [], []
+        self.writeMeta()
+
+    def writeMeta(self):
+        Checkpoint.atomicSavez(os.path.join(self.dirName, "meta.npz"), state0=self.state0, vacSite0=self.vacSite0,
+                               nbrTable=self.nbrTable, dxList=self.dxList, NSpec=self.NSpec,
+                               keyframeInterval=self.keyframeInterval, chunkSteps=self.chunkSteps,
+                               Nsteps=self.Nsteps)
+
+    def addSteps(self, jmpSelectSteps, t_steps):
+        """
+        Add steps to the trajectory.
+        :param jmpSelectSteps: the jump selected at each step (-1 where the vacancy was blocked).
+        :param t_steps: the time at each step, measured from the start of the trajectory.
+        """
+        start = 0
+        while start < jmpSelectSteps.shape[0]:
+            if self.Nsteps % self.keyframeInterval == 0:
+                self.keyStates.append(self.state.astype(np.uint8))
+                self.keyX.append(self.X.copy())
+                self.keyT.append(self.t)
+                self.keyVacSites.append(self.vacSite)
+
+            # go up to the next keyframe
+            stop = min(jmpSelectSteps.shape[0],
+                       start + self.keyframeInterval - self.Nsteps % self.keyframeInterval)
+            jumps = np.where(jmpSelectSteps[start:stop] < 0, BLOCKED, jmpSelectSteps[start:stop]).astype(np.uint8)
+            self.vacSite = replayJumps(self.state, self.X, self.vacSite, jumps, self.nbrTable, self.dxList,
+                                       self.NSpec)
+            self.jumpBuf.append(jumps)
+            # the time is infinite from the first blocked step on - store infinite increments rather than inf - inf
+            with np.errstate(invalid="ignore"):
+                dt = np.diff(t_steps[start:stop], prepend=self.t)
+            dt[jumps == BLOCKED] = np.inf
+            self.dtBuf.append(dt.astype(np.float32))
+            self.t = t_steps[stop - 1]
+            self.Nsteps += stop - start
+            start = stop
+
+            if self.Nsteps % self.chunkSteps == 0:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the buffered steps as a chunk. Called automatically when a chunk is full - call it directly (or call
+        close) to write out a partial chunk at the end of a trajectory.
+        """
+        if len(self.jumpBuf) == 0:
+            return
+        Checkpoint.atomicSavez(chunkFileName(self.dirName, self.chunk), compressed=True,
+                               jumps=np.concatenate(self.jumpBuf), dt=np.concatenate(self.dtBuf),
+                               keyStates=np.array(self.keyStates, dtype=np.uint8),
+                               keyX=np.array(self.keyX), keyT=np.array(self.keyT),
+                               keyVacSites=np.array(self.keyVacSites, dtype=np.int64))
+        self.writeMeta()
+        if self.Nsteps % self.chunkSteps == 0:
+            # the chunk is complete - start the next one
+            self.chunk += 1
+            self.jumpBuf, self.dtBuf = [], []
+            self.keyStates, self.keyX, self.keyT, self.keyVacSites = [], [], [], []
+
+    def close(self):
+        self.flush()
+
+
+class CompactTrajReader(object):
+    """
+    Reader of trajectories written with CompactTrajWriter.
+    The quantities are indexed by the number of steps taken "n" (0 <= n <= Nsteps), so that getX(n) corresponds to
+    X_steps[n - 1] of the trajectory, and getX(0) is zero.
+    """
+
+    def __init__(self, dirName):
+        self.dirName = dirName
+        meta = Checkpoint.loadFields(os.path.join(dirName, "meta.npz"),
+                                     ["state0", "vacSite0", "nbrTable", "dxList", "NSpec", "keyframeInterval",
+                                      "chunkSteps", "Nsteps"])
+        self.__dict__.update(meta)
+        self.cachedChunk = -1
+        self.chunkData = None
+
+    def loadChunk(self, chunk):
+        if chunk != self.cachedChunk:
+            with np.load(chunkFileName(self.dirName, chunk)) as fl:
+                self.chunkData = {key: fl[key] for key in fl.files}
+            self.cachedChunk = chunk
+        return self.chunkData
+
+    def replay(self, n):
+        """
+        Reconstruct the trajectory after n steps, starting from the nearest keyframe before it.
+        :param n: the number of steps taken.
+        :return: state - the state after n steps.
+                 X - (NSpec x 3) displacements of the species after n steps.
+                 t - the time after n steps.
+                 vacSite - the site of the vacancy after n steps.
+        """
+        if n < 0 or n > self.Nsteps:
+            raise ValueError("n must be between 0 and the number of steps in the trajectory ({})".format(self.Nsteps))
+        if self.Nsteps == 0:
+            return self.state0.copy(), np.zeros((self.NSpec, 3)), 0., self.vacSite0
+
+        # the last keyframe is at or before the last step
+        keyframe = min(n, self.Nsteps - 1) // self.keyframeInterval
+        keyStep = keyframe * self.keyframeInterval
+        chunk = keyStep // self.chunkSteps
+        data = self.loadChunk(chunk)
+        keyInChunk = (keyStep - chunk * self.chunkSteps) // self.keyframeInterval
+
+        state = data["keyStates"][keyInChunk].astype(self.state0.dtype)
+        X = data["keyX"][keyInChunk].copy()
+        start = keyStep - chunk * self.chunkSteps
+        stop = n - chunk * self.chunkSteps
+        vacSite = replayJumps(state, X, data["keyVacSites"][keyInChunk], data["jumps"][start:stop], self.nbrTable,
+                              self.dxList, self.NSpec)
+        t = data["keyT"][keyInChunk] + np.sum(data["dt"][start:stop], dtype=np.float64)
+        return state, X, t, vacSite
+
+    def getState(self, n):
+        return self.replay(n)[0]
+
+    def getX(self, n):
+        return self.replay(n)[1]
+
+    def getTime(self, n):
+        return self.replay(n)[2]
@@ -0,0 +1,47 @@
+"""
+Counter-based random number generation for jitted KMC and MC kernels.
+A random number is a pure function of a stream key and an integer counter, so that independent trajectories can
+draw from their own streams inside parallel loops, and the full state of a stream is just its (key, counter) pair.
+"""
+import numpy as np
+from numba import jit, int64, uint64
+
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+@jit(nopython=True)
+def mix64(z):
+    """
+    The splitmix64 finalizer - a bijective scrambling of a 64 bit unsigned integer.
+    :param z: uint64 value to scramble
+    :return: the scrambled uint64 value
+    """
+    z = (z ^ (z >> uint64(30))) * MIX1
+    z = (z ^ (z >> uint64(27))) * MIX2
+    return z ^ (z >> uint64(31))
+
+
+@jit(nopython=True)
+def makeStreamKey(seed, stream):
+    """
+    Function to make the key of an independent random stream.
+    :param seed: Integer - the global seed of a set of streams
+    :param stream: Integer - the index of the stream (e.g, the trajectory index).
+    :return: key - key identifying the stream. The 64 bits are stored as a (signed) int64 so that keys can be
+    freely passed between python and jitted code.
+    """
+    return int64(mix64(mix64(uint64(seed) + GOLDEN) ^ (uint64(stream) * MIX2 + GOLDEN)))
+
+
+@jit(nopython=True)
+def randUniform(key, counter):
+    """
+    Function to get the random number at a given position in a stream.
+    :param key: key of the stream (see makeStreamKey)
+    :param counter: Integer - position of the random number in the stream
+    :return: float uniformly distributed in [0, 1)
+    """
+    z = mix64(uint64(key) + (uint64(counter) + uint64(1)) * GOLDEN)
+    return (z >> uint64(11)) * (1.0 / 9007199254740992.0)
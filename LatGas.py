@@ -3,7 +3,11 @@ Functions to perform KMC simulations on mono-atomic lattice gases.
 """
 import numpy as np
 from onsager import cluster
-from numba import jit, int64, float64
+from numba import jit, prange, int64, float64
+from numba.experimental import jitclass
+import CounterRNG
+import SumTree
+import Checkpoint
 
 
 def makeSiteIndtoR(supercell):
@@ -90,6 +94,131 @@ def TrajAv(X_steps, t_steps, diff):
             diff[spec, step] += np.dot(X[spec], X[spec])/(6*t)
 
 
+MultiOriginMSDSpec = [
+    ("dt", float64),
+    ("lagInds", int64[:]),
+    ("maxLag", int64),
+    ("NSpec", int64),
+    ("Nblocks", int64),
+    ("Xbuf", float64[:, :, :]),
+    ("Xprev", float64[:, :]),
+    ("gridCount", int64),
+    ("block", int64),
+    ("msdSum", float64[:, :, :]),
+    ("originCount", float64[:, :]),
+]
+
+
+@jitclass(MultiOriginMSDSpec)
+class MultiOriginMSD(object):
+    """
+    Estimator for the mean squared displacements of each species on a common grid of physical time lags.
+    The displacements of a trajectory are interpolated onto a uniform time grid (t = j*dt), and every grid point is
+    used as a time origin for every lag. Trajectories can be fed in chunks of steps, and only the last maxLag grid
+    points are kept in memory. Every trajectory is assigned to a block, and the spread of the block averages gives
+    the error bars.
+    """
+
+    def __init__(self, NSpec, dt, lagInds, Nblocks):
+        """
+        :param NSpec: the number of species (including the vacancy).
+        :param dt: the spacing of the time grid.
+        :param lagInds: sorted array of the time lags (in units of dt) at which to compute the MSD.
+        :param Nblocks: the number of blocks to average trajectories in for the error bars.
+        """
+        self.NSpec = NSpec
+        self.dt = dt
+        self.lagInds = lagInds
+        self.maxLag = lagInds[-1]
+        self.Nblocks = Nblocks
+        self.Xbuf = np.zeros((self.maxLag + 1, NSpec, 3))
+        self.Xprev = np.zeros((NSpec, 3))
+        self.msdSum = np.zeros((Nblocks, NSpec, lagInds.shape[0]))
+        self.originCount = np.zeros((Nblocks, lagInds.shape[0]))
+        self.gridCount = 0
+        self.block = 0
+
+    def startTrajectory(self, block):
+        """
+        Start a new trajectory (starting with zero displacement at t = 0), to be averaged into the given block.
+        """
+        self.block = block % self.Nblocks
+        self.gridCount = 0
+        self.Xprev[:, :] = 0.
+
+    def addGridPoint(self, X):
+        """
+        Add the displacements (NSpec x 3) at the next point of the time grid of the current trajectory.
+        """
+        bufLen = self.maxLag + 1
+        self.Xbuf[self.gridCount % bufLen, :, :] = X
+        for lagInd in range(self.lagInds.shape[0]):
+            lag = self.lagInds[lagInd]
+            if lag > self.gridCount:
+                break
+            X0 = self.Xbuf[(self.gridCount - lag) % bufLen]
+            for spec in range(self.NSpec):
+                dX = X[spec] - X0[spec]
+                self.msdSum[self.block, spec, lagInd] += np.dot(dX, dX)
+            self.originCount[self.block, lagInd] += 1.
+        self.gridCount += 1
+
+    def addGridPoints(self, X_grid):
+        """
+        Add displacements that are already on the time grid, e.g, the X_times output of LatGasKMCTrajSampled
+        with sample times j*dt.
+        :param X_grid: (Ngrid x NSpec x 3) displacements at successive points of the time grid.
+        """
+        for j in range(X_grid.shape[0]):
+            self.addGridPoint(X_grid[j])
+        if X_grid.shape[0] > 0:
+            self.Xprev[:, :] = X_grid[-1]
+
+    def addChunk(self, X_chunk, t_chunk):
+        """
+        Add a chunk of consecutive KMC steps of the current trajectory.
+        :param X_chunk: (Nchunk x NSpec x 3) accumulated displacements after each step (e.g, X_steps).
+        :param t_chunk: (Nchunk-size array) accumulated time at each step (e.g, t_steps), measured from the start
+        of the trajectory. The displacement after step "k" holds from t_chunk[k] until the time of the next step.
+        """
+        for step in range(t_chunk.shape[0]):
+            # grid points before this step see the displacement of the previous step
+            while self.gridCount * self.dt < t_chunk[step]:
+                self.addGridPoint(self.Xprev)
+            self.Xprev[:, :] = X_chunk[step]
+
+    def getMSD(self):
+        """
+        :return: lagTimes - the time lags (lagInds*dt)
+                 msd - (NSpec x Nlags) mean squared displacements at the lags, averaged over all origins.
+                 msdErr - (NSpec x Nlags) standard errors of msd from the spread of the block averages
+                          (zero if fewer than two blocks have data at a lag).
+        """
+        Nlags = self.lagInds.shape[0]
+        lagTimes = self.lagInds * self.dt
+        msd = np.zeros((self.NSpec, Nlags))
+        msdErr = np.zeros((self.NSpec, Nlags))
+        for lagInd in range(Nlags):
+            totCount = np.sum(self.originCount[:, lagInd])
+            if totCount == 0:
+                continue
+            nb = 0
+            for block in range(self.Nblocks):
+                if self.originCount[block, lagInd] > 0:
+                    nb += 1
+            for spec in range(self.NSpec):
+                msd[spec, lagInd] = np.sum(self.msdSum[:, spec, lagInd]) / totCount
+                if nb < 2:
+                    continue
+                var = 0.
+                for block in range(self.Nblocks):
+                    if self.originCount[block, lagInd] > 0:
+                        dev = self.msdSum[block, spec, lagInd] / self.originCount[block, lagInd] - msd[spec, lagInd]
+                        var += dev * dev
+                msdErr[spec, lagInd] = np.sqrt(var / (nb * (nb - 1)))
+        return lagTimes, msd, msdErr
+
+
 # Function to convert a state into grid form
 @jit(nopython=True)
 def gridState(state, siteIndtoR, N_units):
@@ -130,9 +259,70 @@ def translateState(state, vacSiteNow, vacsiteDes, RtoSiteInd, siteIndtoR, N_unit
         state2New[RsiteNew[0], RsiteNew[1], RsiteNew[2]] = spec
     return state2New
 
+@jit(nopython=True)
+def LatGasKMCStep(state, X, rateArr, jmpFinSiteList, SpecRates, ijList, dxList, vacSiteInit, vacSiteNow, rn, N_unit,
+                  siteIndtoR, RtoSiteInd):
+    """
+    Function to do one lattice gas KMC step - get the exit rates of the vacancy at vacSiteNow, select a jump with the
+    uniform random number rn and do it. All the lattice gas trajectory drivers except the table and multi-vacancy ones
+    take their steps through this function.
+    :param X - (NSpec x 3) displacements of each species - updated in place, along with state and jmpFinSiteList.
+    :param rateArr - work array of the same size as ijList.
+    :param jmpFinSiteList - the exit sites of the vacancy at vacSiteNow - updated to those of the vacancy after the
+                           step.
+    :param rn - uniform random number in [0, 1) to select the jump with.
+    The rest of the parameters are the same as in LatGasKMCTraj.
+
+    :returns
+    vacSiteNext - the site of the vacancy after the step.
+    jmpSelect - the jump that was selected (-1 if the escape rate is zero, and nothing can move).
+    rateTot - the escape rate out of the state before the step.
+    """
+    NSpec = X.shape[0]
+
+    # first get the exit rates out of this state
+    for jmpInd in range(jmpFinSiteList.shape[0]):
+        specB = state[jmpFinSiteList[jmpInd]]  # Get the species occupying the exit site.
+        rateArr[jmpInd] = SpecRates[specB]  # Get the exit rate corresponding to this species.
+
+    rateTot = np.sum(rateArr)
+    if rateTot < 1e-8:  # If escape rate is zero, then nothing will move
+        return vacSiteNow, -1, rateTot
+
+    # convert the rates to cumulative probability
+    rateArr /= rateTot
+    rates_cm = np.cumsum(rateArr)
+
+    # Then select the jump
+    jmpSelect = np.searchsorted(rates_cm, rn)
+
+    # Store the displacement for this step
+    X[NSpec - 1, :] += dxList[jmpSelect]
+
+    siteB = jmpFinSiteList[jmpSelect]
+    specB = state[siteB]
+    X[specB, :] -= dxList[jmpSelect]
+
+    dR = siteIndtoR[siteB] - siteIndtoR[vacSiteInit]
+
+    # Update the final jump sites
+    for jmp in range(jmpFinSiteList.shape[0]):
+        RfinSiteNew = (dR + siteIndtoR[ijList[jmp]]) % N_unit  # This returns element wise modulo when N_unit is an
+                                                               # array instead of an integer.
+
+        jmpFinSiteList[jmp] = RtoSiteInd[RfinSiteNew[0], RfinSiteNew[1], RfinSiteNew[2]]
+
+    # Next, do the site swap to update the state
+    temp = state[vacSiteNow]
+    state[vacSiteNow] = specB
+    state[siteB] = temp
+
+    return siteB, jmpSelect, rateTot
+
+
 @jit(nopython=True)
 def LatGasKMCTraj(state, SpecRates, Nsteps, ijList, dxList,
-                  vacSiteInit, N_unit, siteIndtoR, RtoSiteInd):
+                  vacSiteInit, N_unit, siteIndtoR, RtoSiteInd, tracker=None):
     """
     Function to generate a KMC trajectory on a lattice gas where there aren't any energetic interactions, and
     vacancy transition rates with all species are pre-defined
@@ -145,11 +335,13 @@ def LatGasKMCTraj(state, SpecRates, Nsteps, ijList, dxList,
     :param N_unit - Supercell size.
     :param siteIndtoR - contains the lattice vectors pointing to specific supercell sites
     :param RtoSiteInd - contains the index of the site to which a lattice vector points.
+    :param tracker - optional Tracer.TracerTracker to record the displacements of the individual atoms in.
 
     :returns
     X_steps - (NstepsxNSpecx3) the displacement at each step for each of the NSpec species
     t_steps - (Nsteps-size array)the residence time at each step
     jmpSelectSteps - (Nsteps-size array) which jump was selected at each step - for reproduction of a trajectory during testing.
+    -1 at steps where the escape rate is zero and the vacancy cannot move.
     jmpFinSites - The exit site index list for the vacancy out of the final state - for testing.
     """
     NSpec = SpecRates.shape[0] + 1
@@ -167,54 +359,715 @@ def LatGasKMCTraj(state, SpecRates, Nsteps, ijList, dxList,
     jmpSelectSteps = np.zeros(Nsteps, dtype=int64)  # To store which jump was selected in each step
 
     for step in range(Nsteps):
+        vacSiteNext, jmpSelect, rateTot = LatGasKMCStep(state, X, rateArr, jmpFinSiteList, SpecRates, ijList, dxList,
+                                                        vacSiteInit, vacSiteNow, np.random.rand(), N_unit,
+                                                        siteIndtoR, RtoSiteInd)
+        if jmpSelect < 0:  # If escape rate is zero, then nothing will move and time will be infinite
+            t = np.inf
+            jmpSelectSteps[step] = -1
+        else:
+            t += 1. / rateTot
+            jmpSelectSteps[step] = jmpSelect  # Store which jump was selected
+            if tracker is not None:
+                tracker.recordExchange(vacSiteNow, vacSiteNext, dxList[jmpSelect])
+            vacSiteNow = vacSiteNext
+
+        X_steps[step, :, :] = X.copy()
+        t_steps[step] = t
+
+    return X_steps, t_steps, jmpSelectSteps, jmpFinSiteList
+
+
+@jit(nopython=True)
+def makeNeighborTable(ijList, vacSiteInit, N_unit, siteIndtoR, RtoSiteInd):
+    """
+    Function to tabulate the final sites of all vacancy jumps out of every site of a mono-atomic supercell, so that
+    they need not be recomputed from lattice coordinates at every KMC step.
+    :param ijList: final site indices of the jumps out of vacSiteInit (see makeSupJumps).
+    :param vacSiteInit: the site the jumps in ijList start from.
+    :param N_unit: Supercell size.
+    :param siteIndtoR, RtoSiteInd: site index to lattice coordinate maps (see makeSiteIndtoR).
+    :return: nbrTable - (Nsites x z) array - nbrTable[site, jmp] is the final site of jump jmp out of site.
+    """
+    Nsites = siteIndtoR.shape[0]
+    nbrTable = np.zeros((Nsites, ijList.shape[0]), dtype=int64)
+    for site in range(Nsites):
+        dR = siteIndtoR[site] - siteIndtoR[vacSiteInit]
+        for jmp in range(ijList.shape[0]):
+            RfinSite = (dR + siteIndtoR[ijList[jmp]]) % N_unit
+            nbrTable[site, jmp] = RtoSiteInd[RfinSite[0], RfinSite[1], RfinSite[2]]
+    return nbrTable
+
+
+@jit(nopython=True)
+def LatGasKMCTrajTable(state, SpecRates, Nsteps, nbrTable, dxList, vacSiteInit, specSelect, tracker=None):
+    """
+    Function to generate a lattice gas KMC trajectory (same kinetics as LatGasKMCTraj), looking up the exit sites of
+    the vacancy from a precomputed neighbor table.
+    :param nbrTable: (Nsites x z) table of final sites of the vacancy jumps (see makeNeighborTable).
+    :param specSelect: Boolean - if False, the jump is selected by a search over the cumulative rates of all the
+    jumps, and the trajectory is identical to that of LatGasKMCTraj for the same random numbers. If True, the
+    neighbors are counted by species, the species to exchange with is selected first, and then one of the neighbors
+    occupied by it. Since the rates depend only on the species, this samples the same kinetics while avoiding the
+    cumulative sum over the jumps.
+    The rest of the parameters are the same as in LatGasKMCTraj.
+    :return: X_steps, t_steps, jmpSelectSteps, jmpFinSiteList - same as LatGasKMCTraj.
+    """
+    NSpec = SpecRates.shape[0] + 1
+    z = nbrTable.shape[1]
+    X = np.zeros((NSpec, 3))
+    t = 0.
+
+    X_steps = np.zeros((Nsteps, NSpec, 3))
+    t_steps = np.zeros(Nsteps)
+    jmpSelectSteps = np.zeros(Nsteps, dtype=int64)
 
-        # first get the exit rates out of this state
-        for jmpInd in range(jmpFinSiteList.shape[0]):
-            specB = state[jmpFinSiteList[jmpInd]]  # Get the species occupying the exit site.
-            rateArr[jmpInd] = SpecRates[specB]  # Get the exit rate corresponding to this species.
+    rates_cm = np.zeros(z)
+    specCounts = np.zeros(SpecRates.shape[0], dtype=int64)
+    vacSiteNow = vacSiteInit
+
+    for step in range(Nsteps):
+        # Get the escape rate
+        rateTot = 0.
+        if specSelect:
+            specCounts[:] = 0
+            for jmp in range(z):
+                specCounts[state[nbrTable[vacSiteNow, jmp]]] += 1
+            for spec in range(SpecRates.shape[0]):
+                rateTot += specCounts[spec] * SpecRates[spec]
+        else:
+            for jmp in range(z):
+                rateTot += SpecRates[state[nbrTable[vacSiteNow, jmp]]]
+                rates_cm[jmp] = rateTot
 
-        # Next get the escape time
-        rateTot = np.sum(rateArr)
         if rateTot < 1e-8:  # If escape rate is zero, then nothing will move and time will be infinite
-            X[:, :] += 0.
             t = np.inf
+            jmpSelectSteps[step] = -1
         else:
-            # convert the rates to cumulative probability
-            rateArr /= rateTot
-
             t += 1. / rateTot
-            rates_cm = np.cumsum(rateArr)
-
-            # Then select the jump
             rn = np.random.rand()
-            jmpSelect = np.searchsorted(rates_cm, rn)
 
-            jmpSelectSteps[step] = jmpSelect  # Store which jump was selected
+            if specSelect:
+                # select the species, and then which of its neighbors to exchange with.
+                r = rn * rateTot
+                specSel = 0
+                for spec in range(SpecRates.shape[0]):
+                    specRate = specCounts[spec] * SpecRates[spec]
+                    if specRate > 0.:
+                        specSel = spec
+                        if r < specRate:
+                            break
+                        r -= specRate
+                nbrSel = min(int(r / SpecRates[specSel]), specCounts[specSel] - 1)
+                jmpSelect = 0
+                for jmp in range(z):
+                    if state[nbrTable[vacSiteNow, jmp]] == specSel:
+                        if nbrSel == 0:
+                            jmpSelect = jmp
+                            break
+                        nbrSel -= 1
+            else:
+                jmpSelect = np.searchsorted(rates_cm, rn * rateTot)
 
-            # Store the displacement and the time for this step
-            X[NSpec - 1, :] += dxList[jmpSelect]
+            jmpSelectSteps[step] = jmpSelect
 
-            siteB = jmpFinSiteList[jmpSelect]
+            # Store the displacement and the time for this step
+            siteB = nbrTable[vacSiteNow, jmpSelect]
             specB = state[siteB]
+            X[NSpec - 1, :] += dxList[jmpSelect]
             X[specB, :] -= dxList[jmpSelect]
+            if tracker is not None:
+                tracker.recordExchange(vacSiteNow, siteB, dxList[jmpSelect])
 
-            dR = siteIndtoR[siteB] - siteIndtoR[vacSiteInit]
+            # Next, do the site swap to update the state
+            state[siteB] = state[vacSiteNow]
+            state[vacSiteNow] = specB
+            vacSiteNow = siteB
 
-            # Update the final jump sites
-            for jmp in range(jmpFinSiteList.shape[0]):
-                RfinSiteNew = (dR + siteIndtoR[ijList[jmp]]) % N_unit  # This returns element wise modulo when N_unit is an
-                                                                       # array instead of an integer.
+        X_steps[step, :, :] = X.copy()
+        t_steps[step] = t
 
-                jmpFinSiteList[jmp] = RtoSiteInd[RfinSiteNew[0], RfinSiteNew[1], RfinSiteNew[2]]
+    return X_steps, t_steps, jmpSelectSteps, nbrTable[vacSiteNow].copy()
 
-            # Next, do the site swap to update the state
-            temp = state[vacSiteNow]
-            state[vacSiteNow] = specB
-            state[siteB] = temp
 
-            vacSiteNow = siteB
+@jit(nopython=True)
+def makeReverseJumps(dxList):
+    """
+    Function to find, for each jump, the jump with the opposite displacement.
+    :param dxList: array containing the displacement of each jump
+    :return: revJumps - revJumps[jmp] is the index of the jump with displacement -dxList[jmp].
+    """
+    revJumps = np.full(dxList.shape[0], -1, dtype=int64)
+    for jmp in range(dxList.shape[0]):
+        for jmpRev in range(dxList.shape[0]):
+            if np.sum(np.abs(dxList[jmp] + dxList[jmpRev])) < 1e-8:
+                revJumps[jmp] = jmpRev
+                break
+    return revJumps
+
+
+@jit(nopython=True)
+def LatGasMultiVacKMCTraj(state, SpecRates, Nsteps, nbrTable, dxList, tracker=None):
+    """
+    Function to generate a lattice gas KMC trajectory with any number of vacancies in the supercell.
+    The rates of all the vacancy jumps are kept in a sum tree (see SumTree), with event index vacInd * z + jmp. After
+    a jump, only the jumps of the moving vacancy, and of other vacancies next to its initial and final sites are
+    updated, so that each step takes O(z log(Nvac * z)) time.
+    Exchanges between two vacancies are given zero rate.
+    :param state: the starting state for the trajectory (the vacancies have species index NSpec-1) - updated in place.
+    :param SpecRates: the exchange rates of a vacancy with the different species.
+    :param Nsteps: the no. of KMC steps to take
+    :param nbrTable: (Nsites x z) table of final sites of the vacancy jumps (see makeNeighborTable).
+    :param dxList: array containing the displacement of each jump
+    :param tracker: optional Tracer.TracerTracker to record the displacements of the individual atoms in.
+    :return: X_steps - (Nsteps x NSpec x 3) the total displacement of each species (the vacancy row is summed over
+             all the vacancies) at each step.
+             t_steps - (Nsteps-size array) the time at each step.
+             eventSteps - (Nsteps-size array) the event selected at each step (vacInd * z + jmp).
+             vacSites - the sites of the vacancies at the end, in the order they are indexed in the events.
+    """
+    NSpec = SpecRates.shape[0] + 1
+    Nsites, z = nbrTable.shape
+    revJumps = makeReverseJumps(dxList)
+
+    vacSites = np.where(state == NSpec - 1)[0]
+    Nvac = vacSites.shape[0]
+    vacIndOfSite = np.full(Nsites, -1, dtype=int64)
+    for vacInd in range(Nvac):
+        vacIndOfSite[vacSites[vacInd]] = vacInd
+
+    rates = np.zeros(Nvac * z)
+    for vacInd in range(Nvac):
+        for jmp in range(z):
+            specB = state[nbrTable[vacSites[vacInd], jmp]]
+            if specB != NSpec - 1:
+                rates[vacInd * z + jmp] = SpecRates[specB]
+    tree = SumTree.makeSumTree(rates)
+
+    X = np.zeros((NSpec, 3))
+    t = 0.
+    X_steps = np.zeros((Nsteps, NSpec, 3))
+    t_steps = np.zeros(Nsteps)
+    eventSteps = np.zeros(Nsteps, dtype=int64)
+
+    for step in range(Nsteps):
+        rateTot = SumTree.sumTreeTotal(tree)
+        if rateTot < 1e-8:  # If escape rate is zero, then nothing will move and time will be infinite
+            t = np.inf
+        else:
+            t += 1. / rateTot
+            event = SumTree.sumTreeSelect(tree, np.random.rand() * rateTot)
+            eventSteps[step] = event
+            vacInd = event // z
+            jmpSelect = event % z
+
+            siteA = vacSites[vacInd]
+            siteB = nbrTable[siteA, jmpSelect]
+            specB = state[siteB]
+            X[NSpec - 1, :] += dxList[jmpSelect]
+            X[specB, :] -= dxList[jmpSelect]
+            if tracker is not None:
+                tracker.recordExchange(siteA, siteB, dxList[jmpSelect])
+
+            state[siteA] = specB
+            state[siteB] = NSpec - 1
+            vacSites[vacInd] = siteB
+            vacIndOfSite[siteA] = -1
+            vacIndOfSite[siteB] = vacInd
+
+            # update the jumps of the moved vacancy
+            for jmp in range(z):
+                specC = state[nbrTable[siteB, jmp]]
+                SumTree.sumTreeUpdate(tree, vacInd * z + jmp, SpecRates[specC] if specC != NSpec - 1 else 0.)
+
+            # update the jumps of the other vacancies into the two sites that changed
+            for jmp in range(z):
+                vacNbr = vacIndOfSite[nbrTable[siteA, jmp]]
+                if vacNbr != -1:
+                    SumTree.sumTreeUpdate(tree, vacNbr * z + revJumps[jmp], SpecRates[specB])
+                vacNbr = vacIndOfSite[nbrTable[siteB, jmp]]
+                if vacNbr != -1 and vacNbr != vacInd:
+                    SumTree.sumTreeUpdate(tree, vacNbr * z + revJumps[jmp], 0.)
 
         X_steps[step, :, :] = X.copy()
         t_steps[step] = t
 
-    return X_steps, t_steps, jmpSelectSteps, jmpFinSiteList
\ No newline at end of file
+    return X_steps, t_steps, eventSteps, vacSites
+
+
+@jit(nopython=True)
+def runDomainWindow(state, SpecRates, nbrTable, dxList, revJumps, domainOfSite, domain, vacInds, vacSites, locOfSite,
+                    tWindow, key, counter, X):
+    """
+    Function to run KMC for a time window on the vacancies inside one domain of the supercell (see LatGasSLKMC).
+    A vacancy that leaves the domain is frozen for the rest of the window.
+    Waiting times are drawn from the exponential distribution, so that the window can be cut off at tWindow.
+    As in LatGasMultiVacKMCTraj, the rates of the jumps are kept in a sum tree with event index locInd * z + jmp, and
+    only the jumps of the moving vacancy and of the vacancies next to its initial and final sites are updated.
+    :param revJumps: revJumps[jmp] is the jump with the opposite displacement (see makeReverseJumps).
+    :param vacInds: indices (into vacSites) of the vacancies that are in the domain at the start of the window.
+    :param vacSites: the sites of all the vacancies - updated in place for the vacancies in vacInds.
+    :param locOfSite: (Nsites) array of -1, shared by the domains - the local index of the vacancy at each site is
+    kept in it during the window, and the entries are reset to -1 at the end.
+    :param key, counter: random stream of the domain, and the position in it to start from.
+    :param X: (NSpec x 3) array to accumulate the displacements in.
+    :return: the position in the random stream after the window, and the number of jumps made.
+    """
+    NSpec = SpecRates.shape[0] + 1
+    z = nbrTable.shape[1]
+    Nloc = vacInds.shape[0]
+    active = np.ones(Nloc, dtype=np.bool_)
+
+    rates = np.zeros(Nloc * z)
+    for locInd in range(Nloc):
+        locOfSite[vacSites[vacInds[locInd]]] = locInd
+        for jmp in range(z):
+            specB = state[nbrTable[vacSites[vacInds[locInd]], jmp]]
+            if specB != NSpec - 1:
+                rates[locInd * z + jmp] = SpecRates[specB]
+    tree = SumTree.makeSumTree(rates)
+
+    t = 0.
+    Njumps = 0
+    while True:
+        rateTot = SumTree.sumTreeTotal(tree)
+        if rateTot < 1e-8:
+            break
+
+        t -= np.log(1. - CounterRNG.randUniform(key, counter)) / rateTot
+        counter += 1
+        if t > tWindow:
+            break
+
+        event = SumTree.sumTreeSelect(tree, CounterRNG.randUniform(key, counter) * rateTot)
+        counter += 1
+
+        locInd = event // z
+        jmpSelect = event % z
+        siteA = vacSites[vacInds[locInd]]
+        siteB = nbrTable[siteA, jmpSelect]
+        specB = state[siteB]
+        X[NSpec - 1, :] += dxList[jmpSelect]
+        X[specB, :] -= dxList[jmpSelect]
+        state[siteA] = specB
+        state[siteB] = NSpec - 1
+        vacSites[vacInds[locInd]] = siteB
+        locOfSite[siteA] = -1
+        locOfSite[siteB] = locInd
+        Njumps += 1
+        if domainOfSite[siteB] != domain:
+            active[locInd] = False
+
+        # update the jumps of the moved vacancy
+        for jmp in range(z):
+            rate = 0.
+            if active[locInd]:
+                specC = state[nbrTable[siteB, jmp]]
+                if specC != NSpec - 1:
+                    rate = SpecRates[specC]
+            SumTree.sumTreeUpdate(tree, locInd * z + jmp, rate)
+
+        # update the jumps of the other active vacancies into the two sites that changed - these are all inside the
+        # domain, so that the sites outside it (which other domains may be changing) are never looked up
+        for jmp in range(z):
+            nbr = nbrTable[siteA, jmp]
+            if domainOfSite[nbr] == domain:
+                locNbr = locOfSite[nbr]
+                if locNbr != -1 and active[locNbr]:
+                    SumTree.sumTreeUpdate(tree, locNbr * z + revJumps[jmp], SpecRates[specB])
+            nbr = nbrTable[siteB, jmp]
+            if domainOfSite[nbr] == domain:
+                locNbr = locOfSite[nbr]
+                if locNbr != -1 and locNbr != locInd and active[locNbr]:
+                    SumTree.sumTreeUpdate(tree, locNbr * z + revJumps[jmp], 0.)
+
+    for locInd in range(Nloc):
+        locOfSite[vacSites[vacInds[locInd]]] = -1
+
+    return counter, Njumps
+
+
+@jit(nopython=True, parallel=True)
+def LatGasSLKMC(state, SpecRates, nbrTable, dxList, N_unit, siteIndtoR, domainSize, tWindow, Nwindows, seed):
+    """
+    Function to run synchronous sublattice parallel KMC on a lattice gas with many vacancies.
+    The supercell is divided into cubic domains of domainSize unit cells along each lattice vector, and the domains
+    are colored in a 2x2x2 checkerboard. At the start of each time window, every vacancy is assigned to the domain it
+    is in. The eight colors are then run one after the other, and all the domains of a color are run in parallel,
+    each for a time tWindow on the vacancies assigned to it (see runDomainWindow), so that every vacancy is run for
+    exactly tWindow in each window, even if it moves into a domain of a later color. Since every jump only reads and
+    changes sites within one jump of its vacancy, domains of the same color never touch the same sites if domainSize
+    is at least twice the reach of the jumps.
+    The kinetics is exact within domains, the approximation being at the domain boundaries, with an error that
+    vanishes with tWindow.
+    Domain "d" draws random numbers from stream "d" of the seed, so the results do not depend on the number of
+    threads.
+    :param state: the starting state (the vacancies have species index NSpec-1) - updated in place.
+    :param SpecRates: the exchange rates of a vacancy with the different species.
+    :param nbrTable: (Nsites x z) table of final sites of the vacancy jumps (see makeNeighborTable).
+    :param dxList: array containing the displacement of each jump
+    :param N_unit: Integer - Supercell size.
+    :param siteIndtoR: contains the lattice vectors pointing to specific supercell sites
+    :param domainSize: Integer - the size of the domains in unit cells. N_unit / domainSize must be an even integer.
+    :param tWindow: the time for which each domain is run in each window.
+    :param Nwindows: the number of windows to run.
+    :param seed: Integer - the global seed of the random streams.
+    :return: X_windows - (Nwindows x NSpec x 3) total displacement of each species at the end of each window.
+             t_windows - (Nwindows-size array) the time at the end of each window.
+             jumpCounts - (Nwindows-size array) the number of jumps made in each window.
+    """
+    NSpec = SpecRates.shape[0] + 1
+    Nsites = nbrTable.shape[0]
+
+    # get the reach of the jumps in unit cells
+    reach = 0
+    for jmp in range(nbrTable.shape[1]):
+        dR = (siteIndtoR[nbrTable[0, jmp]] - siteIndtoR[0]) % N_unit
+        for dim in range(3):
+            reach = max(reach, min(dR[dim], N_unit - dR[dim]))
+
+    if N_unit % domainSize != 0 or (N_unit // domainSize) % 2 != 0:
+        raise ValueError("The supercell must contain an even number of domains along each lattice vector.")
+    if domainSize < 2 * reach:
+        raise ValueError("The domains must be at least twice as large as the reach of the jumps.")
+
+    Nd = N_unit // domainSize
+    Ndomains = Nd * Nd * Nd
+    domainOfSite = np.zeros(Nsites, dtype=int64)
+    for site in range(Nsites):
+        d = siteIndtoR[site] // domainSize
+        domainOfSite[site] = (d[0] * Nd + d[1]) * Nd + d[2]
+
+    # group the domains by color
+    NperColor = Ndomains // 8
+    colorDomains = np.zeros((8, NperColor), dtype=int64)
+    colorCounts = np.zeros(8, dtype=int64)
+    for d0 in range(Nd):
+        for d1 in range(Nd):
+            for d2 in range(Nd):
+                color = (d0 % 2) * 4 + (d1 % 2) * 2 + d2 % 2
+                colorDomains[color, colorCounts[color]] = (d0 * Nd + d1) * Nd + d2
+                colorCounts[color] += 1
+
+    keys = np.zeros(Ndomains, dtype=int64)
+    for domain in range(Ndomains):
+        keys[domain] = CounterRNG.makeStreamKey(seed, domain)
+    counters = np.zeros(Ndomains, dtype=int64)
+    revJumps = makeReverseJumps(dxList)
+    locOfSite = np.full(Nsites, -1, dtype=int64)
+
+    vacSites = np.where(state == NSpec - 1)[0]
+    Nvac = vacSites.shape[0]
+    vacStart = np.zeros(Ndomains + 1, dtype=int64)
+    vacInDomain = np.zeros(Nvac, dtype=int64)
+    fillCount = np.zeros(Ndomains, dtype=int64)
+
+    XDomains = np.zeros((Ndomains, NSpec, 3))
+    jumpsDomains = np.zeros(Ndomains, dtype=int64)
+
+    X_windows = np.zeros((Nwindows, NSpec, 3))
+    t_windows = np.zeros(Nwindows)
+    jumpCounts = np.zeros(Nwindows, dtype=int64)
+
+    for window in range(Nwindows):
+        # sort the vacancies by the domain they are in at the start of the window - each one is run only by this
+        # domain in this window, wherever it goes
+        vacStart[:] = 0
+        for vacInd in range(Nvac):
+            vacStart[domainOfSite[vacSites[vacInd]] + 1] += 1
+        for domain in range(Ndomains):
+            vacStart[domain + 1] += vacStart[domain]
+        fillCount[:] = 0
+        for vacInd in range(Nvac):
+            domain = domainOfSite[vacSites[vacInd]]
+            vacInDomain[vacStart[domain] + fillCount[domain]] = vacInd
+            fillCount[domain] += 1
+
+        for color in range(8):
+            for domInd in prange(NperColor):
+                domain = colorDomains[color, domInd]
+                counters[domain], Njumps = runDomainWindow(state, SpecRates, nbrTable, dxList, revJumps,
+                                                           domainOfSite, domain,
+                                                           vacInDomain[vacStart[domain]:vacStart[domain + 1]],
+                                                           vacSites, locOfSite, tWindow, keys[domain],
+                                                           counters[domain], XDomains[domain])
+                jumpsDomains[domain] += Njumps
+
+        for domain in range(Ndomains):
+            X_windows[window] += XDomains[domain]
+            jumpCounts[window] += jumpsDomains[domain]
+        jumpsDomains[:] = 0
+        t_windows[window] = (window + 1) * tWindow
+
+    return X_windows, t_windows, jumpCounts
+
+
+def makeSampleSteps(Nsteps, stride=None, Nlog=None):
+    """
+    Function to make the steps at which a trajectory is to be recorded.
+    :param Nsteps: the no. of KMC steps in the trajectory.
+    :param stride: record every "stride"-th step (the last step of every stride is recorded).
+    :param Nlog: record (at most) Nlog steps logarithmically spaced between the first and the last step.
+    If neither stride nor Nlog is given, every step is recorded.
+    :return: sampleSteps - sorted array of unique (0-based) step indices.
+    """
+    if stride is not None and Nlog is not None:
+        raise ValueError("Only one of stride and Nlog can be specified")
+    if stride is not None:
+        if stride < 1:
+            raise ValueError("stride must be a positive integer")
+        return np.arange(stride - 1, Nsteps, stride, dtype=int)
+    if Nlog is not None:
+        return np.unique(np.geomspace(1, Nsteps, Nlog).astype(int)) - 1
+    return np.arange(Nsteps, dtype=int)
+
+@jit(nopython=True)
+def LatGasKMCTrajSampled(state, SpecRates, Nsteps, ijList, dxList, vacSiteInit, N_unit, siteIndtoR, RtoSiteInd,
+                         sampleSteps, sampleTimes, key=None):
+    """
+    Function to generate a lattice gas KMC trajectory (same as LatGasKMCTraj), but recording the displacements only at
+    a given set of steps and a given set of times, so that memory goes as the number of samples and not Nsteps.
+    :param sampleSteps - sorted array of the steps at which to record displacements and times (see makeSampleSteps).
+    :param sampleTimes - sorted array of times at which to record displacements. The displacement at time "T" is that
+                         of the state the system is residing in at T. Times beyond the end of the trajectory
+                         are left unrecorded.
+    :param key - optional key of a counter-based random stream to draw from (see CounterRNG.makeStreamKey), with the
+                 random number of step "step" at counter "step". If not given, numba's np.random is used.
+    The rest of the parameters are the same as in LatGasKMCTraj.
+
+    :returns
+    X_steps - (Nsamples x NSpec x 3) the displacement of each species at each of the sampled steps.
+    t_steps - (Nsamples-size array) the accumulated time at each of the sampled steps.
+    X_times - (Ntimes x NSpec x 3) the displacement of each species at each of the sampled times.
+    NtimesDone - the number of sample times that have been reached by the trajectory.
+    jmpFinSites - The exit site index list for the vacancy out of the final state.
+    """
+    NSpec = SpecRates.shape[0] + 1
+    X = np.zeros((NSpec, 3))
+    Xprev = np.zeros((NSpec, 3))
+    t = 0.
+
+    X_steps = np.zeros((sampleSteps.shape[0], NSpec, 3))
+    t_steps = np.zeros(sampleSteps.shape[0])
+    X_times = np.zeros((sampleTimes.shape[0], NSpec, 3))
+
+    rateArr = np.zeros(ijList.shape[0])
+
+    jmpFinSiteList = ijList.copy()
+    vacSiteNow = vacSiteInit
+    sampInd = 0
+    timeInd = 0
+
+    for step in range(Nsteps):
+        if key is None:
+            rn = np.random.rand()
+        else:
+            rn = CounterRNG.randUniform(key, step)
+        Xprev[:, :] = X
+        vacSiteNow, jmpSelect, rateTot = LatGasKMCStep(state, X, rateArr, jmpFinSiteList, SpecRates, ijList, dxList,
+                                                       vacSiteInit, vacSiteNow, rn, N_unit, siteIndtoR, RtoSiteInd)
+        if jmpSelect < 0:
+            t = np.inf
+        else:
+            tNew = t + 1. / rateTot
+            # The system resides in the state before the jump until tNew
+            while timeInd < sampleTimes.shape[0] and sampleTimes[timeInd] < tNew:
+                X_times[timeInd, :, :] = Xprev
+                timeInd += 1
+            t = tNew
+
+        if sampInd < sampleSteps.shape[0] and step == sampleSteps[sampInd]:
+            X_steps[sampInd, :, :] = X
+            t_steps[sampInd] = t
+            sampInd += 1
+
+    return X_steps, t_steps, X_times, timeInd, jmpFinSiteList
+
+@jit(nopython=True)
+def LatGasTrajAccumulate(state, SpecRates, Nsteps, ijList, dxList, vacSiteInit, N_unit, siteIndtoR, RtoSiteInd,
+                         key, Xsq, tSum, diff, sampleSteps=None):
+    """
+    Function to run a single lattice gas KMC trajectory (same kinetics as LatGasKMCTraj), drawing random numbers from
+    a counter-based stream and reducing the results into running accumulators instead of returning them step by step.
+    The trajectory is run by LatGasKMCTrajSampled, recording only at the sample steps.
+    :param state - the starting state for the trajectory - modified in place.
+    :param key - key of the random stream for this trajectory (see CounterRNG.makeStreamKey)
+    :param Xsq - (NSpec x Nsamples) array to accumulate the squared displacement of each species at each sample.
+    :param tSum - (Nsamples-size array) to accumulate the residence time at each sample.
+    :param diff - (NSpec x Nsamples) array to accumulate X^2/6t at each sample (as in TrajAv).
+    :param sampleSteps - sorted array of the steps at which to accumulate (see makeSampleSteps). If not given, every
+                         step is a sample (Nsamples = Nsteps).
+    The rest of the parameters are the same as in LatGasKMCTraj.
+    """
+    if sampleSteps is None:
+        steps = np.arange(Nsteps)
+    else:
+        steps = sampleSteps
+
+    X_steps, t_steps, X_times, NtimesDone, jmpFinSiteList = \
+        LatGasKMCTrajSampled(state, SpecRates, Nsteps, ijList, dxList, vacSiteInit, N_unit, siteIndtoR, RtoSiteInd,
+                             steps, np.zeros(0), key)
+
+    for sampInd in range(steps.shape[0]):
+        t = t_steps[sampInd]
+        tSum[sampInd] += t
+        for spec in range(X_steps.shape[1]):
+            r2 = np.dot(X_steps[sampInd, spec], X_steps[sampInd, spec])
+            Xsq[spec, sampInd] += r2
+            diff[spec, sampInd] += r2 / (6 * t)
+
+
+@jit(nopython=True, parallel=True)
+def LatGasKMCTrajMulti(states, SpecRates, Nsteps, ijList, dxList, vacSiteInit, N_unit, siteIndtoR, RtoSiteInd,
+                       seed, Nblocks, sampleSteps=None):
+    """
+    Function to run many independent lattice gas KMC trajectories in parallel.
+    Trajectory "i" draws its random numbers from stream "i" of the given seed, so the trajectories do not depend on
+    the number of threads or blocks (the sums may differ only by floating point round off).
+    The trajectories are divided into Nblocks blocks which are run in parallel, each accumulating into its own slice
+    of the accumulators, which are summed at the end.
+    :param states - (Ntraj x Nsites) starting states of the trajectories - these are not modified.
+    :param seed - Integer, the global seed of the random streams.
+    :param Nblocks - the number of blocks to divide the trajectories into (typically the number of threads).
+    :param sampleSteps - sorted array of the steps at which to accumulate (see makeSampleSteps). If not given, every
+                         step is a sample (Nsamples = Nsteps).
+    The rest of the parameters are the same as in LatGasKMCTraj.
+
+    :returns
+    Xsq - (NSpec x Nsamples) squared displacement of each species at each sample, summed over trajectories
+    tSum - (Nsamples-size array) residence time at each sample summed over trajectories
+    diff - (NSpec x Nsamples) X^2/6t at each sample summed over trajectories (same as accumulating TrajAv)
+    """
+    if sampleSteps is None:
+        steps = np.arange(Nsteps)
+    else:
+        steps = sampleSteps
+
+    Ntraj = states.shape[0]
+    NSpec = SpecRates.shape[0] + 1
+    Nsamples = steps.shape[0]
+    Nblocks = max(1, min(Nblocks, Ntraj))
+
+    XsqBlocks = np.zeros((Nblocks, NSpec, Nsamples))
+    tSumBlocks = np.zeros((Nblocks, Nsamples))
+    diffBlocks = np.zeros((Nblocks, NSpec, Nsamples))
+
+    for block in prange(Nblocks):
+        for traj in range(block, Ntraj, Nblocks):
+            state = states[traj].copy()
+            key = CounterRNG.makeStreamKey(seed, traj)
+            LatGasTrajAccumulate(state, SpecRates, Nsteps, ijList, dxList, vacSiteInit, N_unit, siteIndtoR,
+                                 RtoSiteInd, key, XsqBlocks[block], tSumBlocks[block], diffBlocks[block], steps)
+
+    Xsq = np.zeros((NSpec, Nsamples))
+    tSum = np.zeros(Nsamples)
+    diff = np.zeros((NSpec, Nsamples))
+    for block in range(Nblocks):
+        Xsq += XsqBlocks[block]
+        tSum += tSumBlocks[block]
+        diff += diffBlocks[block]
+
+    return Xsq, tSum, diff
+
+
+LatGasCarrierSpec = [
+    ("state", int64[:]),
+    ("X", float64[:, :]),
+    ("t", float64),
+    ("vacSiteInit", int64),
+    ("vacSiteNow", int64),
+    ("jmpFinSiteList", int64[:]),
+    ("step", int64),
+    ("key", int64),
+]
+
+LatGasCarrierFields = [field for field, typ in LatGasCarrierSpec]
+
+
+@jitclass(LatGasCarrierSpec)
+class LatGasCarrier(object):
+    """
+    Holds everything needed to continue a lattice gas KMC trajectory - the state, the vacancy position and its exit
+    sites, the accumulated displacements and time, and the position in the random stream.
+    """
+
+    def __init__(self, state, vacSiteInit, ijList, NSpec, key):
+        """
+        :param state: the starting state of the trajectory (copied).
+        :param vacSiteInit: the site of the vacancy in the starting state, to which ijList refers.
+        :param ijList: final site indices of the vacancy jumps out of vacSiteInit.
+        :param NSpec: the number of species (including the vacancy).
+        :param key: key of the random stream of the trajectory (see CounterRNG.makeStreamKey)
+        """
+        self.state = state.copy()
+        self.X = np.zeros((NSpec, 3))
+        self.t = 0.
+        self.vacSiteInit = vacSiteInit
+        self.vacSiteNow = vacSiteInit
+        self.jmpFinSiteList = ijList.copy()
+        self.step = 0
+        self.key = key
+
+
+def saveLatGasCarrier(carrier, fileName):
+    """
+    Write a LatGasCarrier to a checkpoint file.
+    """
+    Checkpoint.saveFields(carrier, LatGasCarrierFields, fileName)
+
+
+def loadLatGasCarrier(fileName):
+    """
+    Read a LatGasCarrier from a checkpoint file written with saveLatGasCarrier.
+    """
+    data = Checkpoint.loadFields(fileName, LatGasCarrierFields)
+    carrier = LatGasCarrier(data["state"], data["vacSiteInit"], data["jmpFinSiteList"], data["X"].shape[0],
+                            data["key"])
+    for field in LatGasCarrierFields:
+        setattr(carrier, field, data[field])
+    return carrier
+
+
+@jit(nopython=True)
+def LatGasKMCTrajChunk(carrier, SpecRates, Nsteps, ijList, dxList, N_unit, siteIndtoR, RtoSiteInd):
+    """
+    Function to advance a lattice gas KMC trajectory held in a LatGasCarrier by Nsteps steps, with the same kinetics
+    as LatGasKMCTraj. Random numbers are drawn from the counter-based stream of the carrier, indexed by the total step
+    count, so that running a trajectory in several chunks is exactly the same as running it in one go.
+    :param carrier: LatGasCarrier holding the trajectory - updated in place.
+    The rest of the parameters are the same as in LatGasKMCTraj.
+
+    :returns
+    X_steps - (NstepsxNSpecx3) the displacement (from the start of the trajectory) at each step of the chunk.
+    t_steps - (Nsteps-size array) the time (from the start of the trajectory) at each step of the chunk.
+    jmpSelectSteps - (Nsteps-size array) which jump was selected at each step of the chunk (-1 if the vacancy is
+    blocked).
+    """
+    NSpec = SpecRates.shape[0] + 1
+    X = carrier.X
+    state = carrier.state
+    jmpFinSiteList = carrier.jmpFinSiteList
+
+    X_steps = np.zeros((Nsteps, NSpec, 3))
+    t_steps = np.zeros(Nsteps)
+    jmpSelectSteps = np.zeros(Nsteps, dtype=int64)
+
+    rateArr = np.zeros(ijList.shape[0])
+
+    for step in range(Nsteps):
+        carrier.vacSiteNow, jmpSelect, rateTot = \
+            LatGasKMCStep(state, X, rateArr, jmpFinSiteList, SpecRates, ijList, dxList, carrier.vacSiteInit,
+                          carrier.vacSiteNow, CounterRNG.randUniform(carrier.key, carrier.step), N_unit, siteIndtoR,
+                          RtoSiteInd)
+        if jmpSelect < 0:
+            carrier.t = np.inf
+            jmpSelectSteps[step] = -1
+        else:
+            carrier.t += 1. / rateTot
+            jmpSelectSteps[step] = jmpSelect
+
+        carrier.step += 1
+        X_steps[step, :, :] = X
+        t_steps[step] = carrier.t
+
+    return X_steps, t_steps, jmpSelectSteps
@@ -1,6 +1,11 @@
 import numpy as np
+from scipy import sparse
 from numba.experimental import jitclass
-from numba import jit, int64, float64
+from numba import jit, prange, int64, uint64, float64
+import CounterRNG
+import SumTree
+import Checkpoint
+import MC_Kernels
 
 # Paste all the function definitions here as comments
 
@@ -32,6 +37,206 @@ def DoRandSwap(state, Ntrials, vacSiteInd):
 
     return initSiteList, finSiteList
 
+MCCarrierSpec = [
+    ("mobOcc", int64[:]),
+    ("OffSiteCount", int64[:]),
+    ("TransOffSiteCount", int64[:]),
+    ("acceptCount", int64),
+    ("badTrials", int64),
+    ("trialCount", int64),
+    ("drawCount", int64),
+    ("key", int64),
+]
+
+MCCarrierFields = [field for field, typ in MCCarrierSpec]
+
+
+@jitclass(MCCarrierSpec)
+class MCCarrier(object):
+    """
+    Holds everything needed to continue a chain of MC swap trials - the state, its off site counts, the acceptance
+    counters and the position in the random stream.
+    """
+    def __init__(self, mobOcc, OffSiteCount, TransOffSiteCount, key):
+        self.mobOcc = mobOcc.copy()
+        self.OffSiteCount = OffSiteCount.copy()
+        self.TransOffSiteCount = TransOffSiteCount.copy()
+        self.acceptCount = 0
+        self.badTrials = 0
+        self.trialCount = 0
+        self.drawCount = 0
+        self.key = key
+
+
+KMCCarrierSpec = [
+    ("state", int64[:]),
+    ("offsc", int64[:]),
+    ("X", float64[:, :]),
+    ("t", float64),
+    ("vacSiteFix", int64),
+    ("vacIndNow", int64),
+    ("step", int64),
+    ("key", int64),
+]
+
+KMCCarrierFields = [field for field, typ in KMCCarrierSpec]
+
+
+@jitclass(KMCCarrierSpec)
+class KMCCarrier(object):
+    """
+    Holds everything needed to continue a KMC trajectory - the state, its off site counts, the vacancy position, the
+    accumulated displacements and time, and the position in the random stream.
+    """
+    def __init__(self, state, offsc, vacSiteFix, NSpec, key):
+        self.state = state.copy()
+        self.offsc = offsc.copy()
+        self.X = np.zeros((NSpec, 3))
+        self.t = 0.
+        self.vacSiteFix = vacSiteFix
+        self.vacIndNow = vacSiteFix
+        self.step = 0
+        self.key = key
+
+
+MCTableFields = ["numSitesInteracts", "SupSitesInteracts", "SpecOnInteractSites", "Interaction2En",
+                 "numInteractsSiteSpec", "SiteSpecInterArray", "numSitesTSInteracts", "TSInteractSites",
+                 "TSInteractSpecs"]
+
+
+def hashMCTables(MC_jit):
+    """
+    :param MC_jit: MCSamplerClass (or KMC_JIT) object.
+    :return: hash of the interaction tables that the MC sweeps depend on.
+    """
+    return Checkpoint.hashArrays([getattr(MC_jit, field) for field in MCTableFields])
+
+
+def saveMCCarrier(carrier, fileName, tableHash="", writer=None):
+    """
+    Write an MCCarrier to a checkpoint file.
+    :param tableHash: hash of the interaction tables the carrier is run with (see hashMCTables) - checked when the
+    carrier is read back.
+    :param writer: optional Checkpoint.BackgroundWriter to do the write in the background.
+    """
+    arrays = {field: np.asarray(getattr(carrier, field)) for field in MCCarrierFields}
+    arrays["tableHash"] = np.array(tableHash)
+    if writer is None:
+        Checkpoint.atomicSavez(fileName, **arrays)
+    else:
+        writer.submit(fileName, **arrays)
+
+
+def loadMCCarrier(fileName, tableHash=None):
+    """
+    Read an MCCarrier from a checkpoint file written with saveMCCarrier.
+    The off site counts are read back as they were saved, and not recomputed.
+    :param tableHash: if given, the hash of the interaction tables the carrier will be run with - a ValueError is
+    raised if the carrier was saved with different tables.
+    """
+    data = Checkpoint.loadFields(fileName, MCCarrierFields)
+    if tableHash is not None:
+        with np.load(fileName) as fl:
+            savedHash = fl["tableHash"].item() if "tableHash" in fl.files else ""
+        if savedHash != tableHash:
+            raise ValueError("The checkpoint {} was written with different interaction tables".format(fileName))
+    carrier = MCCarrier(data["mobOcc"], data["OffSiteCount"], data["TransOffSiteCount"], data["key"])
+    for field in MCCarrierFields:
+        setattr(carrier, field, data[field])
+    return carrier
+
+
+def runMCSweeps(MC_jit, carrier, beta, Nsweeps, Nswaptrials, vacSiteInd, checkpointFile=None,
+                checkpointInterval=1, writer=None):
+    """
+    Run MC sweeps of Nswaptrials swap trials each (see MCSamplerClass.makeMCsweepChunk) on a carrier, until it has
+    done Nsweeps sweeps in total, writing it to a checkpoint file every checkpointInterval sweeps and at the end.
+    To restart an interrupted run, read the carrier back with loadMCCarrier and call this again with the same
+    arguments - since the random numbers are indexed by the carrier's counters, the run continues exactly as if it
+    had not been interrupted.
+    :param MC_jit: MCSamplerClass object to do the sweeps with.
+    :param carrier: MCCarrier holding the state - updated in place.
+    :param checkpointFile: name of the checkpoint file (None for no checkpoints).
+    :param writer: Checkpoint.BackgroundWriter to write the checkpoints with. If not given, one is made for this call,
+    and closed (waiting for the last write) before returning.
+    :return: the carrier.
+    """
+    tableHash = hashMCTables(MC_jit)
+    ownWriter = writer is None and checkpointFile is not None
+    if ownWriter:
+        writer = Checkpoint.BackgroundWriter()
+    try:
+        sweep = carrier.trialCount // Nswaptrials
+        while sweep < Nsweeps:
+            MC_jit.makeMCsweepChunk(carrier, beta, Nswaptrials, vacSiteInd)
+            sweep += 1
+            if checkpointFile is not None and (sweep % checkpointInterval == 0 or sweep == Nsweeps):
+                saveMCCarrier(carrier, checkpointFile, tableHash, writer)
+    finally:
+        if ownWriter:
+            writer.close()
+    return carrier
+
+
+def sgcScan(MC_jit, state, OffSiteCount, muList, beta, NequilSweeps, NsampleSweeps, Nfliptrials, vacSiteInd):
+    """
+    Scan the composition over a list of chemical potentials with semi-grand-canonical sweeps (see
+    MCSamplerClass.makeSGCsweep). The state is carried over from each chemical potential to the next, so that each one
+    starts from a state already close to equilibrium, and the composition is averaged over every trial of the
+    sampling sweeps.
+    :param state: the starting state - updated in place.
+    :param OffSiteCount: the off site counts of the state - updated in place.
+    :param muList: (Nmu x Nspec) the chemical potentials to go through, in order.
+    :param NequilSweeps: the number of sweeps at each chemical potential before sampling.
+    :param NsampleSweeps: the number of sweeps to average the composition over at each chemical potential.
+    :return: comps - (Nmu x Nspec) the average fraction of the sites occupied by each species.
+             accepts - (Nmu) the fraction of the sampling flips accepted.
+    """
+    Nspec = muList.shape[1]
+    Nsites = state.shape[0]
+    specCounts = np.bincount(state, minlength=Nspec).astype(np.int64)
+    TransOffSiteCount = np.zeros(MC_jit.numSitesTSInteracts.shape[0], dtype=np.int64)
+    FlipTrials = np.zeros((Nfliptrials, 2), dtype=np.int64)
+
+    comps = np.zeros((muList.shape[0], Nspec))
+    accepts = np.zeros(muList.shape[0])
+    for muInd in range(muList.shape[0]):
+        mu = np.asarray(muList[muInd], dtype=float)
+        compSum = np.zeros(Nspec)
+        for sweep in range(NequilSweeps + NsampleSweeps):
+            randarr = np.log(np.random.rand(Nfliptrials))
+            if sweep < NequilSweeps:
+                MC_jit.makeSGCsweep(state, OffSiteCount, TransOffSiteCount, FlipTrials, beta, mu, randarr,
+                                    Nfliptrials, specCounts, np.zeros(Nspec), vacSiteInd)
+            else:
+                acceptCount, acceptInd = MC_jit.makeSGCsweep(state, OffSiteCount, TransOffSiteCount, FlipTrials,
+                                                             beta, mu, randarr, Nfliptrials, specCounts, compSum,
+                                                             vacSiteInd)
+                accepts[muInd] += acceptCount
+        comps[muInd, :] = compSum / (Nsites * Nfliptrials * max(NsampleSweeps, 1))
+        accepts[muInd] /= Nfliptrials * max(NsampleSweeps, 1)
+
+    return comps, accepts
+
+
+def saveKMCCarrier(carrier, fileName):
+    """
+    Write a KMCCarrier to a checkpoint file.
+    """
+    Checkpoint.saveFields(carrier, KMCCarrierFields, fileName)
+
+
+def loadKMCCarrier(fileName):
+    """
+    Read a KMCCarrier from a checkpoint file written with saveKMCCarrier.
+    """
+    data = Checkpoint.loadFields(fileName, KMCCarrierFields)
+    carrier = KMCCarrier(data["state"], data["offsc"], data["vacSiteFix"], data["X"].shape[0], data["key"])
+    for field in KMCCarrierFields:
+        setattr(carrier, field, data[field])
+    return carrier
+
+
 MonteCarloSamplerSpec = [
     ("numInteractsSiteSpec", int64[:, :]),
     ("SiteSpecInterArray", int64[:, :, :]),
@@ -99,458 +304,96 @@ class MCSamplerClass(object):
         # Reformat the array so that the swaps are always between atoms of different species
 
     def makeMCsweep(self, mobOcc, OffSiteCount, TransOffSiteCount,
-                    SwapTrials, beta, randarr, Nswaptrials, vacSiteInd=0):
-
-        acceptCount = 0
-        acceptInd = np.zeros(Nswaptrials, dtype=int64)
-        badTrials = 0
-        self.delEArray = np.zeros(Nswaptrials)
-
-        Nsites = len(mobOcc)
-
-        count = 0  # to keep a steady count of accepted moves
-        swapcount = 0
-        while swapcount < Nswaptrials:
-            # first select two random sites to swap - for now, let's just select naively.
-            siteA = np.random.randint(0, Nsites)
-            siteB = np.random.randint(0, Nsites)
-
-            specA = mobOcc[siteA]
-            specB = mobOcc[siteB]
-
-            if specA == specB or siteA == vacSiteInd or siteB == vacSiteInd:
-                badTrials += 1
-                continue
-
-            # If the move is not a bad one, then store it for testing later on
-            SwapTrials[swapcount, 0] = siteA
-            SwapTrials[swapcount, 1] = siteB
-
-            delE = 0.
-            # Next, switch required sites off
-            for interIdx in range(self.numInteractsSiteSpec[siteA, specA]):
-                # check if an interaction is on
-                interMainInd = self.SiteSpecInterArray[siteA, specA, interIdx]
-                if OffSiteCount[interMainInd] == 0:
-                    delE -= self.Interaction2En[interMainInd]
-                OffSiteCount[interMainInd] += 1
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, specB]):
-                interMainInd = self.SiteSpecInterArray[siteB, specB, interIdx]
-                # offscount = OffSiteCount[interMainInd]
-                if OffSiteCount[interMainInd] == 0:
-                    delE -= self.Interaction2En[interMainInd]
-                OffSiteCount[interMainInd] += 1
-
-            # Next, switch required sites on
-            for interIdx in range(self.numInteractsSiteSpec[siteA, specB]):
-                interMainInd = self.SiteSpecInterArray[siteA, specB, interIdx]
-                OffSiteCount[interMainInd] -= 1
-                if OffSiteCount[interMainInd] == 0:
-                    delE += self.Interaction2En[interMainInd]
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, specA]):
-                interMainInd = self.SiteSpecInterArray[siteB, specA, interIdx]
-                OffSiteCount[interMainInd] -= 1
-                if OffSiteCount[interMainInd] == 0:
-                    delE += self.Interaction2En[interMainInd]
-
-            self.delEArray[swapcount] = delE
-
-            # do the selection test
-            if -beta*delE > randarr[swapcount]:
-                # swap the sites to get to the next state
-                mobOcc[siteA] = specB
-                mobOcc[siteB] = specA
-                # OffSiteCount is already updated to that of the new state.
-                acceptCount += 1
-                count += 1
-                acceptInd[swapcount] = count
-
-            else:
-                # revert back the off site counts, because the state has not changed
-                for interIdx in range(self.numInteractsSiteSpec[siteA, specA]):
-                    # interMainInd = self.SiteSpecInterArray[siteA, specA, interIdx]
-                    OffSiteCount[self.SiteSpecInterArray[siteA, specA, interIdx]] -= 1
+                    SwapTrials, beta, randarr, Nswaptrials, vacSiteInd=0, Interaction2Orbit=None, OrbitCounts=None):
+        """
+        Optionally, pass Interaction2Orbit (see Cluster_Expansion.VectorClusterExpansion.makeInteractionOrbits) and
+        OrbitCounts (see makeOrbitCounts) to keep the number of interactions of each orbit that are on up to date
+        during the sweep - the energy of the state for any other set of orbit energies is then OrbitCounts @ En.
+        """
+        if OrbitCounts is None:
+            acceptCount, badTrials, acceptInd, self.delEArray = \
+                MC_Kernels.mcSweep(mobOcc, OffSiteCount, TransOffSiteCount, SwapTrials, beta, randarr, Nswaptrials,
+                                   vacSiteInd, self.numInteractsSiteSpec, self.SiteSpecInterArray, self.Interaction2En,
+                                   self.numSitesTSInteracts, self.TSInteractSites, self.TSInteractSpecs,
+                                   np.zeros(0, dtype=int64), np.zeros(0, dtype=int64))
+        else:
+            acceptCount, badTrials, acceptInd, self.delEArray = \
+                MC_Kernels.mcSweep(mobOcc, OffSiteCount, TransOffSiteCount, SwapTrials, beta, randarr, Nswaptrials,
+                                   vacSiteInd, self.numInteractsSiteSpec, self.SiteSpecInterArray, self.Interaction2En,
+                                   self.numSitesTSInteracts, self.TSInteractSites, self.TSInteractSpecs,
+                                   Interaction2Orbit, OrbitCounts)
 
-                for interIdx in range(self.numInteractsSiteSpec[siteB, specB]):
-                    # interMainInd = self.SiteSpecInterArray[siteB, specB, interIdx]
-                    OffSiteCount[self.SiteSpecInterArray[siteB, specB, interIdx]] -= 1
+        return acceptCount, badTrials, acceptInd
 
-                for interIdx in range(self.numInteractsSiteSpec[siteA, specB]):
-                    # interMainInd = self.SiteSpecInterArray[siteA, specB, interIdx]
-                    OffSiteCount[self.SiteSpecInterArray[siteA, specB, interIdx]] += 1
+    def makeSGCsweep(self, mobOcc, OffSiteCount, TransOffSiteCount, FlipTrials, beta, mu, randarr, Nfliptrials,
+                     specCounts, compSum, vacSiteInd=0):
+        """
+        Semi-grand-canonical sweep - Nfliptrials trials, each changing the species at one random site to another
+        (non-vacancy) species, accepted with the Metropolis criterion on delE - (mu[specNew] - mu[specOld]).
+        With a single mobile species no flip is possible, and every trial is rejected (see MC_Kernels.sgcSweep).
+        :param FlipTrials: (Nfliptrials x 2) array - the site and new species of each trial are stored in it.
+        :param mu: (Nspec) chemical potentials of the species (only their differences matter).
+        :param randarr: log of uniform random numbers for the acceptance tests (as in makeMCsweep).
+        :param specCounts: (Nspec) the number of sites with each species - updated in place.
+        :param compSum: (Nspec) the species counts after every trial are added to it.
+        :return: acceptCount - the number of accepted flips.
+                 acceptInd - the running count of accepted flips at each accepted trial (zero if rejected).
+        """
+        acceptCount, acceptInd, self.delEArray = \
+            MC_Kernels.sgcSweep(mobOcc, OffSiteCount, TransOffSiteCount, FlipTrials, beta, mu, randarr, Nfliptrials,
+                                vacSiteInd, self.numInteractsSiteSpec, self.SiteSpecInterArray, self.Interaction2En,
+                                self.numSitesTSInteracts, self.TSInteractSites, self.TSInteractSpecs, specCounts,
+                                compSum)
 
-                for interIdx in range(self.numInteractsSiteSpec[siteB, specA]):
-                    # interMainInd = self.SiteSpecInterArray[siteB, specA, interIdx]
-                    OffSiteCount[self.SiteSpecInterArray[siteB, specA, interIdx]] += 1
+        return acceptCount, acceptInd
 
-            swapcount += 1
+    def makeMCsweepChunk(self, carrier, beta, Nswaptrials, vacSiteInd=0):
+        """
+        Do Nswaptrials swap trials (same as makeMCsweep) on the state held in an MCCarrier.
+        The sites and the acceptance tests are drawn from the counter-based stream of the carrier, so that doing
+        the trials in several chunks is exactly the same as doing them in one go.
+        :param carrier: MCCarrier holding the state, off site counts and counters - updated in place.
+        :return: acceptCount - the number of accepted swaps in this chunk.
+        """
+        acceptCount, badTrials, carrier.drawCount = \
+            MC_Kernels.mcSweepStream(carrier.mobOcc, carrier.OffSiteCount, carrier.TransOffSiteCount, beta,
+                                     Nswaptrials, vacSiteInd, carrier.key, carrier.drawCount,
+                                     self.numInteractsSiteSpec, self.SiteSpecInterArray, self.Interaction2En,
+                                     self.numSitesTSInteracts, self.TSInteractSites, self.TSInteractSpecs)
 
-        # make the offsite for the transition states
-        for TsInteractIdx in range(len(self.TSInteractSites)):
-            TransOffSiteCount[TsInteractIdx] = 0
-            for Siteind in range(self.numSitesTSInteracts[TsInteractIdx]):
-                if mobOcc[self.TSInteractSites[TsInteractIdx, Siteind]] != self.TSInteractSpecs[TsInteractIdx, Siteind]:
-                    TransOffSiteCount[TsInteractIdx] += 1
+        carrier.acceptCount += acceptCount
+        carrier.badTrials += badTrials
+        carrier.trialCount += Nswaptrials
 
-        return acceptCount, badTrials, acceptInd
+        return acceptCount
 
     def MultiSwapMC(self, mobOcc, OffSiteCount, TransOffSiteCount,
                     SwapTrials, Nswaptrials, beta, randlog, vacSiteInd=0):
 
-        Nsites = len(mobOcc)
-        EnChange = 0.
-        swapcount = 0
-
-        while swapcount < Nswaptrials:
-            # first select two random sites to swap - for now, let's just select naively.
-            siteA = np.random.randint(0, Nsites)
-            siteB = np.random.randint(0, Nsites)
-
-            specA = mobOcc[siteA]
-            specB = mobOcc[siteB]
-
-            if specA == specB or siteA == vacSiteInd or siteB == vacSiteInd:
-                continue
-
-            SwapTrials[swapcount, 0] = siteA
-            SwapTrials[swapcount, 1] = siteB
-
-            delE = 0.
-            # Next, switch required sites off
-            for interIdx in range(self.numInteractsSiteSpec[siteA, specA]):
-                # check if an interaction is on
-                interMainInd = self.SiteSpecInterArray[siteA, specA, interIdx]
-                if OffSiteCount[interMainInd] == 0:
-                    delE -= self.Interaction2En[interMainInd]
-                OffSiteCount[interMainInd] += 1
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, specB]):
-                interMainInd = self.SiteSpecInterArray[siteB, specB, interIdx]
-                # offscount = OffSiteCount[interMainInd]
-                if OffSiteCount[interMainInd] == 0:
-                    delE -= self.Interaction2En[interMainInd]
-                OffSiteCount[interMainInd] += 1
-
-            # Next, switch required sites on
-            for interIdx in range(self.numInteractsSiteSpec[siteA, specB]):
-                interMainInd = self.SiteSpecInterArray[siteA, specB, interIdx]
-                OffSiteCount[interMainInd] -= 1
-                if OffSiteCount[interMainInd] == 0:
-                    delE += self.Interaction2En[interMainInd]
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, specA]):
-                interMainInd = self.SiteSpecInterArray[siteB, specA, interIdx]
-                OffSiteCount[interMainInd] -= 1
-                if OffSiteCount[interMainInd] == 0:
-                    delE += self.Interaction2En[interMainInd]
-
-            # do the selection test
-            # swap the sites to get to the next state
-            mobOcc[siteA] = specB
-            mobOcc[siteB] = specA
-            # add the energy to get the energy of the next state
-            EnChange += delE
-            swapcount += 1
-
-        # Do the Metropolis test
-
-        if -beta*EnChange < randlog:  # Then the whole thing needs to be reverted
-
-            # We need to reverse everything in the exact opposite sequence of how it was produced
-            for i in range(Nswaptrials-1, -1, -1):
-                # Get the sites that were swapped
-                siteA = SwapTrials[i, 0]
-                siteB = SwapTrials[i, 1]
-
-                # remember that the sites have been swapped.
-                # So, The previous specA is now at siteB
-                specA = mobOcc[siteB]
-                specB = mobOcc[siteA]
-
-                # revert off site counts
-                for interIdx in range(self.numInteractsSiteSpec[siteA, specA]):
-                    OffSiteCount[self.SiteSpecInterArray[siteA, specA, interIdx]] -= 1
-
-                for interIdx in range(self.numInteractsSiteSpec[siteB, specB]):
-                    OffSiteCount[self.SiteSpecInterArray[siteB, specB, interIdx]] -= 1
-
-                for interIdx in range(self.numInteractsSiteSpec[siteA, specB]):
-                    OffSiteCount[self.SiteSpecInterArray[siteA, specB, interIdx]] += 1
-
-                for interIdx in range(self.numInteractsSiteSpec[siteB, specA]):
-                    OffSiteCount[self.SiteSpecInterArray[siteB, specA, interIdx]] += 1
-
-                # revert state
-                mobOcc[siteA] = specA
-                mobOcc[siteB] = specB
-
-        # once the final state is decided, compute the TS energies.
-        for TsInteractIdx in range(len(self.TSInteractSites)):
-            TransOffSiteCount[TsInteractIdx] = 0
-            for Siteind in range(self.numSitesTSInteracts[TsInteractIdx]):
-                if mobOcc[self.TSInteractSites[TsInteractIdx, Siteind]] != self.TSInteractSpecs[TsInteractIdx, Siteind]:
-                    TransOffSiteCount[TsInteractIdx] += 1
-
-        return EnChange  # For testing
+        return MC_Kernels.multiSwapMC(mobOcc, OffSiteCount, TransOffSiteCount, SwapTrials, Nswaptrials, beta, randlog,
+                                      vacSiteInd, self.numInteractsSiteSpec, self.SiteSpecInterArray,
+                                      self.Interaction2En, self.numSitesTSInteracts, self.TSInteractSites,
+                                      self.TSInteractSpecs)
 
     def Expand(self, state, ijList, dxList, OffSiteCount, TSOffSiteCount, lenVecClus, beta):
 
-        del_lamb_mat = np.zeros((lenVecClus, lenVecClus, ijList.shape[0]))
-        delxDotdelLamb = np.zeros((lenVecClus, ijList.shape[0]))
-
-        ratelist = np.zeros(ijList.shape[0])
-
-        siteA, specA = self.vacSiteInd, self.Nspecs - 1
-        # go through all the transition
-
-        for jumpInd in range(ijList.shape[0]):
-            del_lamb = np.zeros((lenVecClus, 3))
-
-            # Get the transition index
-            siteB, specB = ijList[jumpInd], state[ijList[jumpInd]]
-            transInd = self.FinSiteFinSpecJumpInd[siteB, specB]
-
-            # SiteTransArray[jumpInd] = siteB
-            # SpecTransArray[jumpInd] = specB
-
-            # First, work on getting the KRA energy for the jump
-            delEKRA = 0.0
-            # We need to go through every point group for this jump
-            for tsPtGpInd in range(self.numJumpPointGroups[transInd]):
-                for interactInd in range(self.numTSInteractsInPtGroups[transInd, tsPtGpInd]):
-                    # Check if this interaction is on
-                    interactMainInd = self.JumpInteracts[transInd, tsPtGpInd, interactInd]
-                    if TSOffSiteCount[interactMainInd] == 0:
-                        delEKRA += self.Jump2KRAEng[transInd, tsPtGpInd, interactInd]
-
-            # delEKRAarray[jumpInd] = delEKRA
-
-            # next, calculate the energy change due to site swapping
-
-            delE = 0.0
-            # Switch required sites off
-            for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteA]]):
-                # check if an interaction is on
-                interMainInd = self.SiteSpecInterArray[siteA, state[siteA], interIdx]
-                if OffSiteCount[interMainInd] == 0:
-                    delE -= self.Interaction2En[interMainInd]
-                    # take away the vectors for this interaction
-                    for i in range(self.numVecsInteracts[interMainInd]):
-                        del_lamb[self.VecGroupInteracts[interMainInd, i]] -= self.VecsInteracts[interMainInd, i, :]
-                OffSiteCount[interMainInd] += 1
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteB]]):
-                interMainInd = self.SiteSpecInterArray[siteB, state[siteB], interIdx]
-                if OffSiteCount[interMainInd] == 0:
-                    delE -= self.Interaction2En[interMainInd]
-                    for i in range(self.numVecsInteracts[interMainInd]):
-                        del_lamb[self.VecGroupInteracts[interMainInd, i]] -= self.VecsInteracts[interMainInd, i, :]
-                OffSiteCount[interMainInd] += 1
-
-            # Next, switch required sites on
-            for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteB]]):
-                interMainInd = self.SiteSpecInterArray[siteA, state[siteB], interIdx]
-                OffSiteCount[interMainInd] -= 1
-                if OffSiteCount[interMainInd] == 0:
-                    delE += self.Interaction2En[interMainInd]
-                    # add the vectors for this interaction
-                    for i in range(self.numVecsInteracts[interMainInd]):
-                        del_lamb[self.VecGroupInteracts[interMainInd, i]] += self.VecsInteracts[interMainInd, i, :]
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteA]]):
-                interMainInd = self.SiteSpecInterArray[siteB, state[siteA], interIdx]
-                OffSiteCount[interMainInd] -= 1
-                if OffSiteCount[interMainInd] == 0:
-                    delE += self.Interaction2En[interMainInd]
-                    # add the vectors for this interaction
-                    # for interactions with zero vector basis, numVecsInteracts[interMainInd] = -1 and the
-                    # loop doesn't run
-                    for i in range(self.numVecsInteracts[interMainInd]):
-                        del_lamb[self.VecGroupInteracts[interMainInd, i]] += self.VecsInteracts[interMainInd, i, :]
-
-            # delEarray[jumpInd] = delE
-            # Energy change computed, now expand
-            # if 0.5 * delE + delEKRA < 0:
-            #     print(delE, delEKRA)
-            #     raise ValueError("negative activation barrier")
-            ratelist[jumpInd] = np.exp(-(0.5 * delE + delEKRA) * beta)
-            del_lamb_mat[:, :, jumpInd] = np.dot(del_lamb, del_lamb.T)
-
-            # delxDotdelLamb[:, jumpInd] = np.tensordot(del_lamb, dxList[jumpInd], axes=(1, 0))
-            # let's do the tensordot by hand (work on finding numba support for this)
-            for i in range(lenVecClus):
-                # replace innder loop with outer product
-                delxDotdelLamb[i, jumpInd] = np.dot(del_lamb[i, :], dxList[jumpInd, :])
-
-            # Next, restore OffSiteCounts to original values for next jump, as well as
-            # for use in the next MC sweep.
-            # During switch-off operations, offsite counts were increased by one.
-            # So decrease them back by one
-            for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteA]]):
-                OffSiteCount[self.SiteSpecInterArray[siteA, state[siteA], interIdx]] -= 1
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteB]]):
-                OffSiteCount[self.SiteSpecInterArray[siteB, state[siteB], interIdx]] -= 1
-
-            # During switch-on operations, offsite counts were decreased by one.
-            # So increase them back by one
-            for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteB]]):
-                OffSiteCount[self.SiteSpecInterArray[siteA, state[siteB], interIdx]] += 1
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteA]]):
-                OffSiteCount[self.SiteSpecInterArray[siteB, state[siteA], interIdx]] += 1
-
-        # Wbar = np.tensordot(ratelist, del_lamb_mat, axes=(0, 2))
-        WBar = np.zeros((lenVecClus, lenVecClus))
-        for i in range(lenVecClus):
-            for j in range(lenVecClus):
-                WBar[i, j] += np.dot(del_lamb_mat[i, j, :], ratelist)
-
-        # assert np.allclose(Wbar, WBar)
-
-        # Bbar = np.tensordot(ratelist, delxDotdelLamb, axes=(0, 1))
-        BBar = np.zeros(lenVecClus)
-        for i in range(lenVecClus):
-            BBar[i] = np.dot(ratelist, delxDotdelLamb[i, :])
-
-        # assert np.allclose(Bbar, BBar)
-
-        return WBar, BBar
+        return MC_Kernels.expand(state, ijList, dxList, OffSiteCount, TSOffSiteCount, lenVecClus, beta,
+                                 self.vacSiteInd, self.numInteractsSiteSpec, self.SiteSpecInterArray,
+                                 self.Interaction2En, self.numVecsInteracts, self.VecsInteracts, self.VecGroupInteracts,
+                                 self.FinSiteFinSpecJumpInd, self.numJumpPointGroups, self.numTSInteractsInPtGroups,
+                                 self.JumpInteracts, self.Jump2KRAEng)
 
     def GetNewRandState(self, mobOcc, OffSiteCount, Energy, SwapTrials, Nswaptrials):
 
-        En = Energy
-        for swapcount in range(Nswaptrials):
-            # first select two random sites to swap - for now, let's just select naively.
-            siteA = SwapTrials[swapcount, 0]
-            siteB = SwapTrials[swapcount, 1]
-
-            specA = mobOcc[siteA]
-            specB = mobOcc[siteB]
-
-            delE = 0.
-            # Next, switch required sites off
-            for interIdx in range(self.numInteractsSiteSpec[siteA, specA]):
-                # check if an interaction is on
-                interMainInd = self.SiteSpecInterArray[siteA, specA, interIdx]
-                if OffSiteCount[interMainInd] == 0:
-                    delE -= self.Interaction2En[interMainInd]
-                OffSiteCount[interMainInd] += 1
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, specB]):
-                interMainInd = self.SiteSpecInterArray[siteB, specB, interIdx]
-                # offscount = OffSiteCount[interMainInd]
-                if OffSiteCount[interMainInd] == 0:
-                    delE -= self.Interaction2En[interMainInd]
-                OffSiteCount[interMainInd] += 1
-
-            # Next, switch required sites on
-            for interIdx in range(self.numInteractsSiteSpec[siteA, specB]):
-                interMainInd = self.SiteSpecInterArray[siteA, specB, interIdx]
-                OffSiteCount[interMainInd] -= 1
-                if OffSiteCount[interMainInd] == 0:
-                    delE += self.Interaction2En[interMainInd]
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, specA]):
-                interMainInd = self.SiteSpecInterArray[siteB, specA, interIdx]
-                OffSiteCount[interMainInd] -= 1
-                if OffSiteCount[interMainInd] == 0:
-                    delE += self.Interaction2En[interMainInd]
-
-            # do the selection test
-            # swap the sites to get to the next state
-            mobOcc[siteA] = specB
-            mobOcc[siteB] = specA
-            # add the energy to get the energy of the next state
-            En += delE
-
-        return En
+        return MC_Kernels.newRandState(mobOcc, OffSiteCount, Energy, SwapTrials, Nswaptrials,
+                                       self.numInteractsSiteSpec, self.SiteSpecInterArray, self.Interaction2En)
 
     def getExitData(self, state, ijList, dxList, OffSiteCount, TSOffSiteCount, beta, Nsites):
 
-        statesTrans = np.zeros((ijList.shape[0], Nsites), dtype=int64)
-        ratelist = np.zeros(ijList.shape[0])
-        Specdisps = np.zeros((ijList.shape[0], self.Nspecs, 3))  # To store the displacement of each species during every jump
-
-        siteA, specA = self.vacSiteInd, self.Nspecs - 1
-        # go through all the transition
-
-        for jumpInd in range(ijList.shape[0]):
-            # Get the transition index
-            siteB, specB = ijList[jumpInd], state[ijList[jumpInd]]
-            transInd = self.FinSiteFinSpecJumpInd[siteB, specB]
-
-            # copy the state
-            statesTrans[jumpInd, :] = state
-
-            # swap occupancies after jump
-            statesTrans[jumpInd, siteB] = state[siteA]
-            statesTrans[jumpInd, siteA] = state[siteB]
-
-            # First, work on getting the KRA energy for the jump
-            delEKRA = 0.0
-            # We need to go through every point group for this jump
-            for tsPtGpInd in range(self.numJumpPointGroups[transInd]):
-                for interactInd in range(self.numTSInteractsInPtGroups[transInd, tsPtGpInd]):
-                    # Check if this interaction is on
-                    interactMainInd = self.JumpInteracts[transInd, tsPtGpInd, interactInd]
-                    if TSOffSiteCount[interactMainInd] == 0:
-                        delEKRA += self.Jump2KRAEng[transInd, tsPtGpInd, interactInd]
-
-            # next, calculate the energy change due to site swapping
-            delE = 0.0
-            # Switch required sites off
-            for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteA]]):
-                # check if an interaction is on
-                interMainInd = self.SiteSpecInterArray[siteA, state[siteA], interIdx]
-                if OffSiteCount[interMainInd] == 0:
-                    delE -= self.Interaction2En[interMainInd]
-                OffSiteCount[interMainInd] += 1
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteB]]):
-                interMainInd = self.SiteSpecInterArray[siteB, state[siteB], interIdx]
-                if OffSiteCount[interMainInd] == 0:
-                    delE -= self.Interaction2En[interMainInd]
-                OffSiteCount[interMainInd] += 1
-
-            # Next, switch required sites on
-            for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteB]]):
-                interMainInd = self.SiteSpecInterArray[siteA, state[siteB], interIdx]
-                OffSiteCount[interMainInd] -= 1
-                if OffSiteCount[interMainInd] == 0:
-                    delE += self.Interaction2En[interMainInd]
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteA]]):
-                interMainInd = self.SiteSpecInterArray[siteB, state[siteA], interIdx]
-                OffSiteCount[interMainInd] -= 1
-                if OffSiteCount[interMainInd] == 0:
-                    delE += self.Interaction2En[interMainInd]
-
-            ratelist[jumpInd] = np.exp(-(0.5 * delE + delEKRA) * beta)
-            Specdisps[jumpInd, specB, :] = -dxList[jumpInd, :]
-            Specdisps[jumpInd, -1, :] = dxList[jumpInd, :]
-
-            # Next, restore OffSiteCounts to original values for next jump, as well as
-            # for use in the next MC sweep.
-            # During switch-off operations, offsite counts were increased by one.
-            # So decrease them back by one
-            for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteA]]):
-                OffSiteCount[self.SiteSpecInterArray[siteA, state[siteA], interIdx]] -= 1
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteB]]):
-                OffSiteCount[self.SiteSpecInterArray[siteB, state[siteB], interIdx]] -= 1
-
-            # During switch-on operations, offsite counts were decreased by one.
-            # So increase them back by one
-            for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteB]]):
-                OffSiteCount[self.SiteSpecInterArray[siteA, state[siteB], interIdx]] += 1
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteA]]):
-                OffSiteCount[self.SiteSpecInterArray[siteB, state[siteA], interIdx]] += 1
-
-        return statesTrans, ratelist, Specdisps
+        return MC_Kernels.exitData(state, ijList, dxList, OffSiteCount, TSOffSiteCount, beta, Nsites,
+                                   self.vacSiteInd, self.Nspecs, self.numInteractsSiteSpec, self.SiteSpecInterArray,
+                                   self.Interaction2En, self.FinSiteFinSpecJumpInd, self.numJumpPointGroups,
+                                   self.numTSInteractsInPtGroups, self.JumpInteracts, self.Jump2KRAEng)
 
 
 KMC_additional_spec = [
@@ -597,189 +440,139 @@ class KMC_JIT(object):
         :param N_unit: Number of unit cells in each direction
         :return:
         """
-        dR = self.siteIndtoR[siteFin, :] - self.siteIndtoR[siteInit, :]
-        stateTrans = np.zeros_like(state, dtype=int64)
-        for siteInd in range(state.shape[0]):
-            Rnew = (self.siteIndtoR[siteInd, :] + dR) % self.N_unit  # to apply PBC
-            siteIndNew = self.RtoSiteInd[Rnew[0], Rnew[1], Rnew[2]]
-            stateTrans[siteIndNew] = state[siteInd]
-        return stateTrans
+        return MC_Kernels.translateState(state, siteFin, siteInit, self.siteIndtoR, self.RtoSiteInd, self.N_unit)
 
-    def GetOffSite(self, state):
+    def GetOffSite(self, state, occBits=None):
         """
         :param state: State for which to count off sites of interactions
+        :param occBits: optional OccupancyBits object of the site interactions (see makeOccupancyBits) - if given,
+        the off sites are counted on the bitset occupancy of the state instead of site by site.
         :return: OffSiteCount array (N_interaction x 1)
         """
-        OffSiteCount = np.zeros(self.numSitesInteracts.shape[0], dtype=int64)
-        for interactIdx in range(self.numSitesInteracts.shape[0]):
-            for intSiteind in range(self.numSitesInteracts[interactIdx]):
-                if state[self.SupSitesInteracts[interactIdx, intSiteind]] !=\
-                        self.SpecOnInteractSites[interactIdx, intSiteind]:
-                    OffSiteCount[interactIdx] += 1
-        return OffSiteCount
+        if occBits is None:
+            return MC_Kernels.countOffSites(state, self.numSitesInteracts, self.SupSitesInteracts,
+                                            self.SpecOnInteractSites)
+        return occBits.GetOffSite(occBits.makeOccupancy(state))
 
-    def GetTSOffSite(self, state):
+    def GetTSOffSite(self, state, occBits=None):
         """
         :param state: State for which to count off sites of TS interactions
+        :param occBits: optional OccupancyBits object of the TS interactions (see makeOccupancyBits) - if given,
+        the off sites are counted on the bitset occupancy of the state instead of site by site.
         :return: OffSiteCount array (N_interaction x 1)
         """
-        TransOffSiteCount = np.zeros(self.numSitesTSInteracts.shape[0], dtype=int64)
-        for TsInteractIdx in range(self.numSitesTSInteracts.shape[0]):
-            for Siteind in range(self.numSitesTSInteracts[TsInteractIdx]):
-                if state[self.TSInteractSites[TsInteractIdx, Siteind]] != self.TSInteractSpecs[TsInteractIdx, Siteind]:
-                    TransOffSiteCount[TsInteractIdx] += 1
-        return TransOffSiteCount
+        if occBits is None:
+            return MC_Kernels.countOffSites(state, self.numSitesTSInteracts, self.TSInteractSites,
+                                            self.TSInteractSpecs)
+        return occBits.GetOffSite(occBits.makeOccupancy(state))
+
+    def getEnergy(self, state, occBits=None):
+        """
+        :param state: State to get the energy of.
+        :param occBits: optional OccupancyBits object of the site interactions (see makeOccupancyBits) - if given,
+        the interactions are evaluated on the bitset occupancy of the state.
+        :return: the total energy of the interactions that are on in the state.
+        """
+        if occBits is None:
+            OffSiteCount = self.GetOffSite(state)
+            En = 0.
+            for interactIdx in range(OffSiteCount.shape[0]):
+                if OffSiteCount[interactIdx] == 0:
+                    En += self.Interaction2En[interactIdx]
+            return En
+        return occBits.getEnergy(occBits.makeOccupancy(state), self.Interaction2En)
+
+    def hashState(self, state, occBits):
+        """
+        :param occBits: OccupancyBits object (either one made by makeOccupancyBits).
+        :return: uint64 hash of the state, from its bitset occupancy (see OccupancyBits.hashOccupancy).
+        """
+        return occBits.hashOccupancy(occBits.makeOccupancy(state))
 
     def getKRAEnergies(self, state, TSOffSiteCount, ijList):
 
-        delEKRA = np.zeros(ijList.shape[0], dtype=float64)
-        for jumpInd in range(ijList.shape[0]):
-            delE = 0.0
-            # Get the transition index
-            siteB, specB = ijList[jumpInd], state[ijList[jumpInd]]
-            transInd = self.FinSiteFinSpecJumpInd[siteB, specB]
-            # We need to go through every point group for this jump
-            for tsPtGpInd in range(self.numJumpPointGroups[transInd]):
-                for interactInd in range(self.numTSInteractsInPtGroups[transInd, tsPtGpInd]):
-                    # Check if this interaction is on
-                    interactMainInd = self.JumpInteracts[transInd, tsPtGpInd, interactInd]
-                    if TSOffSiteCount[interactMainInd] == 0:
-                        delE += self.Jump2KRAEng[transInd, tsPtGpInd, interactInd]
-            delEKRA[jumpInd] = delE
-
-        return delEKRA
+        return MC_Kernels.getKRAEnergies(state, TSOffSiteCount, ijList, self.FinSiteFinSpecJumpInd,
+                                         self.numJumpPointGroups, self.numTSInteractsInPtGroups, self.JumpInteracts,
+                                         self.Jump2KRAEng)
 
     def getEnergyChangeJumps(self, state, OffSiteCount, siteA, jmpFinSiteListTrans):
 
-        delEArray = np.zeros(jmpFinSiteListTrans.shape[0], dtype=float64)
-
-        for jmpInd in range(jmpFinSiteListTrans.shape[0]):
-            siteB = jmpFinSiteListTrans[jmpInd]
-            delE = 0.0
-            # Switch required sites off
-            for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteA]]):
-                # check if an interaction is on
-                interMainInd = self.SiteSpecInterArray[siteA, state[siteA], interIdx]
-                if OffSiteCount[interMainInd] == 0:
-                    delE -= self.Interaction2En[interMainInd]
-                OffSiteCount[interMainInd] += 1
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteB]]):
-                interMainInd = self.SiteSpecInterArray[siteB, state[siteB], interIdx]
-                if OffSiteCount[interMainInd] == 0:
-                    delE -= self.Interaction2En[interMainInd]
-                OffSiteCount[interMainInd] += 1
-
-            # Next, switch required sites on
-            for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteB]]):
-                interMainInd = self.SiteSpecInterArray[siteA, state[siteB], interIdx]
-                OffSiteCount[interMainInd] -= 1
-                if OffSiteCount[interMainInd] == 0:
-                    delE += self.Interaction2En[interMainInd]
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteA]]):
-                interMainInd = self.SiteSpecInterArray[siteB, state[siteA], interIdx]
-                OffSiteCount[interMainInd] -= 1
-                if OffSiteCount[interMainInd] == 0:
-                    delE += self.Interaction2En[interMainInd]
-
-            delEArray[jmpInd] = delE
-
-            # Now revert offsitecounts for next jump
-            for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteA]]):
-                OffSiteCount[self.SiteSpecInterArray[siteA, state[siteA], interIdx]] -= 1
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteB]]):
-                OffSiteCount[self.SiteSpecInterArray[siteB, state[siteB], interIdx]] -= 1
-
-            # During switch-on operations, offsite counts were decreased by one.
-            # So increase them back by one
-            for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteB]]):
-                OffSiteCount[self.SiteSpecInterArray[siteA, state[siteB], interIdx]] += 1
-
-            for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteA]]):
-                OffSiteCount[self.SiteSpecInterArray[siteB, state[siteA], interIdx]] += 1
-
-        return delEArray
+        return MC_Kernels.getEnergyChangeJumps(state, OffSiteCount, siteA, jmpFinSiteListTrans,
+                                               self.numInteractsSiteSpec, self.SiteSpecInterArray, self.Interaction2En)
 
     def updateState(self, state, OffSiteCount, siteA, siteB):
 
-        # update offsitecounts
-        for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteA]]):
-            interMainInd = self.SiteSpecInterArray[siteA, state[siteA], interIdx]
-            OffSiteCount[interMainInd] += 1
-
-        for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteB]]):
-            interMainInd = self.SiteSpecInterArray[siteB, state[siteB], interIdx]
-            OffSiteCount[interMainInd] += 1
-
-        # Next, switch required sites on
-        for interIdx in range(self.numInteractsSiteSpec[siteA, state[siteB]]):
-            interMainInd = self.SiteSpecInterArray[siteA, state[siteB], interIdx]
-            OffSiteCount[interMainInd] -= 1
-
-        for interIdx in range(self.numInteractsSiteSpec[siteB, state[siteA]]):
-            interMainInd = self.SiteSpecInterArray[siteB, state[siteA], interIdx]
-            OffSiteCount[interMainInd] -= 1
-
-        # swap sites
-        temp = state[siteA]
-        state[siteA] = state[siteB]
-        state[siteB] = temp
-
-    def getTraj(self, state, offsc, vacSiteFix, jumpFinSiteList, dxList, NSpec, Nsteps, beta):
-
-        X = np.zeros((NSpec, 3), dtype=float64)
-        t = 0.
-
-        X_steps = np.zeros((Nsteps, NSpec, 3), dtype=float64)
-        t_steps = np.zeros(Nsteps, dtype=float64)
-
-        jumpFinSiteListTrans = np.zeros_like(jumpFinSiteList, dtype=int64)
-        vacIndNow = vacSiteFix
-
-        for step in range(Nsteps):
-
-            # Translate the states so that vacancy is taken from vacIndnow to vacSiteFix
-            stateTrans = self.TranslateState(state, vacSiteFix, vacIndNow)
-            TSoffsc = self.GetTSOffSite(stateTrans)
-
-            delEKRA = self.getKRAEnergies(stateTrans, TSoffsc, jumpFinSiteList)
-
-            dR = self.siteIndtoR[vacIndNow] - self.siteIndtoR[vacSiteFix]
-
-            for jmp in range(jumpFinSiteList.shape[0]):
-                RfinSiteNew = (dR + self.siteIndtoR[jumpFinSiteList[jmp]]) % self.N_unit
-                jumpFinSiteListTrans[jmp] = self.RtoSiteInd[RfinSiteNew[0], RfinSiteNew[1], RfinSiteNew[2]]
-
-            delE = self.getEnergyChangeJumps(state, offsc, vacIndNow, jumpFinSiteListTrans)
-
-            rates = np.exp(-(0.5 * delE + delEKRA) * beta)
-            rateTot = np.sum(rates)
-            t += 1.0/rateTot
-
-            rates /= rateTot
-            rates_cm = np.cumsum(rates)
-            rn = np.random.rand()
-            jmpSelect = np.searchsorted(rates_cm, rn)
-
-            vacIndNext = jumpFinSiteListTrans[jmpSelect]
-
-            X[NSpec - 1, :] += dxList[jmpSelect]
-            specB = state[vacIndNext]
-            X[specB, :] -= dxList[jmpSelect]
+        MC_Kernels.updateState(state, OffSiteCount, siteA, siteB, self.numInteractsSiteSpec, self.SiteSpecInterArray)
 
-            X_steps[step, :, :] = X.copy()
-            t_steps[step] = t
+    def getTraj(self, state, offsc, vacSiteFix, jumpFinSiteList, dxList, NSpec, Nsteps, beta, tracker=None):
+        """
+        Run a KMC trajectory of a single vacancy, starting at vacSiteFix, drawing random numbers from numba's
+        np.random (see MC_Kernels.kmcTraj).
+        :param tracker: optional Tracer.TracerTracker to record the displacements of the individual atoms in.
+        :return: X_steps - (Nsteps x NSpec x 3) displacements of each species at each step.
+                 t_steps - (Nsteps-size array) time at each step.
+        """
+        X_steps, t_steps, jumpRecord, t, vacIndNow = \
+            MC_Kernels.kmcTraj(state, offsc, np.zeros((NSpec, 3), dtype=float64), 0., vacSiteFix, vacSiteFix,
+                               jumpFinSiteList, dxList, Nsteps, beta, None, 0, self.siteIndtoR, self.RtoSiteInd,
+                               self.N_unit, self.numSitesTSInteracts, self.TSInteractSites, self.TSInteractSpecs,
+                               self.FinSiteFinSpecJumpInd, self.numJumpPointGroups, self.numTSInteractsInPtGroups,
+                               self.JumpInteracts, self.Jump2KRAEng, self.numInteractsSiteSpec,
+                               self.SiteSpecInterArray, self.Interaction2En)
+
+        if tracker is not None:
+            # the tracker depends only on the sequence of exchanges, so it can be brought up to date afterwards
+            for step in range(Nsteps):
+                tracker.recordExchange(jumpRecord[step, 0], jumpRecord[step, 1], dxList[jumpRecord[step, 2]])
 
-            self.updateState(state, offsc, vacIndNow, vacIndNext)
+        return X_steps, t_steps
 
-            vacIndNow = vacIndNext
+    def getTrajChunk(self, carrier, jumpFinSiteList, dxList, NSpec, Nsteps, beta):
+        """
+        Advance the trajectory held in a KMCCarrier by Nsteps steps, with the same kinetics as getTraj.
+        Random numbers are drawn from the counter-based stream of the carrier, indexed by the total step count, so
+        that running a trajectory in several chunks is exactly the same as running it in one go.
+        :param carrier: KMCCarrier holding the trajectory - updated in place.
+        :return: X_steps - (Nsteps x NSpec x 3) displacements (from the start of the trajectory) at each step.
+                 t_steps - (Nsteps-size array) time (from the start of the trajectory) at each step.
+        """
+        X_steps, t_steps, jumpRecord, carrier.t, carrier.vacIndNow = \
+            MC_Kernels.kmcTraj(carrier.state, carrier.offsc, carrier.X, carrier.t, carrier.vacSiteFix,
+                               carrier.vacIndNow, jumpFinSiteList, dxList, Nsteps, beta, carrier.key, carrier.step,
+                               self.siteIndtoR, self.RtoSiteInd, self.N_unit, self.numSitesTSInteracts,
+                               self.TSInteractSites, self.TSInteractSpecs, self.FinSiteFinSpecJumpInd,
+                               self.numJumpPointGroups, self.numTSInteractsInPtGroups, self.JumpInteracts,
+                               self.Jump2KRAEng, self.numInteractsSiteSpec, self.SiteSpecInterArray,
+                               self.Interaction2En)
+        carrier.step += Nsteps
 
         return X_steps, t_steps
 
+    def getTrajSampled(self, state, offsc, vacSiteFix, jumpFinSiteList, dxList, NSpec, Nsteps, beta,
+                       sampleSteps, sampleTimes, key=None):
+        """
+        Same as getTraj, but the displacements are recorded only at a set of steps and a set of times, so that memory
+        goes as the number of samples and not Nsteps (see MC_Kernels.kmcTrajSampled).
+        :param sampleSteps: sorted array of the steps at which to record displacements and times.
+        :param sampleTimes: sorted array of times at which to record displacements. The displacement at time "T" is
+        that of the state the system is residing in at T. Times beyond the end of the trajectory are left unrecorded.
+        :param key: optional key of a counter-based random stream to draw from (see CounterRNG.makeStreamKey). If not
+        given, numba's np.random is used, as in getTraj.
+        :return: X_steps - (Nsamples x NSpec x 3) displacements of each species at the sampled steps.
+                 t_steps - (Nsamples-size array) the accumulated time at the sampled steps.
+                 X_times - (Ntimes x NSpec x 3) displacements of each species at the sampled times.
+                 NtimesDone - the number of sample times that have been reached by the trajectory.
+        """
+        return MC_Kernels.kmcTrajSampled(state, offsc, vacSiteFix, jumpFinSiteList, dxList, NSpec, Nsteps, beta, key,
+                                         sampleSteps, sampleTimes, self.siteIndtoR, self.RtoSiteInd, self.N_unit,
+                                         self.numSitesTSInteracts, self.TSInteractSites, self.TSInteractSpecs,
+                                         self.FinSiteFinSpecJumpInd, self.numJumpPointGroups,
+                                         self.numTSInteractsInPtGroups, self.JumpInteracts, self.Jump2KRAEng,
+                                         self.numInteractsSiteSpec, self.SiteSpecInterArray, self.Interaction2En)
+
 # Here, we write a function that forms the shells
-def makeShells(MC_jit, KMC_jit, state0, offsc0, TSoffsc0, ijList, dxList, beta, Nsites, Nspec, Nshells=1):
+def makeShells(MC_jit, KMC_jit, state0, offsc0, TSoffsc0, ijList, dxList, beta, Nsites, Nspec, Nshells=1,
+               occBits=None, TSoccBits=None):
     """
     Function to make shells around a "seed" state
     :param MC_jit: JIT class MC sampler - to use the exitstates function
@@ -787,6 +580,8 @@ def makeShells(MC_jit, KMC_jit, state0, offsc0, TSoffsc0, ijList, dxList, beta,
     The MC and KMC Jit classes need to be initialized with the same arrays.
     :param state0: The starting initial state.
     :param Nshells: The number of shells to build
+    :param occBits, TSoccBits: optional OccupancyBits objects (see makeOccupancyBits) to recount the off sites of
+    the states of the shells with.
     :return:
     """
     vacSiteInd = MC_jit.vacSiteInd
@@ -836,8 +631,8 @@ def makeShells(MC_jit, KMC_jit, state0, offsc0, TSoffsc0, ijList, dxList, beta,
         nextshell = set([])
         for stateBin in lastShell:
             state = np.frombuffer(stateBin, dtype=state0.dtype)
-            offsc = KMC_jit.GetOffSite(state)
-            TSoffsc = KMC_jit.GetTSOffSite(state)
+            offsc = KMC_jit.GetOffSite(state, occBits)
+            TSoffsc = KMC_jit.GetTSOffSite(state, TSoccBits)
 
             # Now get the exits out of this state
             statesTrans, ratelist, Specdisps = MC_jit.getExitData(state, ijList, dxList, offsc,
@@ -861,4 +656,1114 @@ def makeShells(MC_jit, KMC_jit, state0, offsc0, TSoffsc0, ijList, dxList, beta,
 
         lastShell = nextShell.copy()
 
-    return state2Index, Index2State, TransitionRates, TransitionsZero, velocities
\ No newline at end of file
+    return state2Index, Index2State, TransitionRates, TransitionsZero, velocities
+
+@jit(nopython=True)
+def getTrajAccumulate(KMC_jit, state, offsc, vacSiteFix, jumpFinSiteList, dxList, NSpec, Nsteps, beta,
+                      key, Xsq, tSum, diff, sampleSteps=None):
+    """
+    Run a single KMC trajectory with the same kinetics as KMC_JIT.getTraj, drawing random numbers from a counter-based
+    stream, and reduce the results into running accumulators instead of storing them step by step.
+    The trajectory is run by KMC_JIT.getTrajSampled, recording only at the sample steps.
+    :param KMC_jit: KMC_JIT object to use the interaction data from.
+    :param state: The starting state - modified in place.
+    :param offsc: The off site counts of the starting state - modified in place.
+    :param key: key of the random stream for this trajectory (see CounterRNG.makeStreamKey)
+    :param Xsq: (NSpec x Nsamples) array to accumulate the squared displacement of each species at each sample.
+    :param tSum: (Nsamples-size array) to accumulate the residence time at each sample.
+    :param diff: (NSpec x Nsamples) array to accumulate X^2/6t at each sample (as in LatGas.TrajAv).
+    :param sampleSteps: sorted array of the steps at which to accumulate (see LatGas.makeSampleSteps). If not given,
+    every step is a sample (Nsamples = Nsteps).
+    """
+    if sampleSteps is None:
+        steps = np.arange(Nsteps)
+    else:
+        steps = sampleSteps
+
+    X_steps, t_steps, X_times, NtimesDone = KMC_jit.getTrajSampled(state, offsc, vacSiteFix, jumpFinSiteList, dxList,
+                                                                   NSpec, Nsteps, beta, steps, np.zeros(0), key)
+
+    for sampInd in range(steps.shape[0]):
+        t = t_steps[sampInd]
+        tSum[sampInd] += t
+        for spec in range(NSpec):
+            r2 = np.dot(X_steps[sampInd, spec], X_steps[sampInd, spec])
+            Xsq[spec, sampInd] += r2
+            diff[spec, sampInd] += r2 / (6 * t)
+
+
+@jit(nopython=True, parallel=True)
+def getTrajMulti(KMC_jit, states, vacSiteFix, jumpFinSiteList, dxList, NSpec, Nsteps, beta, seed, Nblocks,
+                 sampleSteps=None):
+    """
+    Run many independent KMC trajectories in parallel, sharing the (read-only) interaction data in KMC_jit.
+    Each trajectory gets its own copy of the state and off site counts, and trajectory "i" draws its random numbers
+    from stream "i" of the given seed, so the trajectories do not depend on the number of threads or blocks.
+    :param KMC_jit: KMC_JIT object to use the interaction data from.
+    :param states: (Ntraj x Nsites) starting states, all with the vacancy at vacSiteFix - these are not modified.
+    :param seed: Integer - the global seed of the random streams.
+    :param Nblocks: the number of blocks to divide the trajectories into (typically the number of threads).
+    :param sampleSteps: sorted array of the steps at which to accumulate (see LatGas.makeSampleSteps). If not given,
+    every step is a sample (Nsamples = Nsteps).
+    :return: Xsq - (NSpec x Nsamples) squared displacements of each species at each sample summed over trajectories.
+             tSum - (Nsamples-size array) residence time at each sample summed over trajectories.
+             diff - (NSpec x Nsamples) X^2/6t at each sample summed over trajectories.
+    """
+    if sampleSteps is None:
+        steps = np.arange(Nsteps)
+    else:
+        steps = sampleSteps
+
+    Ntraj = states.shape[0]
+    Nsamples = steps.shape[0]
+    Nblocks = max(1, min(Nblocks, Ntraj))
+
+    XsqBlocks = np.zeros((Nblocks, NSpec, Nsamples))
+    tSumBlocks = np.zeros((Nblocks, Nsamples))
+    diffBlocks = np.zeros((Nblocks, NSpec, Nsamples))
+
+    for block in prange(Nblocks):
+        for traj in range(block, Ntraj, Nblocks):
+            state = states[traj].copy()
+            offsc = KMC_jit.GetOffSite(state)
+            key = CounterRNG.makeStreamKey(seed, traj)
+            getTrajAccumulate(KMC_jit, state, offsc, vacSiteFix, jumpFinSiteList, dxList, NSpec, Nsteps, beta, key,
+                              XsqBlocks[block], tSumBlocks[block], diffBlocks[block], steps)
+
+    Xsq = np.zeros((NSpec, Nsamples))
+    tSum = np.zeros(Nsamples)
+    diff = np.zeros((NSpec, Nsamples))
+    for block in range(Nblocks):
+        Xsq += XsqBlocks[block]
+        tSum += tSumBlocks[block]
+        diff += diffBlocks[block]
+
+    return Xsq, tSum, diff
+
+
+@jit(nopython=True)
+def countOrbitsOn(state, numSitesInteracts, SupSitesInteracts, SpecOnInteractSites, Interaction2Orbit, orbitCounts):
+    """
+    Add the number of interactions of each orbit that are on in a state to orbitCounts.
+    """
+    for interactIdx in range(numSitesInteracts.shape[0]):
+        on = True
+        for intSiteind in range(numSitesInteracts[interactIdx]):
+            if state[SupSitesInteracts[interactIdx, intSiteind]] != SpecOnInteractSites[interactIdx, intSiteind]:
+                on = False
+                break
+        if on:
+            orbitCounts[Interaction2Orbit[interactIdx]] += 1
+
+
+@jit(nopython=True)
+def makeOrbitCounts(OffSiteCount, Interaction2Orbit, Norbits):
+    """
+    :return: (Norbits) the number of interactions of each orbit that are on, from the off site counts of a state -
+    the starting point for the orbit counts kept up to date by MCSamplerClass.makeMCsweep.
+    """
+    OrbitCounts = np.zeros(Norbits, dtype=int64)
+    for interactIdx in range(OffSiteCount.shape[0]):
+        if OffSiteCount[interactIdx] == 0:
+            OrbitCounts[Interaction2Orbit[interactIdx]] += 1
+    return OrbitCounts
+
+
+@jit(nopython=True, parallel=True)
+def evaluateStatesJit(states, numSitesInteracts, SupSitesInteracts, SpecOnInteractSites, Interaction2Orbit, OrbitEn):
+    """
+    Energies and per-orbit on-counts of a batch of states, in parallel over the states.
+    :param states: (Nstates x Nsites) the states to evaluate.
+    :param Interaction2Orbit: (Ninteracts) the orbit (symmetry-grouped species cluster) of each interaction (see
+    Cluster_Expansion.VectorClusterExpansion.makeInteractionOrbits).
+    :param OrbitEn: (Norbits) the energy of each orbit.
+    :return: energies - (Nstates) the energy of each state.
+             indptr, indices, data - the (Nstates x Norbits) matrix of on-counts in compressed sparse row form.
+    """
+    Nstates = states.shape[0]
+    Norbits = OrbitEn.shape[0]
+    energies = np.zeros(Nstates)
+    nnz = np.zeros(Nstates, dtype=int64)
+
+    # first pass - the energies and the number of orbits on in each state
+    for stateInd in prange(Nstates):
+        orbitCounts = np.zeros(Norbits, dtype=int64)
+        countOrbitsOn(states[stateInd], numSitesInteracts, SupSitesInteracts, SpecOnInteractSites,
+                      Interaction2Orbit, orbitCounts)
+        En = 0.
+        for orbit in range(Norbits):
+            if orbitCounts[orbit] > 0:
+                En += orbitCounts[orbit] * OrbitEn[orbit]
+                nnz[stateInd] += 1
+        energies[stateInd] = En
+
+    indptr = np.zeros(Nstates + 1, dtype=int64)
+    for stateInd in range(Nstates):
+        indptr[stateInd + 1] = indptr[stateInd] + nnz[stateInd]
+
+    # second pass - fill in the rows, now that we know where they go
+    indices = np.zeros(indptr[Nstates], dtype=int64)
+    data = np.zeros(indptr[Nstates], dtype=int64)
+    for stateInd in prange(Nstates):
+        orbitCounts = np.zeros(Norbits, dtype=int64)
+        countOrbitsOn(states[stateInd], numSitesInteracts, SupSitesInteracts, SpecOnInteractSites,
+                      Interaction2Orbit, orbitCounts)
+        pos = indptr[stateInd]
+        for orbit in range(Norbits):
+            if orbitCounts[orbit] > 0:
+                indices[pos] = orbit
+                data[pos] = orbitCounts[orbit]
+                pos += 1
+
+    return energies, indptr, indices, data
+
+
+def evaluateStates(states, numSitesInteracts, SupSitesInteracts, SpecOnInteractSites, Interaction2Orbit, OrbitEn):
+    """
+    Cluster expansion energies and the design matrix of a batch of states (e.g, relaxed structures or stored MC
+    samples) - see evaluateStatesJit.
+    :return: energies - (Nstates) the energy of each state.
+             design - (Nstates x Norbits) scipy.sparse.csr_matrix, design[i, orbit] is the number of interactions of
+             the orbit that are on in state i, so that energies = design @ OrbitEn.
+    """
+    energies, indptr, indices, data = evaluateStatesJit(np.ascontiguousarray(states), numSitesInteracts,
+                                                        SupSitesInteracts, SpecOnInteractSites, Interaction2Orbit,
+                                                        OrbitEn)
+    design = sparse.csr_matrix((data, indices, indptr), shape=(states.shape[0], OrbitEn.shape[0]))
+    return energies, design
+
+
+@jit(nopython=True)
+def makeRateAffectSites(KMC_jit, vacSiteFix, jumpFinSiteList):
+    """
+    Function to find the sites whose occupancy can change the rate of any jump of a vacancy at vacSiteFix, i.e, the
+    sites of all the interactions (in any species configuration) of the initial and final sites of the jumps, and the
+    sites of the transition state interactions of the jumps.
+    :param KMC_jit: KMC_JIT object to use the interaction data from.
+    :param vacSiteFix: the site the jumps in jumpFinSiteList start from.
+    :param jumpFinSiteList: the final sites of the jumps out of vacSiteFix.
+    :return: affectSites - array of the site indices (relative to a vacancy at vacSiteFix).
+    """
+    affected = np.zeros(KMC_jit.Nsites, dtype=np.bool_)
+    for jmp in range(-1, jumpFinSiteList.shape[0]):
+        site = vacSiteFix if jmp == -1 else jumpFinSiteList[jmp]
+        affected[site] = True
+        for spec in range(KMC_jit.Nspecs):
+            for interIdx in range(KMC_jit.numInteractsSiteSpec[site, spec]):
+                interMainInd = KMC_jit.SiteSpecInterArray[site, spec, interIdx]
+                for intSiteInd in range(KMC_jit.numSitesInteracts[interMainInd]):
+                    affected[KMC_jit.SupSitesInteracts[interMainInd, intSiteInd]] = True
+
+            if jmp == -1:
+                continue
+            transInd = KMC_jit.FinSiteFinSpecJumpInd[site, spec]
+            if transInd < 0:
+                continue
+            for tsPtGpInd in range(KMC_jit.numJumpPointGroups[transInd]):
+                for interactInd in range(KMC_jit.numTSInteractsInPtGroups[transInd, tsPtGpInd]):
+                    tsInteractInd = KMC_jit.JumpInteracts[transInd, tsPtGpInd, interactInd]
+                    for tsSiteInd in range(KMC_jit.numSitesTSInteracts[tsInteractInd]):
+                        affected[KMC_jit.TSInteractSites[tsInteractInd, tsSiteInd]] = True
+
+    return np.where(affected)[0]
+
+
+@jit(nopython=True)
+def getVacancyRates(KMC_jit, state, offsc, vacSite, vacSiteFix, jumpFinSiteList, NSpec, beta, finSites, rates):
+    """
+    Function to compute the rates of the jumps of one vacancy in a state that may contain other vacancies.
+    The transition state interactions (defined around vacSiteFix) are looked up at the translated sites directly,
+    so the state does not need to be translated. Jumps into other vacancies are given zero rate.
+    :param KMC_jit: KMC_JIT object to use the interaction data from.
+    :param state: the current state.
+    :param offsc: the off site counts of the current state - restored on exit.
+    :param vacSite: the site of the vacancy.
+    :param finSites: array to store the final sites of the jumps of the vacancy in.
+    :param rates: array to store the jump rates in.
+    """
+    dR = KMC_jit.siteIndtoR[vacSite] - KMC_jit.siteIndtoR[vacSiteFix]
+    for jmp in range(jumpFinSiteList.shape[0]):
+        RfinSiteNew = (dR + KMC_jit.siteIndtoR[jumpFinSiteList[jmp]]) % KMC_jit.N_unit
+        finSites[jmp] = KMC_jit.RtoSiteInd[RfinSiteNew[0], RfinSiteNew[1], RfinSiteNew[2]]
+
+    delE = KMC_jit.getEnergyChangeJumps(state, offsc, vacSite, finSites)
+
+    for jmp in range(jumpFinSiteList.shape[0]):
+        specB = state[finSites[jmp]]
+        if specB == NSpec - 1:
+            rates[jmp] = 0.
+            continue
+        delEKRA = 0.
+        transInd = KMC_jit.FinSiteFinSpecJumpInd[jumpFinSiteList[jmp], specB]
+        for tsPtGpInd in range(KMC_jit.numJumpPointGroups[transInd]):
+            for interactInd in range(KMC_jit.numTSInteractsInPtGroups[transInd, tsPtGpInd]):
+                tsInteractInd = KMC_jit.JumpInteracts[transInd, tsPtGpInd, interactInd]
+                isOn = True
+                for tsSiteInd in range(KMC_jit.numSitesTSInteracts[tsInteractInd]):
+                    Rsite = (dR + KMC_jit.siteIndtoR[KMC_jit.TSInteractSites[tsInteractInd, tsSiteInd]]) % KMC_jit.N_unit
+                    if state[KMC_jit.RtoSiteInd[Rsite[0], Rsite[1], Rsite[2]]] != \
+                            KMC_jit.TSInteractSpecs[tsInteractInd, tsSiteInd]:
+                        isOn = False
+                        break
+                if isOn:
+                    delEKRA += KMC_jit.Jump2KRAEng[transInd, tsPtGpInd, interactInd]
+        rates[jmp] = np.exp(-(0.5 * delE[jmp] + delEKRA) * beta)
+
+
+@jit(nopython=True)
+def getMultiVacTraj(KMC_jit, state, offsc, vacSiteFix, jumpFinSiteList, dxList, NSpec, Nsteps, beta, tracker=None):
+    """
+    Run a KMC trajectory with any number of vacancies in the supercell, with the same kinetics for each vacancy as
+    KMC_JIT.getTraj. The rates of all the vacancy jumps are kept in a sum tree (see SumTree), with event index
+    vacInd * z + jmp. After each jump, only the vacancies whose rates depend on the two sites that were swapped (see
+    makeRateAffectSites) get their rates recomputed.
+    :param KMC_jit: KMC_JIT object to use the interaction data from.
+    :param state: the starting state (the vacancies have species index NSpec-1) - modified in place.
+    :param offsc: the off site counts of the starting state - modified in place.
+    :param vacSiteFix: the site the jumps in jumpFinSiteList start from.
+    :param tracker: optional Tracer.TracerTracker to record the displacements of the individual atoms in.
+    :return: X_steps - (Nsteps x NSpec x 3) the total displacement of each species (the vacancy row is summed over
+             all the vacancies) at each step.
+             t_steps - (Nsteps-size array) the time at each step.
+             eventSteps - (Nsteps-size array) the event selected at each step (vacInd * z + jmp). If all the rates
+             become zero, the trajectory stops: the remaining steps get event -1 and time inf.
+             vacSites - the sites of the vacancies at the end, in the order they are indexed in the events.
+    """
+    z = jumpFinSiteList.shape[0]
+    affectSites = makeRateAffectSites(KMC_jit, vacSiteFix, jumpFinSiteList)
+
+    vacSites = np.where(state == NSpec - 1)[0]
+    Nvac = vacSites.shape[0]
+    vacIndOfSite = np.full(state.shape[0], -1, dtype=int64)
+    for vacInd in range(Nvac):
+        vacIndOfSite[vacSites[vacInd]] = vacInd
+
+    finSites = np.zeros((Nvac, z), dtype=int64)
+    vacRates = np.zeros(z)
+    rates = np.zeros(Nvac * z)
+    for vacInd in range(Nvac):
+        getVacancyRates(KMC_jit, state, offsc, vacSites[vacInd], vacSiteFix, jumpFinSiteList, NSpec, beta,
+                        finSites[vacInd], vacRates)
+        rates[vacInd * z: (vacInd + 1) * z] = vacRates
+    tree = SumTree.makeSumTree(rates)
+
+    # the step at which each vacancy was last marked for an update
+    lastMarked = np.full(Nvac, -1, dtype=int64)
+    toUpdate = np.zeros(Nvac, dtype=int64)
+
+    X = np.zeros((NSpec, 3), dtype=float64)
+    t = 0.
+    X_steps = np.zeros((Nsteps, NSpec, 3), dtype=float64)
+    t_steps = np.zeros(Nsteps, dtype=float64)
+    eventSteps = np.zeros(Nsteps, dtype=int64)
+
+    for step in range(Nsteps):
+        rateTot = SumTree.sumTreeTotal(tree)
+        if rateTot < 1e-8:
+            # every vacancy is blocked - nothing will move and time will be infinite, so stop here and mark the
+            # remaining steps with no event.
+            X_steps[step:, :, :] = X
+            t_steps[step:] = np.inf
+            eventSteps[step:] = -1
+            break
+        t += 1.0/rateTot
+
+        event = SumTree.sumTreeSelect(tree, np.random.rand() * rateTot)
+        eventSteps[step] = event
+        vacInd = event // z
+        jmpSelect = event % z
+
+        siteA = vacSites[vacInd]
+        siteB = finSites[vacInd, jmpSelect]
+        specB = state[siteB]
+        X[NSpec - 1, :] += dxList[jmpSelect]
+        X[specB, :] -= dxList[jmpSelect]
+
+        X_steps[step, :, :] = X.copy()
+        t_steps[step] = t
+
+        if tracker is not None:
+            tracker.recordExchange(siteA, siteB, dxList[jmpSelect])
+        KMC_jit.updateState(state, offsc, siteA, siteB)
+        vacSites[vacInd] = siteB
+        vacIndOfSite[siteA] = -1
+        vacIndOfSite[siteB] = vacInd
+
+        # find the vacancies whose rates depend on the swapped sites
+        Nupdate = 0
+        for changedSite in (siteA, siteB):
+            for site in affectSites:
+                Rvac = (KMC_jit.siteIndtoR[changedSite] - KMC_jit.siteIndtoR[site] + KMC_jit.siteIndtoR[vacSiteFix]) \
+                       % KMC_jit.N_unit
+                vacNbr = vacIndOfSite[KMC_jit.RtoSiteInd[Rvac[0], Rvac[1], Rvac[2]]]
+                if vacNbr != -1 and lastMarked[vacNbr] != step:
+                    lastMarked[vacNbr] = step
+                    toUpdate[Nupdate] = vacNbr
+                    Nupdate += 1
+
+        for updateInd in range(Nupdate):
+            vacNbr = toUpdate[updateInd]
+            getVacancyRates(KMC_jit, state, offsc, vacSites[vacNbr], vacSiteFix, jumpFinSiteList, NSpec, beta,
+                            finSites[vacNbr], vacRates)
+            for jmp in range(z):
+                SumTree.sumTreeUpdate(tree, vacNbr * z + jmp, vacRates[jmp])
+
+    return X_steps, t_steps, eventSteps, vacSites
+
+
+PackedStateSetSpec = [
+    ("Nsites", int64),
+    ("bitsPerSite", int64),
+    ("sitesPerWord", int64),
+    ("Nwords", int64),
+    ("table", int64[:]),
+    ("keys", uint64[:, :]),
+    ("count", int64),
+]
+
+
+@jitclass(PackedStateSetSpec)
+class PackedStateSet(object):
+    """
+    Open-addressing hash set of states, with each state packed into 64 bit words (bitsPerSite bits per site).
+    Every stored state gets an integer index, in the order in which they were inserted.
+    """
+
+    def __init__(self, Nsites, bitsPerSite, capacity):
+        """
+        :param Nsites: the number of sites in a state
+        :param bitsPerSite: the number of bits to store the species at a site in (at most 64)
+        :param capacity: the expected number of states (the set grows beyond it if needed)
+        """
+        self.Nsites = Nsites
+        self.bitsPerSite = bitsPerSite
+        self.sitesPerWord = 64 // bitsPerSite
+        self.Nwords = (Nsites + self.sitesPerWord - 1) // self.sitesPerWord
+        tableSize = 16
+        while tableSize < 2 * capacity:
+            tableSize *= 2
+        self.table = np.full(tableSize, -1, dtype=int64)
+        self.keys = np.zeros((max(capacity, 1), self.Nwords), dtype=uint64)
+        self.count = 0
+
+    def pack(self, state):
+        packed = np.zeros(self.Nwords, dtype=uint64)
+        for site in range(self.Nsites):
+            word = site // self.sitesPerWord
+            shift = uint64((site % self.sitesPerWord) * self.bitsPerSite)
+            packed[word] |= uint64(state[site]) << shift
+        return packed
+
+    def unpack(self, index):
+        """
+        :return: the state stored at the given index
+        """
+        state = np.zeros(self.Nsites, dtype=int64)
+        mask = (uint64(1) << uint64(self.bitsPerSite)) - uint64(1)
+        for site in range(self.Nsites):
+            word = site // self.sitesPerWord
+            shift = uint64((site % self.sitesPerWord) * self.bitsPerSite)
+            state[site] = int64((self.keys[index, word] >> shift) & mask)
+        return state
+
+    def hashPacked(self, packed):
+        h = uint64(self.Nwords)
+        for word in range(self.Nwords):
+            h = CounterRNG.mix64(h ^ packed[word])
+        return h
+
+    def slotOf(self, packed):
+        """
+        :return: the table slot holding the packed state, or the empty slot where it would go.
+        """
+        mask = uint64(self.table.shape[0] - 1)
+        slot = int64(self.hashPacked(packed) & mask)
+        while self.table[slot] != -1:
+            index = self.table[slot]
+            same = True
+            for word in range(self.Nwords):
+                if self.keys[index, word] != packed[word]:
+                    same = False
+                    break
+            if same:
+                break
+            slot = (slot + 1) & int64(mask)
+        return slot
+
+    def grow(self):
+        # double the table and re-insert all the stored states
+        self.table = np.full(2 * self.table.shape[0], -1, dtype=int64)
+        for index in range(self.count):
+            slot = self.slotOf(self.keys[index])
+            self.table[slot] = index
+
+    def canonicalPack(self, state, sitePerms):
+        """
+        Pack a state in its canonical form under a group of site permutations - the packed image of the state with
+        the lexicographically smallest words.
+        :param state: the state to pack
+        :param sitePerms: (Ng x Nsites) array - sitePerms[g, i] is the site that site i is taken to by operation g.
+        :return: the canonical packed state
+        """
+        best = np.zeros(self.Nwords, dtype=uint64)
+        image = np.zeros(self.Nsites, dtype=int64)
+        for g in range(sitePerms.shape[0]):
+            for site in range(self.Nsites):
+                image[sitePerms[g, site]] = state[site]
+            packed = self.pack(image)
+            if g == 0:
+                best[:] = packed
+                continue
+            for word in range(self.Nwords):
+                if packed[word] != best[word]:
+                    if packed[word] < best[word]:
+                        best[:] = packed
+                    break
+        return best
+
+    def find(self, state):
+        """
+        :return: the index of the state, or -1 if it is not in the set.
+        """
+        return self.table[self.slotOf(self.pack(state))]
+
+    def findPacked(self, packed):
+        """
+        :return: the index of an already packed state, or -1 if it is not in the set.
+        """
+        return self.table[self.slotOf(packed)]
+
+    def insert(self, state):
+        """
+        Insert a state if it is not already in the set.
+        :return: index - the index of the state
+                 isNew - whether the state was newly inserted.
+        """
+        return self.insertPacked(self.pack(state))
+
+    def insertPacked(self, packed):
+        """
+        Same as insert, but for an already packed state.
+        """
+        slot = self.slotOf(packed)
+        if self.table[slot] != -1:
+            return self.table[slot], False
+
+        if self.count == self.keys.shape[0]:
+            newKeys = np.zeros((2 * self.keys.shape[0], self.Nwords), dtype=uint64)
+            newKeys[:self.count, :] = self.keys[:self.count, :]
+            self.keys = newKeys
+
+        index = self.count
+        self.keys[index, :] = packed
+        self.table[slot] = index
+        self.count += 1
+
+        # keep the load factor below a half
+        if 2 * self.count > self.table.shape[0]:
+            self.grow()
+        return index, True
+
+
+@jit(nopython=True)
+def popCount64(x):
+    """
+    :return: the number of set bits in a uint64 value.
+    """
+    x = x - ((x >> uint64(1)) & uint64(0x5555555555555555))
+    x = (x & uint64(0x3333333333333333)) + ((x >> uint64(2)) & uint64(0x3333333333333333))
+    x = (x + (x >> uint64(4))) & uint64(0x0f0f0f0f0f0f0f0f)
+    return int64((x * uint64(0x0101010101010101)) >> uint64(56))
+
+
+OccupancyBitsSpec = [
+    ("Nsites", int64),
+    ("Nspecs", int64),
+    ("Nwords", int64),
+    ("numMasks", int64[:]),
+    ("MaskSpecs", int64[:, :]),
+    ("MaskWords", int64[:, :]),
+    ("MaskBits", uint64[:, :]),
+]
+
+
+@jitclass(OccupancyBitsSpec)
+class OccupancyBits(object):
+    """
+    Evaluation of interactions on bitset occupancies. The occupancy of a state is stored as one bitset per species
+    ((Nspecs x Nwords) uint64 array, bit i of row s set if site i has species s), and every interaction as the bitmasks
+    of the sites it requires each species on, grouped by (species, word). An interaction is on if all of its masks
+    are contained in the occupancy, and its off site count is the number of masked bits missing from it - so that
+    evaluating an interaction takes a few AND and popcount operations instead of a loop over its sites.
+    Make one object with the site interactions and one with the TS interactions (see makeOccupancyBits), and pass
+    them to KMC_JIT.GetOffSite, GetTSOffSite, getEnergy, hashState or makeShells to evaluate states through them.
+    """
+
+    def __init__(self, numSitesInteracts, SupSitesInteracts, SpecOnInteractSites, Nsites, Nspecs):
+        """
+        :param numSitesInteracts, SupSitesInteracts, SpecOnInteractSites: the interaction arrays (or the TS interaction
+        arrays numSitesTSInteracts, TSInteractSites, TSInteractSpecs).
+        :param Nsites: the number of sites in the supercell.
+        :param Nspecs: the number of species (including the vacancy).
+        """
+        self.Nsites = Nsites
+        self.Nspecs = Nspecs
+        self.Nwords = (Nsites + 63) // 64
+        Ninteracts = numSitesInteracts.shape[0]
+        maxOrder = max(1, SupSitesInteracts.shape[1])
+        self.numMasks = np.zeros(Ninteracts, dtype=int64)
+        self.MaskSpecs = np.full((Ninteracts, maxOrder), -1, dtype=int64)
+        self.MaskWords = np.full((Ninteracts, maxOrder), -1, dtype=int64)
+        self.MaskBits = np.zeros((Ninteracts, maxOrder), dtype=uint64)
+        for interactIdx in range(Ninteracts):
+            for intSiteind in range(numSitesInteracts[interactIdx]):
+                site = SupSitesInteracts[interactIdx, intSiteind]
+                spec = SpecOnInteractSites[interactIdx, intSiteind]
+                word = site // 64
+                # merge with an existing mask of the same species and word
+                m = 0
+                while m < self.numMasks[interactIdx]:
+                    if self.MaskSpecs[interactIdx, m] == spec and self.MaskWords[interactIdx, m] == word:
+                        break
+                    m += 1
+                if m == self.numMasks[interactIdx]:
+                    self.MaskSpecs[interactIdx, m] = spec
+                    self.MaskWords[interactIdx, m] = word
+                    self.numMasks[interactIdx] += 1
+                self.MaskBits[interactIdx, m] |= uint64(1) << uint64(site % 64)
+
+    def makeOccupancy(self, state):
+        """
+        :return: (Nspecs x Nwords) the bitset occupancy of a state.
+        """
+        occ = np.zeros((self.Nspecs, self.Nwords), dtype=uint64)
+        for site in range(self.Nsites):
+            occ[state[site], site // 64] |= uint64(1) << uint64(site % 64)
+        return occ
+
+    def swapOccupancy(self, occ, siteA, siteB, specA, specB):
+        """
+        Swap the species specA at siteA and specB at siteB in an occupancy.
+        """
+        bitA = uint64(1) << uint64(siteA % 64)
+        bitB = uint64(1) << uint64(siteB % 64)
+        occ[specA, siteA // 64] ^= bitA
+        occ[specB, siteA // 64] ^= bitA
+        occ[specB, siteB // 64] ^= bitB
+        occ[specA, siteB // 64] ^= bitB
+
+    def isOn(self, occ, interactIdx):
+        for m in range(self.numMasks[interactIdx]):
+            mask = self.MaskBits[interactIdx, m]
+            if occ[self.MaskSpecs[interactIdx, m], self.MaskWords[interactIdx, m]] & mask != mask:
+                return False
+        return True
+
+    def requires(self, interactIdx, site, spec):
+        """
+        :return: whether the interaction requires species spec at site.
+        """
+        bit = uint64(1) << uint64(site % 64)
+        for m in range(self.numMasks[interactIdx]):
+            if self.MaskSpecs[interactIdx, m] == spec and self.MaskWords[interactIdx, m] == site // 64:
+                return self.MaskBits[interactIdx, m] & bit != uint64(0)
+        return False
+
+    def GetOffSite(self, occ):
+        """
+        :return: OffSiteCount array (N_interaction x 1) - same as KMC_JIT.GetOffSite (or GetTSOffSite).
+        """
+        OffSiteCount = np.zeros(self.numMasks.shape[0], dtype=int64)
+        for interactIdx in range(self.numMasks.shape[0]):
+            for m in range(self.numMasks[interactIdx]):
+                OffSiteCount[interactIdx] += popCount64(self.MaskBits[interactIdx, m] &
+                                                        ~occ[self.MaskSpecs[interactIdx, m],
+                                                             self.MaskWords[interactIdx, m]])
+        return OffSiteCount
+
+    def getEnergy(self, occ, Interaction2En):
+        """
+        :return: the total energy of the interactions that are on in an occupancy.
+        """
+        En = 0.
+        for interactIdx in range(self.numMasks.shape[0]):
+            if self.isOn(occ, interactIdx):
+                En += Interaction2En[interactIdx]
+        return En
+
+    def getSwapEnergyChange(self, occ, siteA, siteB, numInteractsSiteSpec, SiteSpecInterArray, Interaction2En):
+        """
+        Energy change of swapping the species at siteA and siteB, from the interactions that contain either site
+        (numInteractsSiteSpec and SiteSpecInterArray as in MCSamplerClass). The occupancy is left unchanged.
+        """
+        specA = -1
+        specB = -1
+        for spec in range(self.Nspecs):
+            if occ[spec, siteA // 64] & (uint64(1) << uint64(siteA % 64)) != uint64(0):
+                specA = spec
+            if occ[spec, siteB // 64] & (uint64(1) << uint64(siteB % 64)) != uint64(0):
+                specB = spec
+        if specA == specB:
+            return 0.
+
+        # interactions that can be on before the swap
+        delE = 0.
+        for i in range(numInteractsSiteSpec[siteA, specA]):
+            interactIdx = SiteSpecInterArray[siteA, specA, i]
+            if self.isOn(occ, interactIdx):
+                delE -= Interaction2En[interactIdx]
+        for i in range(numInteractsSiteSpec[siteB, specB]):
+            interactIdx = SiteSpecInterArray[siteB, specB, i]
+            # those that also contain siteA were counted above
+            if not self.requires(interactIdx, siteA, specA) and self.isOn(occ, interactIdx):
+                delE -= Interaction2En[interactIdx]
+
+        # and after it
+        self.swapOccupancy(occ, siteA, siteB, specA, specB)
+        for i in range(numInteractsSiteSpec[siteA, specB]):
+            interactIdx = SiteSpecInterArray[siteA, specB, i]
+            if self.isOn(occ, interactIdx):
+                delE += Interaction2En[interactIdx]
+        for i in range(numInteractsSiteSpec[siteB, specA]):
+            interactIdx = SiteSpecInterArray[siteB, specA, i]
+            if not self.requires(interactIdx, siteA, specB) and self.isOn(occ, interactIdx):
+                delE += Interaction2En[interactIdx]
+        self.swapOccupancy(occ, siteA, siteB, specB, specA)
+        return delE
+
+    def hashOccupancy(self, occ):
+        """
+        :return: uint64 hash of an occupancy - equal for equal states.
+        """
+        h = uint64(self.Nwords)
+        for spec in range(self.Nspecs - 1):  # the last species is fixed by the others
+            for word in range(self.Nwords):
+                h = CounterRNG.mix64(h ^ occ[spec, word])
+        return h
+
+
+def makeOccupancyBits(MC_jit):
+    """
+    :param MC_jit: MCSamplerClass (or KMC_JIT) object.
+    :return: occBits, TSoccBits - OccupancyBits objects of the site and of the TS interactions of MC_jit, to pass to
+    KMC_JIT.GetOffSite, GetTSOffSite, getEnergy, hashState and makeShells.
+    """
+    occBits = OccupancyBits(MC_jit.numSitesInteracts, MC_jit.SupSitesInteracts, MC_jit.SpecOnInteractSites,
+                            MC_jit.Nsites, MC_jit.Nspecs)
+    TSoccBits = OccupancyBits(MC_jit.numSitesTSInteracts, MC_jit.TSInteractSites, MC_jit.TSInteractSpecs,
+                              MC_jit.Nsites, MC_jit.Nspecs)
+    return occBits, TSoccBits
+
+
+@jit(nopython=True)
+def makeShellsJit(KMC_jit, state0, ijList, dxList, beta, vacSiteInd, Nshells, sitePerms):
+    """
+    Compiled breadth-first version of makeShells.
+    States are stored translated so that the vacancy is at vacSiteInd, and reduced to a canonical form under the
+    site permutations in sitePerms, packed with ceil(log2(Nspecs)) bits per site in a PackedStateSet. To get the exits
+    out of a state, the state and its off site counts are rebuilt from those of state0 by replaying the jumps along
+    the path through which the state was first reached, so that off site counts are only ever updated incrementally.
+    :param KMC_jit: KMC_JIT object to get the energies and state translations from.
+    :param state0: The starting state, with the vacancy at vacSiteInd.
+    :param ijList: final sites of the vacancy jumps out of vacSiteInd.
+    :param dxList: displacements of the vacancy jumps.
+    :param Nshells: the number of shells to build - states reached in fewer than Nshells jumps have their exits
+    computed, the states in the last shell are kept without exits.
+    :param sitePerms: (Ng x Nsites) site permutations of the point group operations that leave vacSiteInd unchanged
+    (see Cluster_Expansion.VectorClusterExpansion.makeVacSitePerms). States related by these operations are
+    stored once. Pass only the identity permutation to keep all states distinct. With more than one operation, the
+    jump indices and velocities of a state refer to the image of it that was reached from state0 (the one that
+    the jumps along its path lead to), which may be a rotation of its canonical (stored) form.
+    :return: stateSet - PackedStateSet containing the (canonical) states, indexed in the order they were found
+             (state0 is 0).
+             depth - (Nstates-size array) the shell that each state belongs to.
+             indptr, colInds, rates, jumpInds - the transition rate matrix in CSR form. Row "i" holds the escape
+             rate out of state "i" as a negative diagonal entry (jump index -1), followed by one entry for every
+             jump out of it (duplicate columns are to be summed).
+             velocities - (Nstates x 3) the rate weighted sum of jump vectors out of each state (zero for the
+             states in the last shell).
+             energies - (Nstates-size array) the energy of each state relative to state0.
+    """
+    Nsites = state0.shape[0]
+    Njumps = ijList.shape[0]
+
+    bitsPerSite = 1
+    while (1 << bitsPerSite) < KMC_jit.Nspecs:
+        bitsPerSite += 1
+
+    stateSet = PackedStateSet(Nsites, bitsPerSite, 1024)
+    depth = np.zeros(1024, dtype=int64)
+    parentInd = np.full(1024, -1, dtype=int64)
+    parentJump = np.full(1024, -1, dtype=int64)
+
+    capEdges = 1024 * (Njumps + 1)
+    rowInds = np.zeros(capEdges, dtype=int64)
+    colInds = np.zeros(capEdges, dtype=int64)
+    rates = np.zeros(capEdges, dtype=float64)
+    jumpInds = np.zeros(capEdges, dtype=int64)
+    Nedges = 0
+
+    stateSet.insertPacked(stateSet.canonicalPack(state0, sitePerms))
+
+    state = state0.copy()
+    offsc = KMC_jit.GetOffSite(state)
+
+    pathJumps = np.zeros(Nshells + 1, dtype=int64)
+    pathSites = np.zeros((Nshells + 1, 2), dtype=int64)
+    jumpFinSiteListTrans = np.zeros(Njumps, dtype=int64)
+
+    velocities = np.zeros((1024, 3))
+    energies = np.zeros(1024)
+
+    stateInd = 0
+    while stateInd < stateSet.count:
+        if depth[stateInd] >= Nshells:
+            stateInd += 1
+            continue
+
+        # Get the path of jumps to this state
+        pathLen = depth[stateInd]
+        ind = stateInd
+        for d in range(pathLen - 1, -1, -1):
+            pathJumps[d] = parentJump[ind]
+            ind = parentInd[ind]
+
+        # replay the path to rebuild the state (untranslated) and its off site counts
+        vacNow = vacSiteInd
+        for d in range(pathLen):
+            dR = KMC_jit.siteIndtoR[vacNow] - KMC_jit.siteIndtoR[vacSiteInd]
+            Rfin = (dR + KMC_jit.siteIndtoR[ijList[pathJumps[d]]]) % KMC_jit.N_unit
+            finSite = KMC_jit.RtoSiteInd[Rfin[0], Rfin[1], Rfin[2]]
+            KMC_jit.updateState(state, offsc, vacNow, finSite)
+            pathSites[d, 0] = vacNow
+            pathSites[d, 1] = finSite
+            vacNow = finSite
+
+        # Get the exit rates
+        stateTrans = KMC_jit.TranslateState(state, vacSiteInd, vacNow)
+        TSoffsc = KMC_jit.GetTSOffSite(stateTrans)
+        delEKRA = KMC_jit.getKRAEnergies(stateTrans, TSoffsc, ijList)
+
+        dR = KMC_jit.siteIndtoR[vacNow] - KMC_jit.siteIndtoR[vacSiteInd]
+        for jmp in range(Njumps):
+            Rfin = (dR + KMC_jit.siteIndtoR[ijList[jmp]]) % KMC_jit.N_unit
+            jumpFinSiteListTrans[jmp] = KMC_jit.RtoSiteInd[Rfin[0], Rfin[1], Rfin[2]]
+
+        delE = KMC_jit.getEnergyChangeJumps(state, offsc, vacNow, jumpFinSiteListTrans)
+        rateList = np.exp(-(0.5 * delE + delEKRA) * beta)
+
+        # make room for the edges out of this state
+        if Nedges + Njumps + 1 > rowInds.shape[0]:
+            newCap = 2 * rowInds.shape[0]
+            newRows = np.zeros(newCap, dtype=int64)
+            newCols = np.zeros(newCap, dtype=int64)
+            newRates = np.zeros(newCap, dtype=float64)
+            newJumps = np.zeros(newCap, dtype=int64)
+            newRows[:Nedges] = rowInds[:Nedges]
+            newCols[:Nedges] = colInds[:Nedges]
+            newRates[:Nedges] = rates[:Nedges]
+            newJumps[:Nedges] = jumpInds[:Nedges]
+            rowInds, colInds, rates, jumpInds = newRows, newCols, newRates, newJumps
+
+        rowInds[Nedges] = stateInd
+        colInds[Nedges] = stateInd
+        rates[Nedges] = -np.sum(rateList)
+        jumpInds[Nedges] = -1
+        Nedges += 1
+
+        for jmp in range(Njumps):
+            # exit state with the vacancy brought back to vacSiteInd
+            exitState = stateTrans.copy()
+            exitState[vacSiteInd] = stateTrans[ijList[jmp]]
+            exitState[ijList[jmp]] = stateTrans[vacSiteInd]
+            exitOrig = KMC_jit.TranslateState(exitState, vacSiteInd, ijList[jmp])
+
+            exitInd, isNew = stateSet.insertPacked(stateSet.canonicalPack(exitOrig, sitePerms))
+            if isNew:
+                if exitInd == depth.shape[0]:
+                    newLen = 2 * depth.shape[0]
+                    newDepth = np.zeros(newLen, dtype=int64)
+                    newParent = np.full(newLen, -1, dtype=int64)
+                    newParentJump = np.full(newLen, -1, dtype=int64)
+                    newVels = np.zeros((newLen, 3))
+                    newEnergies = np.zeros(newLen)
+                    newDepth[:exitInd] = depth[:exitInd]
+                    newParent[:exitInd] = parentInd[:exitInd]
+                    newParentJump[:exitInd] = parentJump[:exitInd]
+                    newVels[:exitInd, :] = velocities[:exitInd, :]
+                    newEnergies[:exitInd] = energies[:exitInd]
+                    depth, parentInd, parentJump, velocities = newDepth, newParent, newParentJump, newVels
+                    energies = newEnergies
+                depth[exitInd] = depth[stateInd] + 1
+                parentInd[exitInd] = stateInd
+                parentJump[exitInd] = jmp
+                energies[exitInd] = energies[stateInd] + delE[jmp]
+
+            rowInds[Nedges] = stateInd
+            colInds[Nedges] = exitInd
+            rates[Nedges] = rateList[jmp]
+            jumpInds[Nedges] = jmp
+            Nedges += 1
+
+            velocities[stateInd, :] += rateList[jmp] * dxList[jmp]
+
+        # undo the path to get back state0 and its off site counts
+        for d in range(pathLen - 1, -1, -1):
+            KMC_jit.updateState(state, offsc, pathSites[d, 0], pathSites[d, 1])
+
+        stateInd += 1
+
+    Nstates = stateSet.count
+    # rows are filled in order, so the CSR row pointers are just the cumulative counts
+    indptr = np.zeros(Nstates + 1, dtype=int64)
+    for edge in range(Nedges):
+        indptr[rowInds[edge] + 1] += 1
+    for i in range(Nstates):
+        indptr[i + 1] += indptr[i]
+
+    return stateSet, depth[:Nstates].copy(), indptr, colInds[:Nedges].copy(), rates[:Nedges].copy(), \
+           jumpInds[:Nedges].copy(), velocities[:Nstates].copy(), energies[:Nstates].copy()
+
+
+@jit(nopython=True)
+def solveBasinExit(Nbasin, edgeRates, edgeTargets, root):
+    """
+    Function to get the exit statistics of a superbasin, treated as an absorbing Markov chain.
+    :param Nbasin: the number of (transient) states in the basin.
+    :param edgeRates: (Nbasin x z) rates of the jumps out of the basin states.
+    :param edgeTargets: (Nbasin x z) the basin state each jump leads to, or -1 if the jump leaves the basin.
+    :param root: the basin state the vacancy starts from.
+    :return: exitProbs - (Nbasin x z) the probability that the basin is left through each jump (zero for the
+             jumps within the basin).
+             residence - (Nbasin-size array) the mean time spent in each basin state before leaving.
+    """
+    # A = diag(escape rates) - (rates between basin states); the residence times solve A^T tau = e_root
+    A = np.zeros((Nbasin, Nbasin))
+    for i in range(Nbasin):
+        for jmp in range(edgeRates.shape[1]):
+            A[i, i] += edgeRates[i, jmp]
+            target = edgeTargets[i, jmp]
+            if target >= 0:
+                A[i, target] -= edgeRates[i, jmp]
+    rhs = np.zeros(Nbasin)
+    rhs[root] = 1.
+    residence = np.linalg.solve(A.T.copy(), rhs)
+
+    exitProbs = np.zeros((Nbasin, edgeRates.shape[1]))
+    for i in range(Nbasin):
+        for jmp in range(edgeRates.shape[1]):
+            if edgeTargets[i, jmp] < 0:
+                exitProbs[i, jmp] = residence[i] * edgeRates[i, jmp]
+    return exitProbs, residence
+
+
+@jit(nopython=True)
+def buildSuperbasin(KMC_jit, state, offsc, vacSite, vacSiteFix, jumpFinSiteList, dxList, NSpec, beta, fastRate,
+                    maxBasinStates):
+    """
+    Function to find the superbasin around a state - the states connected to it by jumps with rates of at least
+    fastRate - with a breadth first search, up to maxBasinStates states.
+    The basin states are held in a PackedStateSet, and rebuilt when needed by replaying the swaps along the path
+    they were first reached by, so that the off site counts are only updated incrementally.
+    :param state, offsc: the current state and its off site counts - restored on exit.
+    :param vacSite: the site of the vacancy in the current state.
+    :return: Nbasin - the number of states in the basin (the current state is 0).
+             parentInd, parentSwaps - the basin state each state was first reached from, and the (vacancy, final)
+             sites of the swap that reached it.
+             basinX - (Nbasin x NSpec x 3) displacements of the species in each state relative to the current state.
+             edgeRates, edgeTargets, edgeFinSites - (Nbasin x z) the rates of the jumps out of each basin state, the
+             basin state they lead to (-1 if the jump is slow, or leads out of the basin) and their final sites.
+    """
+    Nsites = state.shape[0]
+    z = jumpFinSiteList.shape[0]
+    bitsPerSite = 1
+    while (1 << bitsPerSite) < KMC_jit.Nspecs:
+        bitsPerSite += 1
+
+    basinSet = PackedStateSet(Nsites, bitsPerSite, maxBasinStates)
+    basinSet.insert(state)
+    parentInd = np.full(maxBasinStates, -1, dtype=int64)
+    parentSwaps = np.zeros((maxBasinStates, 2), dtype=int64)
+    depth = np.zeros(maxBasinStates, dtype=int64)
+    basinVacSites = np.zeros(maxBasinStates, dtype=int64)
+    basinVacSites[0] = vacSite
+    basinX = np.zeros((maxBasinStates, NSpec, 3))
+    edgeRates = np.zeros((maxBasinStates, z))
+    edgeTargets = np.full((maxBasinStates, z), -1, dtype=int64)
+    edgeFinSites = np.zeros((maxBasinStates, z), dtype=int64)
+    pathSites = np.zeros((maxBasinStates, 2), dtype=int64)
+
+    basinInd = 0
+    while basinInd < basinSet.count:
+        # replay the path to this basin state
+        pathLen = depth[basinInd]
+        ind = basinInd
+        for d in range(pathLen - 1, -1, -1):
+            pathSites[d, :] = parentSwaps[ind]
+            ind = parentInd[ind]
+        for d in range(pathLen):
+            KMC_jit.updateState(state, offsc, pathSites[d, 0], pathSites[d, 1])
+
+        vacNow = basinVacSites[basinInd]
+        getVacancyRates(KMC_jit, state, offsc, vacNow, vacSiteFix, jumpFinSiteList, NSpec, beta,
+                        edgeFinSites[basinInd], edgeRates[basinInd])
+
+        for jmp in range(z):
+            if edgeRates[basinInd, jmp] < fastRate:
+                continue
+            siteB = edgeFinSites[basinInd, jmp]
+            specB = state[siteB]
+            # pack the state after the jump
+            state[vacNow] = specB
+            state[siteB] = NSpec - 1
+            packed = basinSet.pack(state)
+            state[siteB] = specB
+            state[vacNow] = NSpec - 1
+
+            target = basinSet.findPacked(packed)
+            if target == -1 and basinSet.count < maxBasinStates:
+                target, isNew = basinSet.insertPacked(packed)
+                parentInd[target] = basinInd
+                parentSwaps[target, 0] = vacNow
+                parentSwaps[target, 1] = siteB
+                depth[target] = depth[basinInd] + 1
+                basinVacSites[target] = siteB
+                basinX[target] = basinX[basinInd]
+                basinX[target, NSpec - 1, :] += dxList[jmp]
+                basinX[target, specB, :] -= dxList[jmp]
+            edgeTargets[basinInd, jmp] = target
+
+        # undo the path
+        for d in range(pathLen - 1, -1, -1):
+            KMC_jit.updateState(state, offsc, pathSites[d, 0], pathSites[d, 1])
+
+        basinInd += 1
+
+    Nbasin = basinSet.count
+    return Nbasin, parentInd[:Nbasin], parentSwaps[:Nbasin], basinX[:Nbasin], edgeRates[:Nbasin], \
+           edgeTargets[:Nbasin], edgeFinSites[:Nbasin]
+
+
+@jit(nopython=True)
+def getTrajSuperbasin(KMC_jit, state, offsc, vacSiteFix, jumpFinSiteList, dxList, NSpec, Nsteps, beta, fastRate,
+                      maxBasinStates, Nrevisit, historyLen):
+    """
+    Run a KMC trajectory (same kinetics as KMC_JIT.getTraj) with superbasin acceleration.
+    The states visited in the last historyLen steps are hashed, and when the current state has been visited
+    Nrevisit times, the superbasin of states connected to it by jumps with rates of at least fastRate is built (see
+    buildSuperbasin). The vacancy then leaves the basin in a single step, with the exit jump sampled from the
+    exact exit probabilities of the basin as an absorbing Markov chain, and the time advanced by the mean time
+    spent in the basin before leaving it (in keeping with the mean residence times of the regular steps).
+    :param fastRate: jumps with rates at least this large are treated as internal to a basin.
+    :param maxBasinStates: the largest number of states in a basin.
+    :param Nrevisit: the number of visits to a state that triggers a basin escape.
+    :param historyLen: the number of steps after which the visit history is cleared.
+    The rest of the parameters are the same as in KMC_JIT.getTraj.
+    :return: X_steps - (Nsteps x NSpec x 3) displacements of each species at each step.
+             t_steps - (Nsteps-size array) time at each step. At a basin escape, the time is advanced by the mean
+             absorption time of the basin, which is not sampled and does not depend on the exit taken - so that the
+             total time (and the transport coefficients averaged over it) is right, but t_steps is not a KMC time
+             series on the scale of the basin escape times. Use getTraj for displacements as a function of time
+             (e.g, the mean squared displacement against time) on those scales.
+             basinSizes - (Nsteps-size array) the number of states in the basin left at each step (0 for regular
+             steps).
+    """
+    Nsites = state.shape[0]
+    z = jumpFinSiteList.shape[0]
+    bitsPerSite = 1
+    while (1 << bitsPerSite) < KMC_jit.Nspecs:
+        bitsPerSite += 1
+
+    X = np.zeros((NSpec, 3), dtype=float64)
+    t = 0.
+    X_steps = np.zeros((Nsteps, NSpec, 3), dtype=float64)
+    t_steps = np.zeros(Nsteps, dtype=float64)
+    basinSizes = np.zeros(Nsteps, dtype=int64)
+
+    finSites = np.zeros(z, dtype=int64)
+    rates = np.zeros(z)
+    vacIndNow = vacSiteFix
+
+    visited = PackedStateSet(Nsites, bitsPerSite, 64)
+    visitCounts = np.zeros(64, dtype=int64)
+    historyStart = 0
+
+    for step in range(Nsteps):
+        if step - historyStart >= historyLen:
+            visited = PackedStateSet(Nsites, bitsPerSite, 64)
+            historyStart = step
+
+        visitInd, isNew = visited.insert(state)
+        if isNew:
+            if visitInd >= visitCounts.shape[0]:
+                newCounts = np.zeros(2 * visitCounts.shape[0], dtype=int64)
+                newCounts[:visitCounts.shape[0]] = visitCounts
+                visitCounts = newCounts
+            visitCounts[visitInd] = 0
+        visitCounts[visitInd] += 1
+
+        if visitCounts[visitInd] >= Nrevisit:
+            Nbasin, parentInd, parentSwaps, basinX, edgeRates, edgeTargets, edgeFinSites = \
+                buildSuperbasin(KMC_jit, state, offsc, vacIndNow, vacSiteFix, jumpFinSiteList, dxList, NSpec, beta,
+                                fastRate, maxBasinStates)
+            exitProbs, residence = solveBasinExit(Nbasin, edgeRates, edgeTargets, 0)
+
+            # select the exit jump
+            r = np.random.rand() * np.sum(exitProbs)
+            exitEvent = 0
+            for event in range(Nbasin * z):
+                p = exitProbs[event // z, event % z]
+                if p > 0.:
+                    exitEvent = event
+                    if r < p:
+                        break
+                    r -= p
+            exitState = exitEvent // z
+            exitJump = exitEvent % z
+
+            # go to the basin state the exit is from, and make the exit jump
+            pathLen = 0
+            ind = exitState
+            while ind > 0:
+                pathLen += 1
+                ind = parentInd[ind]
+            pathSites = np.zeros((pathLen, 2), dtype=int64)
+            ind = exitState
+            for d in range(pathLen - 1, -1, -1):
+                pathSites[d, :] = parentSwaps[ind]
+                ind = parentInd[ind]
+            for d in range(pathLen):
+                KMC_jit.updateState(state, offsc, pathSites[d, 0], pathSites[d, 1])
+            vacIndNow = vacIndNow if pathLen == 0 else pathSites[pathLen - 1, 1]
+
+            vacIndNext = edgeFinSites[exitState, exitJump]
+            X += basinX[exitState]
+            X[NSpec - 1, :] += dxList[exitJump]
+            X[state[vacIndNext], :] -= dxList[exitJump]
+            t += np.sum(residence)  # the mean time to leave the basin - see the notes on t_steps above
+            basinSizes[step] = Nbasin
+
+            # start a new history after leaving the basin
+            visited = PackedStateSet(Nsites, bitsPerSite, 64)
+            historyStart = step + 1
+        else:
+            getVacancyRates(KMC_jit, state, offsc, vacIndNow, vacSiteFix, jumpFinSiteList, NSpec, beta, finSites,
+                            rates)
+            rateTot = np.sum(rates)
+            t += 1.0/rateTot
+            rates /= rateTot
+            rates_cm = np.cumsum(rates)
+            rn = np.random.rand()
+            jmpSelect = np.searchsorted(rates_cm, rn)
+
+            vacIndNext = finSites[jmpSelect]
+            X[NSpec - 1, :] += dxList[jmpSelect]
+            X[state[vacIndNext], :] -= dxList[jmpSelect]
+
+        X_steps[step, :, :] = X.copy()
+        t_steps[step] = t
+
+        KMC_jit.updateState(state, offsc, vacIndNow, vacIndNext)
+        vacIndNow = vacIndNext
+
+    return X_steps, t_steps, basinSizes
@@ -0,0 +1,1152 @@
+"""
+Array based versions of the hot loops of the MC_JIT jitclasses - MC (swap and semi-grand-canonical) sweeps, cluster
+expansion of the rates, exit data, KMC trajectories and off site counting.
+Jitclasses cannot be cached, so every method of MCSamplerClass and KMC_JIT is compiled again in every new process.
+The functions here take the interaction arrays explicitly instead of through a jitclass, and are compiled with
+cache=True, so that they are compiled once and then loaded from the numba cache (the __pycache__ directory next to
+this file, or NUMBA_CACHE_DIR) by later processes. MCSamplerClass.makeMCsweep, makeMCsweepChunk, makeSGCsweep,
+MultiSwapMC, GetNewRandState, Expand and getExitData, and KMC_JIT.getTraj, getTrajChunk and getTrajSampled (along
+with the off site counting, translation and state update methods) call these functions, so that the cached and the
+jitclass paths run the same code. Every single vacancy KMC step is taken by kmcStep and every swap trial by swapTrial.
+The jitclasses themselves (their constructors and the dispatch of their methods) are still compiled in every process,
+so a process that must reach its first MC step quickly should call these functions directly with the interaction
+arrays (e.g. as loaded with SharedTables) instead of building an MCSamplerClass or KMC_JIT. The other loops of
+MC_JIT - the multi-trajectory, multi vacancy and superbasin drivers and the shell builders - are not cached, and are
+compiled in every process.
+The kernels ending in "Trans" work with interactions stored once per cluster and resolved to supercell sites by
+translation (see Cluster_Expansion.VectorClusterExpansion.makeTransInvariantInteractionsData), so that the size of
+the interaction tables does not grow with the supercell.
+The kernels ending in "Pattern" work with interactions grouped by site cluster, with the species on the sites encoded
+as a single code that indexes an energy table (see VectorClusterExpansion.makePatternInteractionsData), so that the
+labelings of a site cluster with species are not stored separately, and a swap updates one code per site cluster
+containing the swapped sites.
+Call warmUp at the start of a process to load (or, the first time, compile and cache) all the kernels before the
+first MC step.
+"""
+import numpy as np
+from numba import jit, int64, float64
+import CounterRNG
+
+
+@jit(nopython=True, cache=True)
+def translateState(state, siteFin, siteInit, siteIndtoR, RtoSiteInd, N_unit):
+    """
+    Translate a state so that the species at siteInit is taken to siteFin (see KMC_JIT.TranslateState).
+    """
+    dR = siteIndtoR[siteFin, :] - siteIndtoR[siteInit, :]
+    stateTrans = np.zeros_like(state, dtype=int64)
+    for siteInd in range(state.shape[0]):
+        Rnew = (siteIndtoR[siteInd, :] + dR) % N_unit  # to apply PBC
+        siteIndNew = RtoSiteInd[Rnew[0], Rnew[1], Rnew[2]]
+        stateTrans[siteIndNew] = state[siteInd]
+    return stateTrans
+
+
+@jit(nopython=True, cache=True)
+def countOffSites(state, numSitesInteracts, SupSitesInteracts, SpecOnInteractSites):
+    """
+    Count the off sites of every interaction in a state. Pass the TS interaction arrays (numSitesTSInteracts,
+    TSInteractSites, TSInteractSpecs) to count the off sites of the transition state interactions.
+    :return: OffSiteCount array (N_interaction x 1)
+    """
+    OffSiteCount = np.zeros(numSitesInteracts.shape[0], dtype=int64)
+    for interactIdx in range(numSitesInteracts.shape[0]):
+        for intSiteind in range(numSitesInteracts[interactIdx]):
+            if state[SupSitesInteracts[interactIdx, intSiteind]] != SpecOnInteractSites[interactIdx, intSiteind]:
+                OffSiteCount[interactIdx] += 1
+    return OffSiteCount
+
+
+@jit(nopython=True, cache=True)
+def getKRAEnergies(state, TSOffSiteCount, ijList, FinSiteFinSpecJumpInd, numJumpPointGroups,
+                   numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng):
+    """
+    Get the KRA energies of the jumps out of a state, with the vacancy at the site the jumps are defined from.
+    """
+    delEKRA = np.zeros(ijList.shape[0], dtype=float64)
+    for jumpInd in range(ijList.shape[0]):
+        delE = 0.0
+        # Get the transition index
+        siteB, specB = ijList[jumpInd], state[ijList[jumpInd]]
+        transInd = FinSiteFinSpecJumpInd[siteB, specB]
+        # We need to go through every point group for this jump
+        for tsPtGpInd in range(numJumpPointGroups[transInd]):
+            for interactInd in range(numTSInteractsInPtGroups[transInd, tsPtGpInd]):
+                # Check if this interaction is on
+                interactMainInd = JumpInteracts[transInd, tsPtGpInd, interactInd]
+                if TSOffSiteCount[interactMainInd] == 0:
+                    delE += Jump2KRAEng[transInd, tsPtGpInd, interactInd]
+        delEKRA[jumpInd] = delE
+
+    return delEKRA
+
+
+@jit(nopython=True, cache=True)
+def getEnergyChangeJumps(state, OffSiteCount, siteA, jmpFinSiteListTrans, numInteractsSiteSpec,
+                         SiteSpecInterArray, Interaction2En):
+    """
+    Get the energy changes of swapping the species at siteA with those at each of the sites in jmpFinSiteListTrans.
+    The off site counts are restored on exit.
+    """
+    delEArray = np.zeros(jmpFinSiteListTrans.shape[0], dtype=float64)
+
+    for jmpInd in range(jmpFinSiteListTrans.shape[0]):
+        siteB = jmpFinSiteListTrans[jmpInd]
+        delE = 0.0
+        # Switch required sites off
+        for interIdx in range(numInteractsSiteSpec[siteA, state[siteA]]):
+            # check if an interaction is on
+            interMainInd = SiteSpecInterArray[siteA, state[siteA], interIdx]
+            if OffSiteCount[interMainInd] == 0:
+                delE -= Interaction2En[interMainInd]
+            OffSiteCount[interMainInd] += 1
+
+        for interIdx in range(numInteractsSiteSpec[siteB, state[siteB]]):
+            interMainInd = SiteSpecInterArray[siteB, state[siteB], interIdx]
+            if OffSiteCount[interMainInd] == 0:
+                delE -= Interaction2En[interMainInd]
+            OffSiteCount[interMainInd] += 1
+
+        # Next, switch required sites on
+        for interIdx in range(numInteractsSiteSpec[siteA, state[siteB]]):
+            interMainInd = SiteSpecInterArray[siteA, state[siteB], interIdx]
+            OffSiteCount[interMainInd] -= 1
+            if OffSiteCount[interMainInd] == 0:
+                delE += Interaction2En[interMainInd]
+
+        for interIdx in range(numInteractsSiteSpec[siteB, state[siteA]]):
+            interMainInd = SiteSpecInterArray[siteB, state[siteA], interIdx]
+            OffSiteCount[interMainInd] -= 1
+            if OffSiteCount[interMainInd] == 0:
+                delE += Interaction2En[interMainInd]
+
+        delEArray[jmpInd] = delE
+
+        # Now revert offsitecounts for next jump
+        for interIdx in range(numInteractsSiteSpec[siteA, state[siteA]]):
+            OffSiteCount[SiteSpecInterArray[siteA, state[siteA], interIdx]] -= 1
+
+        for interIdx in range(numInteractsSiteSpec[siteB, state[siteB]]):
+            OffSiteCount[SiteSpecInterArray[siteB, state[siteB], interIdx]] -= 1
+
+        # During switch-on operations, offsite counts were decreased by one.
+        # So increase them back by one
+        for interIdx in range(numInteractsSiteSpec[siteA, state[siteB]]):
+            OffSiteCount[SiteSpecInterArray[siteA, state[siteB], interIdx]] += 1
+
+        for interIdx in range(numInteractsSiteSpec[siteB, state[siteA]]):
+            OffSiteCount[SiteSpecInterArray[siteB, state[siteA], interIdx]] += 1
+
+    return delEArray
+
+
+@jit(nopython=True, cache=True)
+def updateState(state, OffSiteCount, siteA, siteB, numInteractsSiteSpec, SiteSpecInterArray):
+    """
+    Swap the species at siteA and siteB, and update the off site counts accordingly.
+    """
+    # update offsitecounts
+    for interIdx in range(numInteractsSiteSpec[siteA, state[siteA]]):
+        interMainInd = SiteSpecInterArray[siteA, state[siteA], interIdx]
+        OffSiteCount[interMainInd] += 1
+
+    for interIdx in range(numInteractsSiteSpec[siteB, state[siteB]]):
+        interMainInd = SiteSpecInterArray[siteB, state[siteB], interIdx]
+        OffSiteCount[interMainInd] += 1
+
+    # Next, switch required sites on
+    for interIdx in range(numInteractsSiteSpec[siteA, state[siteB]]):
+        interMainInd = SiteSpecInterArray[siteA, state[siteB], interIdx]
+        OffSiteCount[interMainInd] -= 1
+
+    for interIdx in range(numInteractsSiteSpec[siteB, state[siteA]]):
+        interMainInd = SiteSpecInterArray[siteB, state[siteA], interIdx]
+        OffSiteCount[interMainInd] -= 1
+
+    # swap sites
+    temp = state[siteA]
+    state[siteA] = state[siteB]
+    state[siteB] = temp
+
+
+@jit(nopython=True, cache=True)
+def swapTrial(mobOcc, OffSiteCount, siteA, siteB, beta, randLog, numInteractsSiteSpec, SiteSpecInterArray,
+              Interaction2En, Interaction2Orbit, OrbitCounts):
+    """
+    Do a Metropolis trial of swapping the (different) species at siteA and siteB, accepted if -beta*delE > randLog.
+    If the swap is accepted, mobOcc and OffSiteCount (and OrbitCounts, if not empty - see mcSweep) are left as those
+    of the new state, otherwise they are restored.
+    :return: accepted - whether the swap was accepted.
+             delE - the energy change of the swap.
+    """
+    trackOrbits = OrbitCounts.shape[0] > 0
+    specA = mobOcc[siteA]
+    specB = mobOcc[siteB]
+
+    delE = 0.
+    # Next, switch required sites off
+    for interIdx in range(numInteractsSiteSpec[siteA, specA]):
+        # check if an interaction is on
+        interMainInd = SiteSpecInterArray[siteA, specA, interIdx]
+        if OffSiteCount[interMainInd] == 0:
+            delE -= Interaction2En[interMainInd]
+            if trackOrbits:
+                OrbitCounts[Interaction2Orbit[interMainInd]] -= 1
+        OffSiteCount[interMainInd] += 1
+
+    for interIdx in range(numInteractsSiteSpec[siteB, specB]):
+        interMainInd = SiteSpecInterArray[siteB, specB, interIdx]
+        if OffSiteCount[interMainInd] == 0:
+            delE -= Interaction2En[interMainInd]
+            if trackOrbits:
+                OrbitCounts[Interaction2Orbit[interMainInd]] -= 1
+        OffSiteCount[interMainInd] += 1
+
+    # Next, switch required sites on
+    for interIdx in range(numInteractsSiteSpec[siteA, specB]):
+        interMainInd = SiteSpecInterArray[siteA, specB, interIdx]
+        OffSiteCount[interMainInd] -= 1
+        if OffSiteCount[interMainInd] == 0:
+            delE += Interaction2En[interMainInd]
+            if trackOrbits:
+                OrbitCounts[Interaction2Orbit[interMainInd]] += 1
+
+    for interIdx in range(numInteractsSiteSpec[siteB, specA]):
+        interMainInd = SiteSpecInterArray[siteB, specA, interIdx]
+        OffSiteCount[interMainInd] -= 1
+        if OffSiteCount[interMainInd] == 0:
+            delE += Interaction2En[interMainInd]
+            if trackOrbits:
+                OrbitCounts[Interaction2Orbit[interMainInd]] += 1
+
+    # do the selection test
+    if -beta*delE > randLog:
+        # swap the sites to get to the next state
+        mobOcc[siteA] = specB
+        mobOcc[siteB] = specA
+        # OffSiteCount is already updated to that of the new state.
+        return True, delE
+
+    # revert back the off site counts, because the state has not changed
+    for interIdx in range(numInteractsSiteSpec[siteA, specA]):
+        interMainInd = SiteSpecInterArray[siteA, specA, interIdx]
+        OffSiteCount[interMainInd] -= 1
+        if trackOrbits and OffSiteCount[interMainInd] == 0:
+            OrbitCounts[Interaction2Orbit[interMainInd]] += 1
+
+    for interIdx in range(numInteractsSiteSpec[siteB, specB]):
+        interMainInd = SiteSpecInterArray[siteB, specB, interIdx]
+        OffSiteCount[interMainInd] -= 1
+        if trackOrbits and OffSiteCount[interMainInd] == 0:
+            OrbitCounts[Interaction2Orbit[interMainInd]] += 1
+
+    for interIdx in range(numInteractsSiteSpec[siteA, specB]):
+        interMainInd = SiteSpecInterArray[siteA, specB, interIdx]
+        if trackOrbits and OffSiteCount[interMainInd] == 0:
+            OrbitCounts[Interaction2Orbit[interMainInd]] -= 1
+        OffSiteCount[interMainInd] += 1
+
+    for interIdx in range(numInteractsSiteSpec[siteB, specA]):
+        interMainInd = SiteSpecInterArray[siteB, specA, interIdx]
+        if trackOrbits and OffSiteCount[interMainInd] == 0:
+            OrbitCounts[Interaction2Orbit[interMainInd]] -= 1
+        OffSiteCount[interMainInd] += 1
+
+    return False, delE
+
+
+@jit(nopython=True, cache=True)
+def mcSweep(mobOcc, OffSiteCount, TransOffSiteCount, SwapTrials, beta, randarr, Nswaptrials, vacSiteInd,
+            numInteractsSiteSpec, SiteSpecInterArray, Interaction2En, numSitesTSInteracts, TSInteractSites,
+            TSInteractSpecs, Interaction2Orbit, OrbitCounts):
+    """
+    Do Nswaptrials Metropolis swap trials (see MCSamplerClass.makeMCsweep).
+    If OrbitCounts is not empty, the number of interactions of each orbit that are on (Interaction2Orbit gives the
+    orbit of each interaction) is kept up to date in it as interactions are switched on and off.
+    :return: acceptCount - the number of accepted swaps.
+             badTrials - the number of site pairs drawn that could not be swapped.
+             acceptInd - the running count of accepted swaps at each accepted trial (zero for rejected trials).
+             delEArray - the energy change of every trial.
+    """
+    acceptCount = 0
+    acceptInd = np.zeros(Nswaptrials, dtype=int64)
+    badTrials = 0
+    delEArray = np.zeros(Nswaptrials)
+
+    Nsites = len(mobOcc)
+
+    count = 0  # to keep a steady count of accepted moves
+    swapcount = 0
+    while swapcount < Nswaptrials:
+        # first select two random sites to swap - for now, let's just select naively.
+        siteA = np.random.randint(0, Nsites)
+        siteB = np.random.randint(0, Nsites)
+
+        if mobOcc[siteA] == mobOcc[siteB] or siteA == vacSiteInd or siteB == vacSiteInd:
+            badTrials += 1
+            continue
+
+        # If the move is not a bad one, then store it for testing later on
+        SwapTrials[swapcount, 0] = siteA
+        SwapTrials[swapcount, 1] = siteB
+
+        accepted, delE = swapTrial(mobOcc, OffSiteCount, siteA, siteB, beta, randarr[swapcount], numInteractsSiteSpec,
+                                   SiteSpecInterArray, Interaction2En, Interaction2Orbit, OrbitCounts)
+        delEArray[swapcount] = delE
+        if accepted:
+            acceptCount += 1
+            count += 1
+            acceptInd[swapcount] = count
+
+        swapcount += 1
+
+    # make the offsite for the transition states
+    TransOffSiteCount[:] = countOffSites(mobOcc, numSitesTSInteracts, TSInteractSites, TSInteractSpecs)
+
+    return acceptCount, badTrials, acceptInd, delEArray
+
+
+@jit(nopython=True, cache=True)
+def mcSweepStream(mobOcc, OffSiteCount, TransOffSiteCount, beta, Nswaptrials, vacSiteInd, key, drawCount,
+                  numInteractsSiteSpec, SiteSpecInterArray, Interaction2En, numSitesTSInteracts, TSInteractSites,
+                  TSInteractSpecs):
+    """
+    Do Nswaptrials Metropolis swap trials (see MCSamplerClass.makeMCsweepChunk), drawing the sites and the acceptance
+    tests from a counter-based stream (see CounterRNG), starting at the counter drawCount.
+    :return: acceptCount - the number of accepted swaps.
+             badTrials - the number of site pairs drawn that could not be swapped.
+             drawCount - the counter of the stream after the last draw.
+    """
+    acceptCount = 0
+    badTrials = 0
+    Nsites = len(mobOcc)
+    noOrbits = np.zeros(0, dtype=int64)
+
+    swapcount = 0
+    while swapcount < Nswaptrials:
+        siteA = int(CounterRNG.randUniform(key, drawCount) * Nsites)
+        siteB = int(CounterRNG.randUniform(key, drawCount + 1) * Nsites)
+        drawCount += 2
+
+        if mobOcc[siteA] == mobOcc[siteB] or siteA == vacSiteInd or siteB == vacSiteInd:
+            badTrials += 1
+            continue
+
+        # 1 - u is in (0, 1], so that the log is finite
+        randLog = np.log(1.0 - CounterRNG.randUniform(key, drawCount))
+        drawCount += 1
+
+        accepted, delE = swapTrial(mobOcc, OffSiteCount, siteA, siteB, beta, randLog, numInteractsSiteSpec,
+                                   SiteSpecInterArray, Interaction2En, noOrbits, noOrbits)
+        if accepted:
+            acceptCount += 1
+
+        swapcount += 1
+
+    # make the offsite for the transition states
+    TransOffSiteCount[:] = countOffSites(mobOcc, numSitesTSInteracts, TSInteractSites, TSInteractSpecs)
+
+    return acceptCount, badTrials, drawCount
+
+
+@jit(nopython=True, cache=True)
+def swapSites(mobOcc, OffSiteCount, siteA, siteB, numInteractsSiteSpec, SiteSpecInterArray, Interaction2En):
+    """
+    Swap the species at siteA and siteB without a selection test, and update the off site counts accordingly.
+    :return: delE - the energy change of the swap.
+    """
+    specA = mobOcc[siteA]
+    specB = mobOcc[siteB]
+
+    delE = 0.
+    # Next, switch required sites off
+    for interIdx in range(numInteractsSiteSpec[siteA, specA]):
+        # check if an interaction is on
+        interMainInd = SiteSpecInterArray[siteA, specA, interIdx]
+        if OffSiteCount[interMainInd] == 0:
+            delE -= Interaction2En[interMainInd]
+        OffSiteCount[interMainInd] += 1
+
+    for interIdx in range(numInteractsSiteSpec[siteB, specB]):
+        interMainInd = SiteSpecInterArray[siteB, specB, interIdx]
+        if OffSiteCount[interMainInd] == 0:
+            delE -= Interaction2En[interMainInd]
+        OffSiteCount[interMainInd] += 1
+
+    # Next, switch required sites on
+    for interIdx in range(numInteractsSiteSpec[siteA, specB]):
+        interMainInd = SiteSpecInterArray[siteA, specB, interIdx]
+        OffSiteCount[interMainInd] -= 1
+        if OffSiteCount[interMainInd] == 0:
+            delE += Interaction2En[interMainInd]
+
+    for interIdx in range(numInteractsSiteSpec[siteB, specA]):
+        interMainInd = SiteSpecInterArray[siteB, specA, interIdx]
+        OffSiteCount[interMainInd] -= 1
+        if OffSiteCount[interMainInd] == 0:
+            delE += Interaction2En[interMainInd]
+
+    mobOcc[siteA] = specB
+    mobOcc[siteB] = specA
+    return delE
+
+
+@jit(nopython=True, cache=True)
+def multiSwapMC(mobOcc, OffSiteCount, TransOffSiteCount, SwapTrials, Nswaptrials, beta, randlog, vacSiteInd,
+                numInteractsSiteSpec, SiteSpecInterArray, Interaction2En, numSitesTSInteracts, TSInteractSites,
+                TSInteractSpecs):
+    """
+    Make Nswaptrials random swaps, and accept or reject all of them together with a single Metropolis test on the
+    total energy change (see MCSamplerClass.MultiSwapMC).
+    :return: EnChange - the total energy change of the swaps.
+    """
+    Nsites = len(mobOcc)
+    EnChange = 0.
+    swapcount = 0
+
+    while swapcount < Nswaptrials:
+        # first select two random sites to swap - for now, let's just select naively.
+        siteA = np.random.randint(0, Nsites)
+        siteB = np.random.randint(0, Nsites)
+
+        if mobOcc[siteA] == mobOcc[siteB] or siteA == vacSiteInd or siteB == vacSiteInd:
+            continue
+
+        SwapTrials[swapcount, 0] = siteA
+        SwapTrials[swapcount, 1] = siteB
+
+        # swap the sites to get to the next state, and add the energy to get the energy of the next state
+        EnChange += swapSites(mobOcc, OffSiteCount, siteA, siteB, numInteractsSiteSpec, SiteSpecInterArray,
+                              Interaction2En)
+        swapcount += 1
+
+    # Do the Metropolis test
+    if -beta*EnChange < randlog:  # Then the whole thing needs to be reverted
+        # We need to reverse everything in the exact opposite sequence of how it was produced
+        for i in range(Nswaptrials-1, -1, -1):
+            updateState(mobOcc, OffSiteCount, SwapTrials[i, 0], SwapTrials[i, 1], numInteractsSiteSpec,
+                        SiteSpecInterArray)
+
+    # once the final state is decided, compute the TS energies.
+    TransOffSiteCount[:] = countOffSites(mobOcc, numSitesTSInteracts, TSInteractSites, TSInteractSpecs)
+
+    return EnChange
+
+
+@jit(nopython=True, cache=True)
+def newRandState(mobOcc, OffSiteCount, Energy, SwapTrials, Nswaptrials, numInteractsSiteSpec, SiteSpecInterArray,
+                 Interaction2En):
+    """
+    Apply the swaps in SwapTrials one after the other without selection tests (see MCSamplerClass.GetNewRandState).
+    :return: the energy of the final state.
+    """
+    En = Energy
+    for swapcount in range(Nswaptrials):
+        En += swapSites(mobOcc, OffSiteCount, SwapTrials[swapcount, 0], SwapTrials[swapcount, 1],
+                        numInteractsSiteSpec, SiteSpecInterArray, Interaction2En)
+    return En
+
+
+@jit(nopython=True, cache=True)
+def sgcSweep(mobOcc, OffSiteCount, TransOffSiteCount, FlipTrials, beta, mu, randarr, Nfliptrials, vacSiteInd,
+             numInteractsSiteSpec, SiteSpecInterArray, Interaction2En, numSitesTSInteracts, TSInteractSites,
+             TSInteractSpecs, specCounts, compSum):
+    """
+    Do Nfliptrials semi-grand-canonical trials (see MCSamplerClass.makeSGCsweep) - each trial changes the species at
+    one random site (other than the vacancy site) to another random non-vacancy species, and is accepted with the
+    Metropolis criterion on delE - (mu[specNew] - mu[specOld]).
+    :param specCounts: (Nspec) the number of sites with each species - updated in place.
+    :param compSum: (Nspec) the species counts after every trial are added to it, so that compSum/Nfliptrials is the
+    average composition over the sweep.
+    With a single mobile species there is nothing to flip to - every trial is then rejected (with site -1 stored in
+    FlipTrials) and the state is left as it is.
+    :return: acceptCount - the number of accepted flips.
+             acceptInd - the running count of accepted flips at each accepted trial (zero for rejected trials).
+             delEArray - the energy change of every trial.
+    """
+    acceptCount = 0
+    acceptInd = np.zeros(Nfliptrials, dtype=int64)
+    delEArray = np.zeros(Nfliptrials)
+
+    Nsites = len(mobOcc)
+    NspecMob = numInteractsSiteSpec.shape[1] - 1  # the vacancy is the last species and is never flipped to
+
+    flipcount = 0
+    if NspecMob < 2:
+        FlipTrials[:Nfliptrials, :] = -1
+        for spec in range(specCounts.shape[0]):
+            compSum[spec] += Nfliptrials * specCounts[spec]
+        flipcount = Nfliptrials
+
+    while flipcount < Nfliptrials:
+        site = np.random.randint(0, Nsites)
+        if site == vacSiteInd:
+            continue
+        specOld = mobOcc[site]
+        # draw a species other than the current one
+        specNew = np.random.randint(0, NspecMob - 1)
+        if specNew >= specOld:
+            specNew += 1
+
+        FlipTrials[flipcount, 0] = site
+        FlipTrials[flipcount, 1] = specNew
+
+        delE = 0.
+        # switch off the interactions with the old species at the site
+        for interIdx in range(numInteractsSiteSpec[site, specOld]):
+            interMainInd = SiteSpecInterArray[site, specOld, interIdx]
+            if OffSiteCount[interMainInd] == 0:
+                delE -= Interaction2En[interMainInd]
+            OffSiteCount[interMainInd] += 1
+
+        # and switch on those with the new species
+        for interIdx in range(numInteractsSiteSpec[site, specNew]):
+            interMainInd = SiteSpecInterArray[site, specNew, interIdx]
+            OffSiteCount[interMainInd] -= 1
+            if OffSiteCount[interMainInd] == 0:
+                delE += Interaction2En[interMainInd]
+
+        delEArray[flipcount] = delE
+
+        if -beta*(delE - (mu[specNew] - mu[specOld])) > randarr[flipcount]:
+            mobOcc[site] = specNew
+            specCounts[specOld] -= 1
+            specCounts[specNew] += 1
+            acceptCount += 1
+            acceptInd[flipcount] = acceptCount
+        else:
+            # revert back the off site counts, because the state has not changed
+            for interIdx in range(numInteractsSiteSpec[site, specOld]):
+                OffSiteCount[SiteSpecInterArray[site, specOld, interIdx]] -= 1
+
+            for interIdx in range(numInteractsSiteSpec[site, specNew]):
+                OffSiteCount[SiteSpecInterArray[site, specNew, interIdx]] += 1
+
+        for spec in range(specCounts.shape[0]):
+            compSum[spec] += specCounts[spec]
+
+        flipcount += 1
+
+    # make the offsite for the transition states
+    for TsInteractIdx in range(len(TSInteractSites)):
+        TransOffSiteCount[TsInteractIdx] = 0
+        for Siteind in range(numSitesTSInteracts[TsInteractIdx]):
+            if mobOcc[TSInteractSites[TsInteractIdx, Siteind]] != TSInteractSpecs[TsInteractIdx, Siteind]:
+                TransOffSiteCount[TsInteractIdx] += 1
+
+    return acceptCount, acceptInd, delEArray
+
+
+@jit(nopython=True, cache=True)
+def expand(state, ijList, dxList, OffSiteCount, TSOffSiteCount, lenVecClus, beta, vacSiteInd, numInteractsSiteSpec,
+           SiteSpecInterArray, Interaction2En, numVecsInteracts, VecsInteracts, VecGroupInteracts,
+           FinSiteFinSpecJumpInd, numJumpPointGroups, numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng):
+    """
+    Get the rate expansion matrix and vector of a state (see MCSamplerClass.Expand).
+    :return: WBar - (lenVecClus x lenVecClus) rate weighted sum of the outer products of the basis vector changes.
+             BBar - (lenVecClus-size array) rate weighted sum of the basis vector changes dotted with the jumps.
+    """
+    ratelist = np.zeros(ijList.shape[0])
+    del_lamb_mat = np.zeros((lenVecClus, lenVecClus, ijList.shape[0]))
+    delxDotdelLamb = np.zeros((lenVecClus, ijList.shape[0]))
+
+    siteA = vacSiteInd
+    delEKRAArray = getKRAEnergies(state, TSOffSiteCount, ijList, FinSiteFinSpecJumpInd, numJumpPointGroups,
+                                  numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng)
+
+    for jumpInd in range(ijList.shape[0]):
+        del_lamb = np.zeros((lenVecClus, 3))
+        siteB = ijList[jumpInd]
+
+        delE = 0.0
+        # Switch required sites off
+        for interIdx in range(numInteractsSiteSpec[siteA, state[siteA]]):
+            # check if an interaction is on
+            interMainInd = SiteSpecInterArray[siteA, state[siteA], interIdx]
+            if OffSiteCount[interMainInd] == 0:
+                delE -= Interaction2En[interMainInd]
+                # take away the vectors for this interaction
+                for i in range(numVecsInteracts[interMainInd]):
+                    del_lamb[VecGroupInteracts[interMainInd, i]] -= VecsInteracts[interMainInd, i, :]
+            OffSiteCount[interMainInd] += 1
+
+        for interIdx in range(numInteractsSiteSpec[siteB, state[siteB]]):
+            interMainInd = SiteSpecInterArray[siteB, state[siteB], interIdx]
+            if OffSiteCount[interMainInd] == 0:
+                delE -= Interaction2En[interMainInd]
+                for i in range(numVecsInteracts[interMainInd]):
+                    del_lamb[VecGroupInteracts[interMainInd, i]] -= VecsInteracts[interMainInd, i, :]
+            OffSiteCount[interMainInd] += 1
+
+        # Next, switch required sites on
+        for interIdx in range(numInteractsSiteSpec[siteA, state[siteB]]):
+            interMainInd = SiteSpecInterArray[siteA, state[siteB], interIdx]
+            OffSiteCount[interMainInd] -= 1
+            if OffSiteCount[interMainInd] == 0:
+                delE += Interaction2En[interMainInd]
+                # add the vectors for this interaction
+                for i in range(numVecsInteracts[interMainInd]):
+                    del_lamb[VecGroupInteracts[interMainInd, i]] += VecsInteracts[interMainInd, i, :]
+
+        for interIdx in range(numInteractsSiteSpec[siteB, state[siteA]]):
+            interMainInd = SiteSpecInterArray[siteB, state[siteA], interIdx]
+            OffSiteCount[interMainInd] -= 1
+            if OffSiteCount[interMainInd] == 0:
+                delE += Interaction2En[interMainInd]
+                # for interactions with zero vector basis, numVecsInteracts[interMainInd] = -1 and the
+                # loop doesn't run
+                for i in range(numVecsInteracts[interMainInd]):
+                    del_lamb[VecGroupInteracts[interMainInd, i]] += VecsInteracts[interMainInd, i, :]
+
+        ratelist[jumpInd] = np.exp(-(0.5 * delE + delEKRAArray[jumpInd]) * beta)
+        del_lamb_mat[:, :, jumpInd] = np.dot(del_lamb, del_lamb.T)
+
+        for i in range(lenVecClus):
+            delxDotdelLamb[i, jumpInd] = np.dot(del_lamb[i, :], dxList[jumpInd, :])
+
+        # Next, restore OffSiteCounts to original values for the next jump
+        for interIdx in range(numInteractsSiteSpec[siteA, state[siteA]]):
+            OffSiteCount[SiteSpecInterArray[siteA, state[siteA], interIdx]] -= 1
+
+        for interIdx in range(numInteractsSiteSpec[siteB, state[siteB]]):
+            OffSiteCount[SiteSpecInterArray[siteB, state[siteB], interIdx]] -= 1
+
+        for interIdx in range(numInteractsSiteSpec[siteA, state[siteB]]):
+            OffSiteCount[SiteSpecInterArray[siteA, state[siteB], interIdx]] += 1
+
+        for interIdx in range(numInteractsSiteSpec[siteB, state[siteA]]):
+            OffSiteCount[SiteSpecInterArray[siteB, state[siteA], interIdx]] += 1
+
+    WBar = np.zeros((lenVecClus, lenVecClus))
+    for i in range(lenVecClus):
+        for j in range(lenVecClus):
+            WBar[i, j] += np.dot(del_lamb_mat[i, j, :], ratelist)
+
+    BBar = np.zeros(lenVecClus)
+    for i in range(lenVecClus):
+        BBar[i] = np.dot(ratelist, delxDotdelLamb[i, :])
+
+    return WBar, BBar
+
+
+@jit(nopython=True, cache=True)
+def exitData(state, ijList, dxList, OffSiteCount, TSOffSiteCount, beta, Nsites, vacSiteInd, Nspecs,
+             numInteractsSiteSpec, SiteSpecInterArray, Interaction2En, FinSiteFinSpecJumpInd, numJumpPointGroups,
+             numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng):
+    """
+    Get the exit states, rates and species displacements of the jumps out of a state (see
+    MCSamplerClass.getExitData).
+    """
+    statesTrans = np.zeros((ijList.shape[0], Nsites), dtype=int64)
+    Specdisps = np.zeros((ijList.shape[0], Nspecs, 3))  # To store the displacement of each species during every jump
+
+    siteA = vacSiteInd
+    delEKRA = getKRAEnergies(state, TSOffSiteCount, ijList, FinSiteFinSpecJumpInd, numJumpPointGroups,
+                             numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng)
+    delE = getEnergyChangeJumps(state, OffSiteCount, siteA, ijList, numInteractsSiteSpec, SiteSpecInterArray,
+                                Interaction2En)
+    ratelist = np.exp(-(0.5 * delE + delEKRA) * beta)
+
+    for jumpInd in range(ijList.shape[0]):
+        siteB, specB = ijList[jumpInd], state[ijList[jumpInd]]
+        # copy the state and swap the occupancies after the jump
+        statesTrans[jumpInd, :] = state
+        statesTrans[jumpInd, siteB] = state[siteA]
+        statesTrans[jumpInd, siteA] = state[siteB]
+
+        Specdisps[jumpInd, specB, :] = -dxList[jumpInd, :]
+        Specdisps[jumpInd, -1, :] = dxList[jumpInd, :]
+
+    return statesTrans, ratelist, Specdisps
+
+
+@jit(nopython=True, cache=True)
+def kmcStep(state, offsc, X, vacSiteFix, vacIndNow, rn, jumpFinSiteList, jumpFinSiteListTrans, dxList, beta,
+            siteIndtoR, RtoSiteInd, N_unit, numSitesTSInteracts, TSInteractSites, TSInteractSpecs,
+            FinSiteFinSpecJumpInd, numJumpPointGroups, numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng,
+            numInteractsSiteSpec, SiteSpecInterArray, Interaction2En):
+    """
+    Do one KMC step of a single vacancy at vacIndNow - get the rates of the jumps out of the state, select one with
+    the uniform random number rn, and do it. Every single vacancy KMC driver takes its steps through this function.
+    :param X: (NSpec x 3) displacements of each species - updated in place, along with state and offsc.
+    :param jumpFinSiteListTrans: work array the size of jumpFinSiteList - the exit sites of vacIndNow are put in it.
+    :return: vacIndNext - the site of the vacancy after the step.
+             jmpSelect - the jump that was selected.
+             rateTot - the total exit rate out of the state before the step.
+    """
+    NSpec = X.shape[0]
+
+    # Translate the states so that vacancy is taken from vacIndnow to vacSiteFix
+    stateTrans = translateState(state, vacSiteFix, vacIndNow, siteIndtoR, RtoSiteInd, N_unit)
+    TSoffsc = countOffSites(stateTrans, numSitesTSInteracts, TSInteractSites, TSInteractSpecs)
+
+    delEKRA = getKRAEnergies(stateTrans, TSoffsc, jumpFinSiteList, FinSiteFinSpecJumpInd, numJumpPointGroups,
+                             numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng)
+
+    dR = siteIndtoR[vacIndNow] - siteIndtoR[vacSiteFix]
+
+    for jmp in range(jumpFinSiteList.shape[0]):
+        RfinSiteNew = (dR + siteIndtoR[jumpFinSiteList[jmp]]) % N_unit
+        jumpFinSiteListTrans[jmp] = RtoSiteInd[RfinSiteNew[0], RfinSiteNew[1], RfinSiteNew[2]]
+
+    delE = getEnergyChangeJumps(state, offsc, vacIndNow, jumpFinSiteListTrans, numInteractsSiteSpec,
+                                SiteSpecInterArray, Interaction2En)
+
+    rates = np.exp(-(0.5 * delE + delEKRA) * beta)
+    rateTot = np.sum(rates)
+
+    rates /= rateTot
+    rates_cm = np.cumsum(rates)
+    jmpSelect = np.searchsorted(rates_cm, rn)
+
+    vacIndNext = jumpFinSiteListTrans[jmpSelect]
+
+    X[NSpec - 1, :] += dxList[jmpSelect]
+    specB = state[vacIndNext]
+    X[specB, :] -= dxList[jmpSelect]
+
+    updateState(state, offsc, vacIndNow, vacIndNext, numInteractsSiteSpec, SiteSpecInterArray)
+
+    return vacIndNext, jmpSelect, rateTot
+
+
+@jit(nopython=True, cache=True)
+def kmcTraj(state, offsc, X, t, vacSiteFix, vacIndNow, jumpFinSiteList, dxList, Nsteps, beta, key, step0,
+            siteIndtoR, RtoSiteInd, N_unit, numSitesTSInteracts, TSInteractSites, TSInteractSpecs,
+            FinSiteFinSpecJumpInd, numJumpPointGroups, numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng,
+            numInteractsSiteSpec, SiteSpecInterArray, Interaction2En):
+    """
+    Run Nsteps KMC steps of a single vacancy, continuing from the vacancy at vacIndNow (see KMC_JIT.getTraj and
+    KMC_JIT.getTrajChunk).
+    :param X: (NSpec x 3) displacements of each species so far - updated in place.
+    :param t: the time so far.
+    :param key: key of the random stream to draw from (see CounterRNG.makeStreamKey), with the random number of
+    step "step" drawn at counter step0 + step. If None, numba's np.random is used instead.
+    :return: X_steps - (Nsteps x NSpec x 3) displacements of each species at each step.
+             t_steps - (Nsteps-size array) time at each step.
+             jumpRecord - (Nsteps x 3) the site of the vacancy before and after each step, and the jump selected.
+             t - the time at the end of the steps.
+             vacIndNow - the site of the vacancy at the end of the steps.
+    """
+    NSpec = X.shape[0]
+    X_steps = np.zeros((Nsteps, NSpec, 3), dtype=float64)
+    t_steps = np.zeros(Nsteps, dtype=float64)
+    jumpRecord = np.zeros((Nsteps, 3), dtype=int64)
+
+    jumpFinSiteListTrans = np.zeros_like(jumpFinSiteList, dtype=int64)
+
+    for step in range(Nsteps):
+        if key is None:
+            rn = np.random.rand()
+        else:
+            rn = CounterRNG.randUniform(key, step0 + step)
+
+        vacIndNext, jmpSelect, rateTot = \
+            kmcStep(state, offsc, X, vacSiteFix, vacIndNow, rn, jumpFinSiteList, jumpFinSiteListTrans, dxList, beta,
+                    siteIndtoR, RtoSiteInd, N_unit, numSitesTSInteracts, TSInteractSites, TSInteractSpecs,
+                    FinSiteFinSpecJumpInd, numJumpPointGroups, numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng,
+                    numInteractsSiteSpec, SiteSpecInterArray, Interaction2En)
+        t += 1.0/rateTot
+
+        X_steps[step, :, :] = X
+        t_steps[step] = t
+        jumpRecord[step, 0] = vacIndNow
+        jumpRecord[step, 1] = vacIndNext
+        jumpRecord[step, 2] = jmpSelect
+
+        vacIndNow = vacIndNext
+
+    return X_steps, t_steps, jumpRecord, t, vacIndNow
+
+
+@jit(nopython=True, cache=True)
+def kmcTrajSampled(state, offsc, vacSiteFix, jumpFinSiteList, dxList, NSpec, Nsteps, beta, key, sampleSteps,
+                   sampleTimes, siteIndtoR, RtoSiteInd, N_unit, numSitesTSInteracts, TSInteractSites, TSInteractSpecs,
+                   FinSiteFinSpecJumpInd, numJumpPointGroups, numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng,
+                   numInteractsSiteSpec, SiteSpecInterArray, Interaction2En):
+    """
+    Run a KMC trajectory of a single vacancy, starting at vacSiteFix, recording the displacements only at a set of
+    steps and a set of times (see KMC_JIT.getTrajSampled).
+    :param key: key of the random stream to draw from, with the random number of step "step" drawn at counter
+    "step" (see kmcTraj). If None, numba's np.random is used instead.
+    :return: X_steps - (Nsamples x NSpec x 3) displacements of each species at the sampled steps.
+             t_steps - (Nsamples-size array) the accumulated time at the sampled steps.
+             X_times - (Ntimes x NSpec x 3) displacements of each species at the sampled times.
+             NtimesDone - the number of sample times that have been reached by the trajectory.
+    """
+    X = np.zeros((NSpec, 3), dtype=float64)
+    Xprev = np.zeros((NSpec, 3), dtype=float64)
+    t = 0.
+
+    X_steps = np.zeros((sampleSteps.shape[0], NSpec, 3), dtype=float64)
+    t_steps = np.zeros(sampleSteps.shape[0], dtype=float64)
+    X_times = np.zeros((sampleTimes.shape[0], NSpec, 3), dtype=float64)
+
+    jumpFinSiteListTrans = np.zeros_like(jumpFinSiteList, dtype=int64)
+    vacIndNow = vacSiteFix
+    sampInd = 0
+    timeInd = 0
+
+    for step in range(Nsteps):
+        if key is None:
+            rn = np.random.rand()
+        else:
+            rn = CounterRNG.randUniform(key, step)
+
+        Xprev[:, :] = X
+        vacIndNow, jmpSelect, rateTot = \
+            kmcStep(state, offsc, X, vacSiteFix, vacIndNow, rn, jumpFinSiteList, jumpFinSiteListTrans, dxList, beta,
+                    siteIndtoR, RtoSiteInd, N_unit, numSitesTSInteracts, TSInteractSites, TSInteractSpecs,
+                    FinSiteFinSpecJumpInd, numJumpPointGroups, numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng,
+                    numInteractsSiteSpec, SiteSpecInterArray, Interaction2En)
+        tNew = t + 1.0/rateTot
+
+        # The system resides in the state before the jump until tNew
+        while timeInd < sampleTimes.shape[0] and sampleTimes[timeInd] < tNew:
+            X_times[timeInd, :, :] = Xprev
+            timeInd += 1
+
+        t = tNew
+
+        if sampInd < sampleSteps.shape[0] and step == sampleSteps[sampInd]:
+            X_steps[sampInd, :, :] = X
+            t_steps[sampInd] = t
+            sampInd += 1
+
+    return X_steps, t_steps, X_times, timeInd
+
+
+def warmUp():
+    """
+    Load all the kernels from the numba cache (compiling and caching them the first time), so that the first MC step
+    or KMC trajectory of a process does not pay for compilation.
+    The kernels are run once on a two site ring with a single pair interaction, with arrays of the same types as
+    those made by Cluster_Expansion.VectorClusterExpansion.makeJitInteractionsData.
+    :return: the wall time taken, in seconds.
+    """
+    import time
+    start = time.time()
+
+    Nsites, Nspecs = 2, 2
+    vacSiteInd = 0
+    state = np.array([1, 0], dtype=np.int64)
+    ijList = np.array([1], dtype=np.int64)
+    dxList = np.array([[1., 0., 0.]])
+
+    # one interaction: species 0 on both sites (used for both the site and the transition state interactions)
+    numSitesInteracts = np.array([2], dtype=np.int64)
+    SupSitesInteracts = np.array([[0, 1]], dtype=np.int64)
+    SpecOnInteractSites = np.array([[0, 0]], dtype=np.int64)
+    Interaction2En = np.array([0.1])
+    numVecsInteracts = np.array([1], dtype=np.int64)
+    VecsInteracts = np.zeros((1, 1, 3))
+    VecGroupInteracts = np.zeros((1, 1), dtype=np.int64)
+    numInteractsSiteSpec = np.zeros((Nsites, Nspecs), dtype=np.int64)
+    numInteractsSiteSpec[:, 0] = 1
+    SiteSpecInterArray = np.zeros((Nsites, Nspecs, 1), dtype=np.int64)
+
+    FinSiteFinSpecJumpInd = np.zeros((Nsites, Nspecs), dtype=np.int64)
+    numJumpPointGroups = np.array([1], dtype=np.int64)
+    numTSInteractsInPtGroups = np.array([[1]], dtype=np.int64)
+    JumpInteracts = np.zeros((1, 1, 1), dtype=np.int64)
+    Jump2KRAEng = np.array([[[0.5]]])
+
+    siteIndtoR = np.array([[0, 0, 0], [1, 0, 0]], dtype=np.int64)
+    RtoSiteInd = np.zeros((2, 2, 2), dtype=np.int64)
+    RtoSiteInd[1, 0, 0] = 1
+    N_unit = 2
+
+    offsc = countOffSites(state, numSitesInteracts, SupSitesInteracts, SpecOnInteractSites)
+    TSoffsc = countOffSites(state, numSitesInteracts, SupSitesInteracts, SpecOnInteractSites)
+    translateState(state, 0, 1, siteIndtoR, RtoSiteInd, N_unit)
+
+    mcSweep(state.copy(), offsc.copy(), TSoffsc.copy(), np.zeros((1, 2), dtype=np.int64), 1.0, np.zeros(1), 0,
+            vacSiteInd, numInteractsSiteSpec, SiteSpecInterArray, Interaction2En, numSitesInteracts,
+            SupSitesInteracts, SpecOnInteractSites, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    sgcSweep(state.copy(), offsc.copy(), TSoffsc.copy(), np.zeros((1, 2), dtype=np.int64), 1.0, np.zeros(Nspecs),
+             np.zeros(1), 0, vacSiteInd, numInteractsSiteSpec, SiteSpecInterArray, Interaction2En, numSitesInteracts,
+             SupSitesInteracts, SpecOnInteractSites, np.zeros(Nspecs, dtype=np.int64), np.zeros(Nspecs))
+    mcSweepStream(state.copy(), offsc.copy(), TSoffsc.copy(), 1.0, 0, vacSiteInd, 1, 0, numInteractsSiteSpec,
+                  SiteSpecInterArray, Interaction2En, numSitesInteracts, SupSitesInteracts, SpecOnInteractSites)
+    multiSwapMC(state.copy(), offsc.copy(), TSoffsc.copy(), np.zeros((1, 2), dtype=np.int64), 0, 1.0, 0.,
+                vacSiteInd, numInteractsSiteSpec, SiteSpecInterArray, Interaction2En, numSitesInteracts,
+                SupSitesInteracts, SpecOnInteractSites)
+    newRandState(state.copy(), offsc.copy(), 0., np.zeros((1, 2), dtype=np.int64), 0, numInteractsSiteSpec,
+                 SiteSpecInterArray, Interaction2En)
+    expand(state, ijList, dxList, offsc, TSoffsc, 1, 1.0, vacSiteInd, numInteractsSiteSpec, SiteSpecInterArray,
+           Interaction2En, numVecsInteracts, VecsInteracts, VecGroupInteracts, FinSiteFinSpecJumpInd,
+           numJumpPointGroups, numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng)
+    exitData(state, ijList, dxList, offsc, TSoffsc, 1.0, Nsites, vacSiteInd, Nspecs, numInteractsSiteSpec,
+             SiteSpecInterArray, Interaction2En, FinSiteFinSpecJumpInd, numJumpPointGroups,
+             numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng)
+    # with numba's np.random and with a counter-based stream
+    for key in [None, 1]:
+        kmcTraj(state.copy(), offsc.copy(), np.zeros((Nspecs, 3)), 0., vacSiteInd, vacSiteInd, ijList, dxList, 1, 1.0,
+                key, 0, siteIndtoR, RtoSiteInd, N_unit, numSitesInteracts, SupSitesInteracts, SpecOnInteractSites,
+                FinSiteFinSpecJumpInd, numJumpPointGroups, numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng,
+                numInteractsSiteSpec, SiteSpecInterArray, Interaction2En)
+        kmcTrajSampled(state.copy(), offsc.copy(), vacSiteInd, ijList, dxList, Nspecs, 1, 1.0, key,
+                       np.zeros(1, dtype=np.int64), np.zeros(1), siteIndtoR, RtoSiteInd, N_unit, numSitesInteracts,
+                       SupSitesInteracts, SpecOnInteractSites, FinSiteFinSpecJumpInd, numJumpPointGroups,
+                       numTSInteractsInPtGroups, JumpInteracts, Jump2KRAEng, numInteractsSiteSpec, SiteSpecInterArray,
+                       Interaction2En)
+
+    # the same interaction stored by translation - the cluster has species 0 at offsets 0 and +x
+    numSitesReps = np.array([2], dtype=np.int64)
+    RepSiteOffsets = np.array([[[0, 0, 0], [1, 0, 0]]], dtype=np.int64)
+    RepSpecs = np.array([[0, 0]], dtype=np.int64)
+    numSpecRefs = np.array([2, 0], dtype=np.int64)
+    SpecRefs = np.array([[[0, 0], [0, 1]], [[-1, -1], [-1, -1]]], dtype=np.int64)
+    offscTrans = countOffSitesTrans(state, numSitesReps, RepSiteOffsets, RepSpecs, siteIndtoR, RtoSiteInd, N_unit)
+    getEnergyTrans(offscTrans, Interaction2En)
+    mcSweepTrans(state.copy(), offscTrans, np.zeros((1, 2), dtype=np.int64), 1.0, np.zeros(1), 0, vacSiteInd,
+                 RepSiteOffsets, Interaction2En, numSpecRefs, SpecRefs, siteIndtoR, RtoSiteInd, N_unit)
+
+    # and encoded by species pattern - one site tuple (0, 1), where the pattern (0, 0) has code 0
+    numSitesTuples = np.array([2], dtype=np.int64)
+    TupleSites = np.array([[0, 1]], dtype=np.int64)
+    TupleGeom = np.array([0], dtype=np.int64)
+    GeomPatternEn = np.zeros((1, Nspecs**2))
+    GeomPatternEn[0, 0] = 0.1
+    numTuplesSite = np.array([1, 1], dtype=np.int64)
+    SiteTuples = np.array([[[0, 1]], [[0, Nspecs]]], dtype=np.int64)
+    codes = patternCodes(state, numSitesTuples, TupleSites, Nspecs)
+    getEnergyPattern(codes, TupleGeom, GeomPatternEn)
+    mcSweepPattern(state.copy(), codes, np.zeros((1, 2), dtype=np.int64), 1.0, np.zeros(1), 0, vacSiteInd,
+                   TupleGeom, GeomPatternEn, numTuplesSite, SiteTuples)
+
+    return time.time() - start
+
+
+@jit(nopython=True, cache=True)
+def countOffSitesTrans(state, numSitesReps, RepSiteOffsets, RepSpecs, siteIndtoR, RtoSiteInd, N_unit):
+    """
+    Count the off sites of every interaction in a state, with the interactions stored by translation (see
+    Cluster_Expansion.VectorClusterExpansion.makeTransInvariantInteractionsData).
+    :return: OffSiteCount - (Nreps x Nsites) array, OffSiteCount[rep, a] is the number of off sites of cluster rep
+    anchored at site a.
+    """
+    Nsites = state.shape[0]
+    OffSiteCount = np.zeros((numSitesReps.shape[0], Nsites), dtype=int64)
+    for rep in range(numSitesReps.shape[0]):
+        for anchor in range(Nsites):
+            for k in range(numSitesReps[rep]):
+                R0 = (siteIndtoR[anchor, 0] + RepSiteOffsets[rep, k, 0]) % N_unit
+                R1 = (siteIndtoR[anchor, 1] + RepSiteOffsets[rep, k, 1]) % N_unit
+                R2 = (siteIndtoR[anchor, 2] + RepSiteOffsets[rep, k, 2]) % N_unit
+                if state[RtoSiteInd[R0, R1, R2]] != RepSpecs[rep, k]:
+                    OffSiteCount[rep, anchor] += 1
+    return OffSiteCount
+
+
+@jit(nopython=True, cache=True)
+def getEnergyTrans(OffSiteCount, Rep2En):
+    """
+    :return: the energy of a state from its (translation-indexed) off site counts.
+    """
+    En = 0.
+    for rep in range(OffSiteCount.shape[0]):
+        for anchor in range(OffSiteCount.shape[1]):
+            if OffSiteCount[rep, anchor] == 0:
+                En += Rep2En[rep]
+    return En
+
+
+@jit(nopython=True, cache=True)
+def switchSiteTrans(site, spec, switchOff, OffSiteCount, RepSiteOffsets, Rep2En, numSpecRefs, SpecRefs, siteIndtoR,
+                    RtoSiteInd, N_unit):
+    """
+    Update the off site counts of the interactions that have species spec at site - switching them off (one more
+    off site) or on (one less).
+    :return: the change in energy.
+    """
+    delE = 0.
+    for i in range(numSpecRefs[spec]):
+        rep = SpecRefs[spec, i, 0]
+        k = SpecRefs[spec, i, 1]
+        # the anchor that puts site k of the cluster at this site
+        R0 = (siteIndtoR[site, 0] - RepSiteOffsets[rep, k, 0]) % N_unit
+        R1 = (siteIndtoR[site, 1] - RepSiteOffsets[rep, k, 1]) % N_unit
+        R2 = (siteIndtoR[site, 2] - RepSiteOffsets[rep, k, 2]) % N_unit
+        anchor = RtoSiteInd[R0, R1, R2]
+        if switchOff:
+            if OffSiteCount[rep, anchor] == 0:
+                delE -= Rep2En[rep]
+            OffSiteCount[rep, anchor] += 1
+        else:
+            OffSiteCount[rep, anchor] -= 1
+            if OffSiteCount[rep, anchor] == 0:
+                delE += Rep2En[rep]
+    return delE
+
+
+@jit(nopython=True, cache=True)
+def swapSitesTrans(state, OffSiteCount, siteA, siteB, RepSiteOffsets, Rep2En, numSpecRefs, SpecRefs, siteIndtoR,
+                   RtoSiteInd, N_unit):
+    """
+    Swap the species at siteA and siteB, updating the (translation-indexed) off site counts.
+    :return: the change in energy.
+    """
+    specA = state[siteA]
+    specB = state[siteB]
+    delE = switchSiteTrans(siteA, specA, True, OffSiteCount, RepSiteOffsets, Rep2En, numSpecRefs, SpecRefs,
+                           siteIndtoR, RtoSiteInd, N_unit)
+    delE += switchSiteTrans(siteB, specB, True, OffSiteCount, RepSiteOffsets, Rep2En, numSpecRefs, SpecRefs,
+                            siteIndtoR, RtoSiteInd, N_unit)
+    delE += switchSiteTrans(siteA, specB, False, OffSiteCount, RepSiteOffsets, Rep2En, numSpecRefs, SpecRefs,
+                            siteIndtoR, RtoSiteInd, N_unit)
+    delE += switchSiteTrans(siteB, specA, False, OffSiteCount, RepSiteOffsets, Rep2En, numSpecRefs, SpecRefs,
+                            siteIndtoR, RtoSiteInd, N_unit)
+    state[siteA] = specB
+    state[siteB] = specA
+    return delE
+
+
+@jit(nopython=True, cache=True)
+def mcSweepTrans(mobOcc, OffSiteCount, SwapTrials, beta, randarr, Nswaptrials, vacSiteInd, RepSiteOffsets, Rep2En,
+                 numSpecRefs, SpecRefs, siteIndtoR, RtoSiteInd, N_unit):
+    """
+    Same as mcSweep (with the same random numbers drawn), but with the interactions stored by translation.
+    :return: acceptCount, badTrials, acceptInd, delEArray - as in mcSweep.
+    """
+    acceptCount = 0
+    acceptInd = np.zeros(Nswaptrials, dtype=int64)
+    badTrials = 0
+    delEArray = np.zeros(Nswaptrials)
+
+    Nsites = len(mobOcc)
+
+    swapcount = 0
+    while swapcount < Nswaptrials:
+        siteA = np.random.randint(0, Nsites)
+        siteB = np.random.randint(0, Nsites)
+
+        specA = mobOcc[siteA]
+        specB = mobOcc[siteB]
+
+        if specA == specB or siteA == vacSiteInd or siteB == vacSiteInd:
+            badTrials += 1
+            continue
+
+        SwapTrials[swapcount, 0] = siteA
+        SwapTrials[swapcount, 1] = siteB
+
+        delE = swapSitesTrans(mobOcc, OffSiteCount, siteA, siteB, RepSiteOffsets, Rep2En, numSpecRefs, SpecRefs,
+                              siteIndtoR, RtoSiteInd, N_unit)
+        delEArray[swapcount] = delE
+
+        if -beta*delE > randarr[swapcount]:
+            acceptCount += 1
+            acceptInd[swapcount] = acceptCount
+        else:
+            # swap back
+            swapSitesTrans(mobOcc, OffSiteCount, siteA, siteB, RepSiteOffsets, Rep2En, numSpecRefs, SpecRefs,
+                           siteIndtoR, RtoSiteInd, N_unit)
+
+        swapcount += 1
+
+    return acceptCount, badTrials, acceptInd, delEArray
+
+
+@jit(nopython=True, cache=True)
+def patternCodes(state, numSitesTuples, TupleSites, Nspec):
+    """
+    Encode the species on every site tuple of a state (see
+    Cluster_Expansion.VectorClusterExpansion.makePatternInteractionsData).
+    :return: codes - (Ntuples) array, sum over k of state[TupleSites[t, k]] * Nspec^k for every site tuple t.
+    """
+    codes = np.zeros(numSitesTuples.shape[0], dtype=int64)
+    for tup in range(numSitesTuples.shape[0]):
+        code = 0
+        weight = 1
+        for k in range(numSitesTuples[tup]):
+            code += state[TupleSites[tup, k]] * weight
+            weight *= Nspec
+        codes[tup] = code
+    return codes
+
+
+@jit(nopython=True, cache=True)
+def getEnergyPattern(codes, TupleGeom, GeomPatternEn):
+    """
+    :return: the energy of a state from the pattern codes of its site tuples.
+    """
+    En = 0.
+    for tup in range(codes.shape[0]):
+        En += GeomPatternEn[TupleGeom[tup], codes[tup]]
+    return En
+
+
+@jit(nopython=True, cache=True)
+def changeSitePattern(site, specOld, specNew, codes, TupleGeom, GeomPatternEn, numTuplesSite, SiteTuples):
+    """
+    Update the codes of the site tuples containing site, for a change of the species on it from specOld to specNew.
+    :return: the change in energy.
+    """
+    delE = 0.
+    for i in range(numTuplesSite[site]):
+        tup = SiteTuples[site, i, 0]
+        codeNew = codes[tup] + (specNew - specOld) * SiteTuples[site, i, 1]
+        delE += GeomPatternEn[TupleGeom[tup], codeNew] - GeomPatternEn[TupleGeom[tup], codes[tup]]
+        codes[tup] = codeNew
+    return delE
+
+
+@jit(nopython=True, cache=True)
+def swapSitesPattern(state, codes, siteA, siteB, TupleGeom, GeomPatternEn, numTuplesSite, SiteTuples):
+    """
+    Swap the species at siteA and siteB, updating the pattern codes of the site tuples containing them.
+    :return: the change in energy.
+    """
+    specA = state[siteA]
+    specB = state[siteB]
+    # site tuples containing both sites are updated twice, which gives the right code after both changes.
+    delE = changeSitePattern(siteA, specA, specB, codes, TupleGeom, GeomPatternEn, numTuplesSite, SiteTuples)
+    delE += changeSitePattern(siteB, specB, specA, codes, TupleGeom, GeomPatternEn, numTuplesSite, SiteTuples)
+    state[siteA] = specB
+    state[siteB] = specA
+    return delE
+
+
+@jit(nopython=True, cache=True)
+def mcSweepPattern(mobOcc, codes, SwapTrials, beta, randarr, Nswaptrials, vacSiteInd, TupleGeom, GeomPatternEn,
+                   numTuplesSite, SiteTuples):
+    """
+    Same as mcSweep (with the same random numbers drawn), but with the interactions encoded by species pattern.
+    :return: acceptCount, badTrials, acceptInd, delEArray - as in mcSweep.
+    """
+    acceptCount = 0
+    acceptInd = np.zeros(Nswaptrials, dtype=int64)
+    badTrials = 0
+    delEArray = np.zeros(Nswaptrials)
+
+    Nsites = len(mobOcc)
+
+    swapcount = 0
+    while swapcount < Nswaptrials:
+        siteA = np.random.randint(0, Nsites)
+        siteB = np.random.randint(0, Nsites)
+
+        specA = mobOcc[siteA]
+        specB = mobOcc[siteB]
+
+        if specA == specB or siteA == vacSiteInd or siteB == vacSiteInd:
+            badTrials += 1
+            continue
+
+        SwapTrials[swapcount, 0] = siteA
+        SwapTrials[swapcount, 1] = siteB
+
+        delE = swapSitesPattern(mobOcc, codes, siteA, siteB, TupleGeom, GeomPatternEn, numTuplesSite, SiteTuples)
+        delEArray[swapcount] = delE
+
+        if -beta*delE > randarr[swapcount]:
+            acceptCount += 1
+            acceptInd[swapcount] = acceptCount
+        else:
+            # swap back
+            swapSitesPattern(mobOcc, codes, siteA, siteB, TupleGeom, GeomPatternEn, numTuplesSite, SiteTuples)
+
+        swapcount += 1
+
+    return acceptCount, badTrials, acceptInd, delEArray
@@ -0,0 +1,195 @@
+"""
+Chunked, column-wise on-disk storage of MC samples - the sampled states (bit-packed), and any per-sample quantities
+such as energies, off site counts, or the WBar/BBar expansion outputs.
+Samples are appended one at a time, and every chunkSize samples each column is written as a .npy file by a
+background thread, so that the sampling loop does not wait for the disk. The chunks are raw .npy files so that they
+can be memory mapped when read back, and passes over the samples (e.g, expansions or fits) go through them one chunk
+at a time without loading the whole store.
+
+Layout of a store directory:
+    index.npz - the number of sites, bits per site, column names and the number of samples in each chunk.
+    <column>_XXXXXX.npy - the rows of a column in one chunk ("states" holds the packed states).
+"""
+import numpy as np
+import os
+from numba import jit
+import Checkpoint
+
+
+@jit(nopython=True)
+def packStates(states, bitsPerSite):
+    """
+    Pack states into 64 bit words, bitsPerSite bits per site (the same layout as MC_JIT.PackedStateSet).
+    :param states: (Nstates x Nsites) array of states.
+    :return: (Nstates x Nwords) uint64 array of packed states.
+    """
+    sitesPerWord = 64 // bitsPerSite
+    Nwords = (states.shape[1] + sitesPerWord - 1) // sitesPerWord
+    packed = np.zeros((states.shape[0], Nwords), dtype=np.uint64)
+    for i in range(states.shape[0]):
+        for site in range(states.shape[1]):
+            word = site // sitesPerWord
+            shift = np.uint64((site % sitesPerWord) * bitsPerSite)
+            packed[i, word] |= np.uint64(states[i, site]) << shift
+    return packed
+
+
+@jit(nopython=True)
+def unpackStates(packed, Nsites, bitsPerSite):
+    """
+    Inverse of packStates.
+    :return: (Nstates x Nsites) int64 array of states.
+    """
+    sitesPerWord = 64 // bitsPerSite
+    mask = (np.uint64(1) << np.uint64(bitsPerSite)) - np.uint64(1)
+    states = np.zeros((packed.shape[0], Nsites), dtype=np.int64)
+    for i in range(packed.shape[0]):
+        for site in range(Nsites):
+            word = site // sitesPerWord
+            shift = np.uint64((site % sitesPerWord) * bitsPerSite)
+            states[i, site] = np.int64((packed[i, word] >> shift) & mask)
+    return states
+
+
+def columnFileName(dirName, column, chunk):
+    return os.path.join(dirName, "{}_{:06d}.npy".format(column, chunk))
+
+
+class SampleStoreWriter(object):
+    """
+    Writer of sample stores. Call append for every sample, and close at the end.
+    """
+
+    def __init__(self, dirName, Nsites, Nspecs, chunkSize=1000, writer=None):
+        """
+        :param dirName: directory to write the store to (created if it does not exist).
+        :param Nsites: the number of sites in a state.
+        :param Nspecs: the number of species (including the vacancy) - sets the number of bits per site.
+        :param chunkSize: the number of samples in each chunk.
+        :param writer: Checkpoint.BackgroundWriter to write the chunks with. If not given, one is made for this store
+        and closed with it.
+        """
+        self.dirName = dirName
+        os.makedirs(dirName, exist_ok=True)
+        self.Nsites = Nsites
+        self.bitsPerSite = 1
+        while (1 << self.bitsPerSite) < Nspecs:
+            self.bitsPerSite += 1
+        self.chunkSize = chunkSize
+        self.ownWriter = writer is None
+        self.writer = Checkpoint.BackgroundWriter() if writer is None else writer
+
+        self.columns = None
+        self.buffers = {}
+        self.chunkRows = []
+
+    def append(self, state, **columns):
+        """
+        Add a sample.
+        :param state: the sampled state.
+        :param columns: the quantities to store with the state, as keyword arguments (e.g, energy=En, WBar=WBar). The
+        same quantities must be given for every sample.
+        """
+        if self.columns is None:
+            self.columns = ["states"] + sorted(columns.keys())
+            self.buffers = {column: [] for column in self.columns}
+        elif sorted(columns.keys()) != self.columns[1:]:
+            raise ValueError("Expected the columns {}, got {}".format(self.columns[1:], sorted(columns.keys())))
+        if state.shape[0] != self.Nsites:
+            raise ValueError("Expected a state with {} sites, got {}".format(self.Nsites, state.shape[0]))
+
+        self.buffers["states"].append(np.asarray(state, dtype=np.int64))
+        for column, value in columns.items():
+            self.buffers[column].append(np.array(value, copy=True))
+
+        if len(self.buffers["states"]) == self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered samples as a chunk (which may be smaller than chunkSize), and update the index.
+        """
+        if self.columns is None or len(self.buffers["states"]) == 0:
+            return
+        chunk = len(self.chunkRows)
+        self.chunkRows.append(len(self.buffers["states"]))
+        for column in self.columns:
+            rows = np.array(self.buffers[column])
+            if column == "states":
+                rows = packStates(rows, self.bitsPerSite)
+            self.writer.submitCall(Checkpoint.atomicSave, columnFileName(self.dirName, column, chunk), rows)
+            self.buffers[column] = []
+
+        # the index is written after the chunk files, so that it never refers to missing chunks
+        self.writer.submitCall(Checkpoint.atomicSavez, os.path.join(self.dirName, "index.npz"), Nsites=self.Nsites,
+                               bitsPerSite=self.bitsPerSite, chunkSize=self.chunkSize,
+                               columns=np.array(self.columns), chunkRows=np.array(self.chunkRows, dtype=np.int64))
+
+    def close(self):
+        """
+        Write out the remaining samples, and wait for all the writes to finish.
+        """
+        self.flush()
+        if self.ownWriter:
+            self.writer.close()
+        else:
+            self.writer.wait()
+
+
+class SampleStoreReader(object):
+    """
+    Reader of stores written with SampleStoreWriter. The chunks are memory mapped, so only the parts of them that are
+    used are read from disk.
+    """
+
+    def __init__(self, dirName):
+        self.dirName = dirName
+        index = Checkpoint.loadFields(os.path.join(dirName, "index.npz"),
+                                      ["Nsites", "bitsPerSite", "chunkSize", "columns", "chunkRows"])
+        self.Nsites = index["Nsites"]
+        self.bitsPerSite = index["bitsPerSite"]
+        self.chunkSize = index["chunkSize"]
+        self.columns = list(index["columns"])
+        self.chunkRows = index["chunkRows"]
+        self.chunkStarts = np.concatenate(([0], np.cumsum(self.chunkRows)))
+        self.Nsamples = int(self.chunkStarts[-1])
+
+    def __len__(self):
+        return self.Nsamples
+
+    def loadChunk(self, column, chunk):
+        """
+        :return: the rows of a column in a chunk, memory mapped (read only). The states are returned packed.
+        """
+        if column not in self.columns:
+            raise KeyError("No column {} in the store (columns: {})".format(column, self.columns))
+        return np.load(columnFileName(self.dirName, column, chunk), mmap_mode="r")
+
+    def loadStates(self, chunk):
+        """
+        :return: (Nrows x Nsites) the states in a chunk, unpacked.
+        """
+        return unpackStates(np.ascontiguousarray(self.loadChunk("states", chunk)), self.Nsites, self.bitsPerSite)
+
+    def iterChunks(self, *columns):
+        """
+        Iterate over the samples chunk by chunk.
+        :param columns: the columns to get - "states" gives the unpacked states.
+        :return: generator of tuples with the rows of each column in a chunk.
+        """
+        for chunk in range(len(self.chunkRows)):
+            yield tuple(self.loadStates(chunk) if column == "states" else self.loadChunk(column, chunk)
+                        for column in columns)
+
+    def getSample(self, column, index):
+        """
+        :return: the value of a column for a single sample (the unpacked state for "states").
+        """
+        if index < 0 or index >= self.Nsamples:
+            raise IndexError("Sample {} out of range (the store has {} samples)".format(index, self.Nsamples))
+        chunk = np.searchsorted(self.chunkStarts, index, side="right") - 1
+        row = index - self.chunkStarts[chunk]
+        if column == "states":
+            return unpackStates(np.ascontiguousarray(self.loadChunk("states", chunk)[row:row + 1]), self.Nsites,
+                                self.bitsPerSite)[0]
+        return np.array(self.loadChunk(column, chunk)[row])
@@ -0,0 +1,122 @@
+"""
+Interaction tables of the MC and KMC jitclasses in shared memory, so that worker processes attach to a single copy of
+them instead of each receiving (and holding) its own.
+The tables are published once into a single multiprocessing.shared_memory block by the parent process. A
+SharedTables object pickles to just the name of the block and the layout of the arrays in it, so it can be passed to
+workers (e.g, as an argument of a multiprocessing.Pool task), and unpickling it attaches to the block. The jitclass
+constructors keep references to the arrays they are given without copying them, so samplers made with makeMCSampler
+or makeKMC in the workers use the shared tables directly, and each worker only holds its own states and counters.
+"""
+import numpy as np
+import sys
+from multiprocessing import shared_memory, resource_tracker
+import MC_JIT
+
+# The interaction arrays, in the order the MCSamplerClass and KMC_JIT constructors take them
+MCTableNames = ["numSitesInteracts", "SupSitesInteracts", "SpecOnInteractSites", "Interaction2En",
+                "numVecsInteracts", "VecsInteracts", "VecGroupInteracts", "numInteractsSiteSpec", "SiteSpecInterArray",
+                "numSitesTSInteracts", "TSInteractSites", "TSInteractSpecs", "jumpFinSites", "jumpFinSpec",
+                "FinSiteFinSpecJumpInd", "numJumpPointGroups", "numTSInteractsInPtGroups", "JumpInteracts",
+                "Jump2KRAEng"]
+
+KMCTableNames = MCTableNames + ["siteIndtoR", "RtoSiteInd"]
+
+alignment = 64
+
+
+class SharedTables(object):
+    """
+    A set of named arrays in one shared memory block. Make it with publish, and keep it alive (in the process that
+    published it) for as long as any worker uses the tables - then call unlink.
+    """
+
+    def __init__(self, shm, layout, owner):
+        """
+        Use publish or attach instead of calling this directly.
+        :param shm: the SharedMemory block.
+        :param layout: dictionary of array name to (offset, dtype string, shape) in the block.
+        :param owner: whether this process created the block (and is responsible for unlinking it).
+        """
+        self.shm = shm
+        self.layout = layout
+        self.owner = owner
+        self.arrays = {}
+        for name, (offset, dtype, shape) in layout.items():
+            self.arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+
+    @classmethod
+    def publish(cls, **arrays):
+        """
+        Copy arrays into a new shared memory block.
+        :param arrays: the arrays to share, as keyword arguments.
+        :return: SharedTables object owning the block.
+        """
+        layout = {}
+        size = 0
+        for name, arr in arrays.items():
+            arr = np.asarray(arr)
+            layout[name] = (size, arr.dtype.str, arr.shape)
+            size += (arr.nbytes + alignment - 1) // alignment * alignment
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        tables = cls(shm, layout, True)
+        for name, arr in arrays.items():
+            tables.arrays[name][...] = arr
+        return tables
+
+    @classmethod
+    def attach(cls, name, layout):
+        """
+        Attach to a block published by another process.
+        :param name: the name of the shared memory block.
+        :param layout: the layout of the arrays in the block (see __init__).
+        """
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+            # only the publishing process should unlink the block when it is done
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, layout, False)
+
+    def __getstate__(self):
+        return {"name": self.shm.name, "layout": self.layout}
+
+    def __setstate__(self, state):
+        attached = SharedTables.attach(state["name"], state["layout"])
+        self.__dict__.update(attached.__dict__)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self):
+        """
+        Detach from the block. The arrays (and any sampler made from them) must not be used after this.
+        """
+        self.arrays = {}
+        self.shm.close()
+
+    def unlink(self):
+        """
+        Close and free the block - to be called by the publishing process when all the workers are done.
+        """
+        self.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def makeMCSampler(tables, vacSiteInd, mobOcc, OffSiteCount):
+    """
+    Make an MCSamplerClass object that uses the shared tables without copying them.
+    :param tables: SharedTables holding (at least) the arrays in MCTableNames.
+    The other parameters are as in the MCSamplerClass constructor.
+    """
+    return MC_JIT.MCSamplerClass(*[tables[name] for name in MCTableNames], vacSiteInd, mobOcc, OffSiteCount)
+
+
+def makeKMC(tables, N_unit):
+    """
+    Make a KMC_JIT object that uses the shared tables without copying them.
+    :param tables: SharedTables holding the arrays in KMCTableNames.
+    :param N_unit: the number of unit cells along each direction of the supercell.
+    """
+    return MC_JIT.KMC_JIT(*[tables[name] for name in KMCTableNames], N_unit)
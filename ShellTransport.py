@@ -0,0 +1,177 @@
+"""
+Functions to solve for the correlated vacancy transport coefficient on a finite network of states built around a
+starting state (see MC_JIT.makeShellsJit).
+
+For a network with transition rate matrix G (G_ij the rate from state i to j, G_ii the negative escape rate),
+stationary probabilities pi (from detailed balance) and velocities v_i = sum_j G_ij dx_ij, the Onsager coefficient is
+    L = L0 - sum_i pi_i v_i (x) eta_i,    with    (-G) eta = v
+where L0 = 1/2 sum_i pi_i sum_j G_ij dx_ij (x) dx_ij is the uncorrelated part and eta is the relaxation vector.
+"""
+import numpy as np
+import warnings
+from scipy import sparse
+from scipy.sparse import linalg as splinalg
+
+
+def makeShellRateMatrix(depth, indptr, colInds, rates, jumpInds, Nshells, boundary="dirichlet"):
+    """
+    Function to assemble -G over the states with known exits (those in the inner shells).
+    :param depth, indptr, colInds, rates, jumpInds: shell network from MC_JIT.makeShellsJit
+    :param Nshells: the number of shells the network was built with.
+    :param boundary: how to treat jumps into the outermost shell, whose exits are not known.
+                     "dirichlet" - the jumps are kept in the escape rates, and the relaxation vector is taken to be
+                                   zero on the outer shell (the outer shell is taken to be fully decorrelated).
+                     "reflecting" - the jumps are removed altogether, so that the inner shells form a closed network.
+    :return: minusG - (Ninner x Ninner) sparse CSR matrix -G over the inner states.
+             innerStates - the indices (in the network) of the inner states.
+             edgeRows, edgeKeep - the (network) state each jump starts from, and whether the jump is kept.
+    """
+    if boundary not in ("dirichlet", "reflecting"):
+        raise ValueError("boundary must be either 'dirichlet' or 'reflecting'")
+
+    Nstates = depth.shape[0]
+    innerStates = np.where(depth < Nshells)[0]
+    innerIndex = np.full(Nstates, -1, dtype=int)
+    innerIndex[innerStates] = np.arange(innerStates.shape[0])
+
+    edgeRows = np.repeat(np.arange(Nstates), np.diff(indptr))
+    edgeKeep = jumpInds >= 0
+    if boundary == "reflecting":
+        edgeKeep &= innerIndex[colInds] != -1
+
+    rows = innerIndex[edgeRows[edgeKeep]]
+    cols = innerIndex[colInds[edgeKeep]]
+    edgeRates = rates[edgeKeep]
+
+    # the escape rates go on the diagonal
+    escape = np.bincount(rows, weights=edgeRates, minlength=innerStates.shape[0])
+
+    # jumps into the outer shell only appear in the escape rates
+    inner = cols != -1
+    Ninner = innerStates.shape[0]
+    minusG = sparse.coo_matrix((-edgeRates[inner], (rows[inner], cols[inner])), shape=(Ninner, Ninner)) \
+        + sparse.diags(escape)
+    # duplicate entries (several jumps into the same state) are summed here
+    return minusG.tocsr(), innerStates, edgeRows, edgeKeep
+
+
+def pinGauge(minusG, row):
+    """
+    Make the singular -G of a closed network (reflecting boundary) non-singular by replacing one of its rows with
+    that of the identity, which fixes the relaxation vector to zero at that state. Since the rows of -G sum to zero
+    with the weights pi, the replaced row follows from the others (for a right hand side with pi.b = 0), so the
+    solution is still one of -G eta = b - the other solutions differ from it by a constant. The right hand side must
+    be zero at the pinned row.
+    :return: the pinned matrix (CSR).
+    """
+    A = minusG.tolil()
+    A.rows[row] = [row]
+    A.data[row] = [1.]
+    return A.tocsr()
+
+
+def solveShellTransport(depth, indptr, colInds, rates, jumpInds, energies, dxList, beta, Nshells,
+                        boundary="dirichlet", method="cg", tol=1e-10, maxiter=None, sitePerms=None, symTol=1e-8):
+    """
+    Function to get the vacancy Onsager coefficient of a finite shell network with sparse iterative solvers, so that
+    memory only goes as the number of transitions.
+    :param depth, indptr, colInds, rates, jumpInds, energies: shell network from MC_JIT.makeShellsJit. The network must
+    be built without symmetry reduction: in a reduced network the jump vectors of a state refer to whichever rotated
+    image of it was reached first, and the states would need multiplicity weights, so the vector relaxation problem
+    is not defined on it.
+    :param dxList: the displacements of the vacancy jumps.
+    :param beta: inverse temperature the rates were computed at.
+    :param Nshells: the number of shells the network was built with.
+    :param boundary: treatment of the outermost shell - see makeShellRateMatrix.
+    :param method: "cg" - conjugate gradients on the symmetrized matrix with a Jacobi preconditioner. If the
+                         symmetrized matrix is not symmetric to within symTol (relative to its largest entry) -
+                         detailed balance does not hold in the network, e.g. because the pi weights are wrong - a
+                         warning is given and GMRES is used instead.
+                   "gmres" - GMRES on -G with an incomplete LU preconditioner. With the reflecting boundary, the
+                         relaxation vector is pinned at the most probable state first (see pinGauge), since the
+                         incomplete LU of the singular -G is not usable.
+    :param tol: relative tolerance of the iterative solver.
+    :param maxiter: maximum number of iterations of the iterative solver.
+    :param sitePerms: the site permutations that the network was built with (as passed to makeShellsJit). If given,
+    networks reduced by more than the identity are rejected with a ValueError.
+    :param symTol: tolerance of the symmetry check done before using conjugate gradients.
+    :return: L - (3x3) the Onsager coefficient (averaged over the inner states with Boltzmann weights).
+             L0 - (3x3) its uncorrelated part.
+             eta - (Ninner x 3) the relaxation vector on the inner states.
+             innerStates - the indices (in the network) of the inner states.
+    """
+    if method not in ("cg", "gmres"):
+        raise ValueError("method must be either 'cg' or 'gmres'")
+    if sitePerms is not None and np.asarray(sitePerms).shape[0] > 1:
+        raise ValueError("The shell network must be built without symmetry reduction (pass only the identity "
+                         "permutation to makeShellsJit) - the jump vectors of a reduced network refer to different "
+                         "rotated images of its states")
+
+    minusG, innerStates, edgeRows, edgeKeep = makeShellRateMatrix(depth, indptr, colInds, rates, jumpInds, Nshells,
+                                                                  boundary=boundary)
+    Ninner = innerStates.shape[0]
+
+    # stationary probabilities of the inner states
+    En = energies[innerStates]
+    pi = np.exp(-beta * (En - np.min(En)))
+    pi /= np.sum(pi)
+
+    innerIndex = np.full(depth.shape[0], -1, dtype=int)
+    innerIndex[innerStates] = np.arange(Ninner)
+    rows = innerIndex[edgeRows[edgeKeep]]
+    edgeRates = rates[edgeKeep]
+    dx = dxList[jumpInds[edgeKeep]]
+
+    vel = np.zeros((Ninner, 3))
+    np.add.at(vel, rows, edgeRates[:, None] * dx)
+
+    L0 = 0.5 * np.einsum("e,ei,ej->ij", pi[rows] * edgeRates, dx, dx)
+
+    sqrtPi = np.sqrt(pi)
+    eta = np.zeros((Ninner, 3))
+    if method == "cg":
+        # S (-G) S^-1 with S = sqrt(pi) is symmetric by detailed balance
+        A = sparse.diags(sqrtPi) @ minusG @ sparse.diags(1. / sqrtPi)
+        asym = abs(A - A.T).max() if A.nnz > 0 else 0.
+        if asym > symTol * max(abs(A).max(), 1e-300):
+            warnings.warn("The shell rate matrix does not satisfy detailed balance with the Boltzmann weights of the "
+                          "states (asymmetry {:.3e}) - solving with GMRES instead of conjugate "
+                          "gradients".format(asym))
+            method = "gmres"
+    if method == "cg":
+        A = 0.5 * (A + A.T)
+        diag = A.diagonal()
+        precond = sparse.diags(1. / np.where(diag > 0, diag, 1.))
+        for i in range(3):
+            b = sqrtPi * vel[:, i]
+            if boundary == "reflecting":
+                # -G is singular for a closed network - remove the stationary part of the right hand side
+                b = b - np.dot(b, sqrtPi) * sqrtPi
+            z, info = splinalg.cg(A, b, rtol=tol, atol=0., maxiter=maxiter, M=precond)
+            if info != 0:
+                raise RuntimeError("conjugate gradients did not converge (info = {})".format(info))
+            if boundary == "reflecting":
+                z = z - np.dot(z, sqrtPi) * sqrtPi
+            eta[:, i] = z / sqrtPi
+    else:
+        M = minusG
+        pinRow = np.argmax(pi)
+        if boundary == "reflecting":
+            M = pinGauge(minusG, pinRow)
+        ilu = splinalg.spilu(M.tocsc())
+        precond = splinalg.LinearOperator(M.shape, ilu.solve)
+        for i in range(3):
+            b = vel[:, i].copy()
+            if boundary == "reflecting":
+                b = b - np.dot(pi, b)
+                b[pinRow] = 0.
+            sol, info = splinalg.gmres(M, b, rtol=tol, atol=0., maxiter=maxiter, M=precond)
+            if info != 0:
+                raise RuntimeError("GMRES did not converge (info = {})".format(info))
+            if boundary == "reflecting":
+                sol = sol - np.dot(pi, sol)
+            eta[:, i] = sol
+
+    L = L0 - np.einsum("s,si,sj->ij", pi, vel, eta)
+
+    return L, L0, eta, innerStates
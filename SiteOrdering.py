@@ -0,0 +1,155 @@
+"""
+Locality-preserving renumbering of the supercell sites and of the interactions.
+The site indices of the supercell come in the order of sup.index, and the interactions are numbered in the order in
+which makeJitInteractionsData first meets them, so the off site counts updated by one swap are scattered across
+memory. Here the sites are renumbered along a space-filling curve (Morton or Hilbert) over their unit cell
+positions, so that sites close in the lattice get close indices, and the interactions are sorted by their anchor
+site (the smallest new index among their sites), so that the interactions around a site sit together in the arrays.
+The tables are given and returned as dictionaries keyed by the names in SharedTables.KMCTableNames (and so can be
+passed to SharedTables.publish, SharedTables.makeKMC or SharedTables.makeMCSampler directly). States, off site counts
+and site indices are translated in and out of the new order with the functions at the end.
+"""
+import numpy as np
+
+
+def mortonIndex(R, bits):
+    """
+    :param R: the three integer coordinates of a unit cell.
+    :param bits: the number of bits in each coordinate.
+    :return: the position of R along the Morton (Z-order) curve - the interleaved bits of its coordinates.
+    """
+    h = 0
+    for b in range(bits - 1, -1, -1):
+        for i in range(3):
+            h = (h << 1) | ((int(R[i]) >> b) & 1)
+    return h
+
+
+def hilbertIndex(R, bits):
+    """
+    :param R: the three integer coordinates of a unit cell.
+    :param bits: the number of bits in each coordinate.
+    :return: the position of R along the Hilbert curve (Skilling's transpose algorithm).
+    """
+    X = [int(x) for x in R]
+    M = 1 << (bits - 1)
+    # inverse undo of the excess work
+    Q = M
+    while Q > 1:
+        P = Q - 1
+        for i in range(3):
+            if X[i] & Q:
+                X[0] ^= P
+            else:
+                t = (X[0] ^ X[i]) & P
+                X[0] ^= t
+                X[i] ^= t
+        Q >>= 1
+    # Gray encode
+    for i in range(1, 3):
+        X[i] ^= X[i - 1]
+    t = 0
+    Q = M
+    while Q > 1:
+        if X[2] & Q:
+            t ^= Q - 1
+        Q >>= 1
+    for i in range(3):
+        X[i] ^= t
+    return mortonIndex(X, bits)
+
+
+def makeSiteOrder(siteIndtoR, curve="hilbert"):
+    """
+    Renumber the sites along a space-filling curve.
+    :param siteIndtoR: (Nsites x 3) the unit cell position of each site.
+    :param curve: "hilbert" or "morton".
+    :return: siteOrder - (Nsites) siteOrder[new] is the old index of the site with the new index new.
+             siteNew - (Nsites) the inverse - siteNew[old] is the new index of site old.
+    """
+    if curve == "hilbert":
+        curveIndex = hilbertIndex
+    elif curve == "morton":
+        curveIndex = mortonIndex
+    else:
+        raise ValueError("Unknown curve {} - use \"hilbert\" or \"morton\"".format(curve))
+    bits = max(1, int(np.max(siteIndtoR)).bit_length())
+    keys = [curveIndex(R, bits) for R in siteIndtoR]
+    siteOrder = np.array(sorted(range(len(keys)), key=lambda siteInd: keys[siteInd]), dtype=int)
+    siteNew = np.zeros_like(siteOrder)
+    siteNew[siteOrder] = np.arange(len(siteOrder))
+    return siteOrder, siteNew
+
+
+def reorderTables(tables, siteOrder, siteNew, vacSiteInd):
+    """
+    Renumber the sites of the interaction tables, and sort the interactions by their anchor sites.
+    :param tables: dictionary of the arrays in SharedTables.KMCTableNames.
+    :param siteOrder, siteNew: the new order of the sites (see makeSiteOrder).
+    :param vacSiteInd: the (old) index of the vacancy site.
+    :return: newTables - dictionary of the renumbered arrays.
+             interactOrder - (Ninteracts) interactOrder[new] is the old index of the interaction with the new index
+             new.
+             vacSiteIndNew - the new index of the vacancy site.
+    """
+    numSitesInteracts = tables["numSitesInteracts"]
+    SupSitesInteracts = tables["SupSitesInteracts"]
+    Nsites = siteOrder.shape[0]
+
+    # renumber the sites of the interactions, and find their anchors
+    SupSitesNew = np.where(SupSitesInteracts >= 0, siteNew[SupSitesInteracts], -1)
+    anchors = np.array([np.min(SupSitesNew[interactIdx, :numSitesInteracts[interactIdx]])
+                        for interactIdx in range(numSitesInteracts.shape[0])], dtype=int)
+    interactOrder = np.argsort(anchors, kind="stable")
+    interactNew = np.zeros_like(interactOrder)
+    interactNew[interactOrder] = np.arange(len(interactOrder))
+
+    newTables = dict(tables)
+    newTables["SupSitesInteracts"] = SupSitesNew[interactOrder]
+    for name in ["numSitesInteracts", "SpecOnInteractSites", "Interaction2En", "numVecsInteracts", "VecsInteracts",
+                 "VecGroupInteracts"]:
+        newTables[name] = tables[name][interactOrder]
+
+    # the interactions of each site, renumbered and sorted
+    numInteractsSiteSpec = tables["numInteractsSiteSpec"][siteOrder]
+    SiteSpecInterArray = tables["SiteSpecInterArray"][siteOrder]
+    SiteSpecInterArray = np.where(SiteSpecInterArray >= 0, interactNew[SiteSpecInterArray], -1)
+    for siteInd in range(Nsites):
+        for spec in range(numInteractsSiteSpec.shape[1]):
+            n = numInteractsSiteSpec[siteInd, spec]
+            SiteSpecInterArray[siteInd, spec, :n] = np.sort(SiteSpecInterArray[siteInd, spec, :n])
+    newTables["numInteractsSiteSpec"] = numInteractsSiteSpec
+    newTables["SiteSpecInterArray"] = SiteSpecInterArray
+
+    # the transition state interactions keep their numbering - only their sites are renumbered
+    TSInteractSites = tables["TSInteractSites"]
+    newTables["TSInteractSites"] = np.where(TSInteractSites >= 0, siteNew[TSInteractSites], -1)
+    jumpFinSites = tables["jumpFinSites"]
+    newTables["jumpFinSites"] = np.where(jumpFinSites >= 0, siteNew[jumpFinSites], -1)
+    newTables["FinSiteFinSpecJumpInd"] = tables["FinSiteFinSpecJumpInd"][siteOrder]
+
+    newTables["siteIndtoR"] = tables["siteIndtoR"][siteOrder]
+    newTables["RtoSiteInd"] = siteNew[tables["RtoSiteInd"]]
+
+    return newTables, interactOrder, siteNew[vacSiteInd]
+
+
+def stateToNew(state, siteOrder):
+    """
+    :return: the state in the new site order.
+    """
+    return state[siteOrder]
+
+
+def stateToOld(stateNew, siteNew):
+    """
+    :return: the state in the original site order.
+    """
+    return stateNew[siteNew]
+
+
+def offSiteCountToNew(OffSiteCount, interactOrder):
+    """
+    :return: the off site counts in the new interaction order.
+    """
+    return OffSiteCount[interactOrder]
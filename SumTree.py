@@ -0,0 +1,73 @@
+"""
+Binary sum tree over a fixed number of non-negative rates, for KMC event catalogs where a move only changes a few
+rates. Updating a rate and selecting an event with probability proportional to its rate both take O(log N) time.
+
+The tree is stored in a flat array of size 2*capacity (capacity being a power of two), with the root at index 1,
+the children of node k at 2k and 2k+1, and the rate of event i stored in the leaf at capacity + i.
+"""
+import numpy as np
+from numba import jit, float64
+
+
+@jit(nopython=True)
+def makeSumTree(rates):
+    """
+    Function to build a sum tree over an array of rates.
+    :param rates: array of non-negative rates of the events.
+    :return: tree - flat array of the partial sums (see module docstring).
+    """
+    capacity = 1
+    while capacity < rates.shape[0]:
+        capacity *= 2
+    tree = np.zeros(2 * capacity, dtype=float64)
+    tree[capacity:capacity + rates.shape[0]] = rates
+    for node in range(capacity - 1, 0, -1):
+        tree[node] = tree[2 * node] + tree[2 * node + 1]
+    return tree
+
+
+@jit(nopython=True)
+def sumTreeUpdate(tree, event, rate):
+    """
+    Function to change the rate of an event, and update the partial sums above it.
+    The partial sums are recomputed from the children instead of being shifted by the change, so that round off
+    errors do not build up over many updates.
+    :param tree: the sum tree (see makeSumTree)
+    :param event: index of the event to update
+    :param rate: the new rate of the event
+    """
+    node = tree.shape[0] // 2 + event
+    tree[node] = rate
+    node //= 2
+    while node > 0:
+        tree[node] = tree[2 * node] + tree[2 * node + 1]
+        node //= 2
+
+
+@jit(nopython=True)
+def sumTreeTotal(tree):
+    """
+    :return: the sum of the rates of all the events in the tree.
+    """
+    return tree[1]
+
+
+@jit(nopython=True)
+def sumTreeSelect(tree, r):
+    """
+    Function to find the event at which the cumulative rate (in order of event index) first exceeds r.
+    :param tree: the sum tree (see makeSumTree)
+    :param r: float in [0, total rate)
+    :return: index of the selected event. Events with zero rate are never selected if the total rate is non-zero,
+    even if r is pushed up to the total by round off.
+    """
+    capacity = tree.shape[0] // 2
+    node = 1
+    while node < capacity:
+        left = 2 * node
+        if r < tree[left] or tree[left + 1] <= 0.:
+            node = left
+        else:
+            r -= tree[left]
+            node = left + 1
+    return node - capacity
@@ -0,0 +1,98 @@
+"""
+Per-atom identity tracking for vacancy mediated KMC, to get tracer diffusion and correlation factors online.
+"""
+import numpy as np
+from numba import int64, float64
+from numba.experimental import jitclass
+
+TracerTrackerSpec = [
+    ("NSpec", int64),
+    ("atomID", int64[:]),
+    ("atomSpec", int64[:]),
+    ("R", float64[:, :]),
+    ("Njumps", int64[:]),
+    ("sumR2", float64[:]),
+    ("sumJumpSq", float64[:]),
+    ("atomCount", float64[:]),
+]
+
+
+@jitclass(TracerTrackerSpec)
+class TracerTracker(object):
+    """
+    Tracker of the identity and displacement of every atom in a supercell. Each atom is given an ID, and an array of
+    atom IDs on the sites is swapped alongside the occupancy at every jump. The sums of squared displacements and
+    squared jump lengths of each species are updated at every jump, so that the tracer mean squared displacements
+    and correlation factors are available at any time without storing the trajectory.
+    Vacancies (species NSpec-1) are not tracked.
+    """
+
+    def __init__(self, state, NSpec):
+        """
+        :param state: the starting state - atoms are numbered in the order of the sites they occupy.
+        :param NSpec: the number of species (including the vacancy).
+        """
+        self.NSpec = NSpec
+        self.atomID = np.full(state.shape[0], -1, dtype=int64)
+        Natoms = 0
+        for site in range(state.shape[0]):
+            if state[site] != NSpec - 1:
+                self.atomID[site] = Natoms
+                Natoms += 1
+        self.atomSpec = np.zeros(Natoms, dtype=int64)
+        self.atomCount = np.zeros(NSpec, dtype=float64)
+        for site in range(state.shape[0]):
+            if self.atomID[site] != -1:
+                self.atomSpec[self.atomID[site]] = state[site]
+                self.atomCount[state[site]] += 1.
+        self.R = np.zeros((Natoms, 3), dtype=float64)
+        self.Njumps = np.zeros(Natoms, dtype=int64)
+        self.sumR2 = np.zeros(NSpec, dtype=float64)
+        self.sumJumpSq = np.zeros(NSpec, dtype=float64)
+
+    def recordExchange(self, vacSite, siteB, dx):
+        """
+        Record a vacancy jump from vacSite to siteB, with the atom at siteB moving into vacSite.
+        :param vacSite: the site of the vacancy before the jump.
+        :param siteB: the site the vacancy jumps to.
+        :param dx: the displacement of the vacancy (the atom moves by -dx).
+        """
+        atom = self.atomID[siteB]
+        if atom == -1:
+            return
+        spec = self.atomSpec[atom]
+        dxSq = 0.
+        Rdx = 0.
+        for dim in range(3):
+            dxSq += dx[dim] * dx[dim]
+            Rdx += self.R[atom, dim] * dx[dim]
+            self.R[atom, dim] -= dx[dim]
+        # |R - dx|^2 - |R|^2
+        self.sumR2[spec] += dxSq - 2. * Rdx
+        self.sumJumpSq[spec] += dxSq
+        self.Njumps[atom] += 1
+        self.atomID[siteB] = self.atomID[vacSite]
+        self.atomID[vacSite] = atom
+
+    def getTracerMSD(self):
+        """
+        :return: (NSpec-size array) the mean squared displacement of the atoms of each species (zero for species
+        with no atoms, including the vacancy).
+        """
+        msd = np.zeros(self.NSpec)
+        for spec in range(self.NSpec):
+            if self.atomCount[spec] > 0:
+                msd[spec] = self.sumR2[spec] / self.atomCount[spec]
+        return msd
+
+    def getCorrelationFactor(self):
+        """
+        :return: (NSpec-size array) the tracer correlation factor of each species - the sum of the squared
+        displacements of its atoms divided by the sum of their squared jump lengths (zero for species that did not
+        move).
+        """
+        f = np.zeros(self.NSpec)
+        for spec in range(self.NSpec):
+            if self.sumJumpSq[spec] > 0:
+                f[spec] = self.sumR2[spec] / self.sumJumpSq[spec]
+        return f
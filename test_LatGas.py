@@ -1,7 +1,23 @@
 from onsager import crystal, supercell, cluster
 import numpy as np
 import LatGas
+import CounterRNG
+import SumTree
+import Tracer
+import CompactTraj
+import SampleStore
 import unittest
+import numba
+import tempfile
+import os
+from numba import jit
+
+
+@jit(nopython=True)
+def seedJit(seed):
+    # seed numba's random number generator
+    np.random.seed(seed)
+
 
 class Test_latGasKMC(unittest.TestCase):
 
@@ -186,3 +202,611 @@ class Test_latGasKMC(unittest.TestCase):
         self.assertEqual(state[RtoSiteInd[dxRunR[0], dxRunR[1], dxRunR[2]]], self.NSpec-1)
 
         print("finished testing steps")
+
+    def test_NeighborTable(self):
+        N_unit = self.N_units
+        SpecRates = np.array(range(1, self.NSpec), dtype=float)
+        nbrTable = LatGas.makeNeighborTable(self.ijList, self.vacsiteInd, N_unit, self.siteIndtoR, self.RtoSiteInd)
+        self.assertEqual(nbrTable.shape, (self.siteIndtoR.shape[0], self.ijList.shape[0]))
+        self.assertTrue(np.array_equal(nbrTable[self.vacsiteInd], self.ijList))
+        for site in range(nbrTable.shape[0]):
+            for jmp in range(self.ijList.shape[0]):
+                Rfin = (self.siteIndtoR[site] + self.dxtoR[jmp]) % N_unit
+                self.assertEqual(nbrTable[site, jmp], self.RtoSiteInd[Rfin[0], Rfin[1], Rfin[2]])
+
+        # Without species selection, the trajectory must be the same as that from LatGasKMCTraj
+        Nsteps = 200
+        state1 = self.initState.copy()
+        seedJit(7)
+        X_steps, t_steps, jmpSelectSteps, jmpFinSiteList = \
+            LatGas.LatGasKMCTraj(state1, SpecRates, Nsteps, self.ijList.copy(), self.dxList, self.vacsiteInd, N_unit,
+                                 self.siteIndtoR, self.RtoSiteInd)
+        state2 = self.initState.copy()
+        seedJit(7)
+        X_steps2, t_steps2, jmpSelectSteps2, jmpFinSiteList2 = \
+            LatGas.LatGasKMCTrajTable(state2, SpecRates, Nsteps, nbrTable, self.dxList, self.vacsiteInd, False)
+        self.assertTrue(np.array_equal(jmpSelectSteps, jmpSelectSteps2))
+        self.assertTrue(np.allclose(X_steps, X_steps2))
+        self.assertTrue(np.allclose(t_steps, t_steps2))
+        self.assertTrue(np.array_equal(state1, state2))
+        self.assertTrue(np.array_equal(jmpFinSiteList, jmpFinSiteList2))
+
+        # With species selection, replay the selected jumps and check the displacements and times
+        state3 = self.initState.copy()
+        X_steps3, t_steps3, jmpSelectSteps3, jmpFinSiteList3 = \
+            LatGas.LatGasKMCTrajTable(state3, SpecRates, Nsteps, nbrTable, self.dxList, self.vacsiteInd, True)
+        state0 = self.initState.copy()
+        vacNow = self.vacsiteInd
+        X = np.zeros((self.NSpec, 3))
+        t = 0.
+        for step in range(Nsteps):
+            t += 1. / np.sum(SpecRates[state0[nbrTable[vacNow]]])
+            jmp = jmpSelectSteps3[step]
+            siteB = nbrTable[vacNow, jmp]
+            specB = state0[siteB]
+            X[self.NSpec - 1] += self.dxList[jmp]
+            X[specB] -= self.dxList[jmp]
+            state0[siteB] = self.NSpec - 1
+            state0[vacNow] = specB
+            vacNow = siteB
+            self.assertTrue(np.allclose(X, X_steps3[step]))
+            self.assertAlmostEqual(t, t_steps3[step])
+        self.assertTrue(np.array_equal(state0, state3))
+        self.assertTrue(np.array_equal(jmpFinSiteList3, nbrTable[vacNow]))
+
+        # The jumps must be selected with probabilities proportional to their rates
+        Ntrials = 20000
+        counts = np.zeros(self.ijList.shape[0])
+        for trial in range(Ntrials):
+            state = self.initState.copy()
+            _, _, jmpSelect, _ = LatGas.LatGasKMCTrajTable(state, SpecRates, 1, nbrTable, self.dxList,
+                                                           self.vacsiteInd, True)
+            counts[jmpSelect[0]] += 1
+        probs = SpecRates[self.initState[self.ijList]]
+        probs /= np.sum(probs)
+        self.assertTrue(np.all(np.abs(counts / Ntrials - probs) < 5 * np.sqrt(probs / Ntrials) + 1e-3))
+
+    def test_SumTree(self):
+        rates = np.random.rand(13)
+        rates[[2, 12]] = 0.
+        tree = SumTree.makeSumTree(rates)
+        self.assertAlmostEqual(SumTree.sumTreeTotal(tree), np.sum(rates))
+        for trial in range(200):
+            ind = np.random.randint(rates.shape[0])
+            rates[ind] = 0. if trial % 5 == 0 else np.random.rand()
+            SumTree.sumTreeUpdate(tree, ind, rates[ind])
+            self.assertAlmostEqual(SumTree.sumTreeTotal(tree), np.sum(rates))
+            r = np.random.rand() * np.sum(rates)
+            self.assertEqual(SumTree.sumTreeSelect(tree, r), np.searchsorted(np.cumsum(rates), r, side="right"))
+        # the last event with a non-zero rate is selected even if r is pushed up to the total
+        last = np.where(rates > 0)[0][-1]
+        self.assertEqual(SumTree.sumTreeSelect(tree, SumTree.sumTreeTotal(tree)), last)
+
+    def test_MultiVacTraj(self):
+        N_unit = self.N_units
+        SpecRates = np.array(range(1, self.NSpec), dtype=float)
+        nbrTable = LatGas.makeNeighborTable(self.ijList, self.vacsiteInd, N_unit, self.siteIndtoR, self.RtoSiteInd)
+        revJumps = LatGas.makeReverseJumps(self.dxList)
+        for jmp in range(self.dxList.shape[0]):
+            self.assertTrue(np.allclose(self.dxList[revJumps[jmp]], -self.dxList[jmp]))
+            self.assertEqual(nbrTable[self.ijList[jmp], revJumps[jmp]], self.vacsiteInd)
+
+        # With a single vacancy, the trajectory must be the same as with the neighbor table
+        Nsteps = 200
+        state1 = self.initState.copy()
+        seedJit(11)
+        X_steps, t_steps, jmpSelectSteps, _ = \
+            LatGas.LatGasKMCTrajTable(state1, SpecRates, Nsteps, nbrTable, self.dxList, self.vacsiteInd, False)
+        state2 = self.initState.copy()
+        seedJit(11)
+        X_steps2, t_steps2, eventSteps, vacSites = LatGas.LatGasMultiVacKMCTraj(state2, SpecRates, Nsteps, nbrTable,
+                                                                                self.dxList)
+        self.assertTrue(np.array_equal(jmpSelectSteps, eventSteps))
+        self.assertTrue(np.allclose(X_steps, X_steps2))
+        self.assertTrue(np.allclose(t_steps, t_steps2))
+        self.assertTrue(np.array_equal(state1, state2))
+
+        # With many vacancies, replay the events and check the rates against a full recomputation
+        state = self.initState.copy()
+        vacSitesInit = np.random.choice(state.shape[0], 40, replace=False)
+        state[vacSitesInit] = self.NSpec - 1
+        # make sure some vacancies are next to each other
+        state[nbrTable[vacSitesInit[0], :2]] = self.NSpec - 1
+        state0 = state.copy()
+        vacSites0 = np.where(state0 == self.NSpec - 1)[0]
+        z = nbrTable.shape[1]
+
+        X_steps, t_steps, eventSteps, vacSites = LatGas.LatGasMultiVacKMCTraj(state, SpecRates, Nsteps, nbrTable,
+                                                                              self.dxList)
+        X = np.zeros((self.NSpec, 3))
+        t = 0.
+        for step in range(Nsteps):
+            rateTot = 0.
+            for site in vacSites0:
+                for nbr in nbrTable[site]:
+                    if state0[nbr] != self.NSpec - 1:
+                        rateTot += SpecRates[state0[nbr]]
+            t += 1. / rateTot
+            self.assertAlmostEqual(t, t_steps[step])
+            vacInd, jmp = eventSteps[step] // z, eventSteps[step] % z
+            siteA = vacSites0[vacInd]
+            siteB = nbrTable[siteA, jmp]
+            specB = state0[siteB]
+            # vacancies must never exchange with each other
+            self.assertNotEqual(specB, self.NSpec - 1)
+            X[self.NSpec - 1] += self.dxList[jmp]
+            X[specB] -= self.dxList[jmp]
+            self.assertTrue(np.allclose(X, X_steps[step]))
+            state0[siteA], state0[siteB] = specB, self.NSpec - 1
+            vacSites0[vacInd] = siteB
+        self.assertTrue(np.array_equal(state0, state))
+        self.assertTrue(np.array_equal(vacSites0, vacSites))
+
+    def test_SLKMC(self):
+        N_unit = self.N_units
+        SpecRates = np.ones(self.NSpec - 1)
+        nbrTable = LatGas.makeNeighborTable(self.ijList, self.vacsiteInd, N_unit, self.siteIndtoR, self.RtoSiteInd)
+        z = nbrTable.shape[1]
+
+        state = self.initState.copy()
+        state[state == self.NSpec - 1] = 0
+        Nvac = 10
+        state[np.random.choice(state.shape[0], Nvac, replace=False)] = self.NSpec - 1
+        state0 = state.copy()
+
+        tWindow = 0.02
+        Nwindows = 2000
+        numba.set_num_threads(1)
+        X_windows, t_windows, jumpCounts = LatGas.LatGasSLKMC(state, SpecRates, nbrTable, self.dxList, N_unit,
+                                                              self.siteIndtoR, 4, tWindow, Nwindows, 5)
+        numba.set_num_threads(numba.config.NUMBA_NUM_THREADS)
+        state2 = state0.copy()
+        X_windows2, t_windows2, jumpCounts2 = LatGas.LatGasSLKMC(state2, SpecRates, nbrTable, self.dxList, N_unit,
+                                                                 self.siteIndtoR, 4, tWindow, Nwindows, 5)
+        # the results must not depend on the number of threads
+        self.assertTrue(np.array_equal(state, state2))
+        self.assertTrue(np.allclose(X_windows, X_windows2))
+        self.assertTrue(np.array_equal(jumpCounts, jumpCounts2))
+
+        self.assertTrue(np.allclose(t_windows, tWindow * np.arange(1, Nwindows + 1)))
+        for spec in range(self.NSpec):
+            self.assertEqual(np.sum(state == spec), np.sum(state0 == spec))
+        self.assertTrue(np.allclose(np.sum(X_windows, axis=1), 0.))
+
+        # Every jump of the vacancies has unit rate, so the number of jumps should be close to Nvac * z * t
+        NjumpsExpected = Nvac * z * t_windows[-1]
+        self.assertTrue(abs(np.sum(jumpCounts) - NjumpsExpected) < 0.1 * NjumpsExpected)
+
+        with self.assertRaises(ValueError):
+            LatGas.LatGasSLKMC(state0.copy(), SpecRates, nbrTable, self.dxList, N_unit, self.siteIndtoR, 8, tWindow,
+                               1, 5)
+        with self.assertRaises(ValueError):
+            LatGas.LatGasSLKMC(state0.copy(), SpecRates, nbrTable, self.dxList, N_unit, self.siteIndtoR, 1, tWindow,
+                               1, 5)
+
+    def test_SLKMCSerial(self):
+        # the statistics of the sublattice parallel runs must agree with those of the exact serial KMC
+        N_unit = self.N_units
+        SpecRates = np.array(range(1, self.NSpec), dtype=float)
+        nbrTable = LatGas.makeNeighborTable(self.ijList, self.vacsiteInd, N_unit, self.siteIndtoR, self.RtoSiteInd)
+
+        state0 = self.initState.copy()
+        state0[state0 == self.NSpec - 1] = 0
+        state0[np.random.choice(state0.shape[0], 12, replace=False)] = self.NSpec - 1
+
+        tWindow = 0.005
+        state = state0.copy()
+        X_windows, t_windows, jumpCounts = LatGas.LatGasSLKMC(state, SpecRates, nbrTable, self.dxList, N_unit,
+                                                              self.siteIndtoR, 4, tWindow, 40000, 5)
+        state2 = state0.copy()
+        seedJit(5)
+        X_steps, t_steps, eventSteps, vacSites = LatGas.LatGasMultiVacKMCTraj(state2, SpecRates, np.sum(jumpCounts),
+                                                                              nbrTable, self.dxList)
+
+        # the jump rates
+        rateSL = np.sum(jumpCounts) / t_windows[-1]
+        rateSerial = t_steps.shape[0] / t_steps[-1]
+        self.assertLess(abs(rateSL - rateSerial), 0.04 * rateSerial)
+
+        # the mean squared displacements of the species over blocks of time T
+        T = 0.5
+        tBlocks = np.arange(T, min(t_windows[-1], t_steps[-1]), T)
+        XBlocksSL = X_windows[np.searchsorted(t_windows, tBlocks, side="right") - 1]
+        XBlocksSerial = X_steps[np.searchsorted(t_steps, tBlocks, side="right") - 1]
+        for spec in range(self.NSpec):
+            msdSL = np.mean(np.sum(np.diff(XBlocksSL[:, spec, :], axis=0) ** 2, axis=1))
+            msdSerial = np.mean(np.sum(np.diff(XBlocksSerial[:, spec, :], axis=0) ** 2, axis=1))
+            self.assertLess(abs(msdSL - msdSerial), 0.25 * msdSerial)
+
+    def test_Tracer(self):
+        N_unit = self.N_units
+        SpecRates = np.array(range(1, self.NSpec), dtype=float)
+        nbrTable = LatGas.makeNeighborTable(self.ijList, self.vacsiteInd, N_unit, self.siteIndtoR, self.RtoSiteInd)
+
+        state = self.initState.copy()
+        state[np.random.choice(state.shape[0], 5, replace=False)] = self.NSpec - 1
+        state0 = state.copy()
+        tracker = Tracer.TracerTracker(state, self.NSpec)
+        # the tracker must not change the trajectory
+        seedJit(3)
+        X_steps, t_steps, eventSteps, vacSites = LatGas.LatGasMultiVacKMCTraj(state, SpecRates, 500, nbrTable,
+                                                                              self.dxList, tracker)
+        state2 = state0.copy()
+        seedJit(3)
+        X_steps2, t_steps2, eventSteps2, vacSites2 = LatGas.LatGasMultiVacKMCTraj(state2, SpecRates, 500, nbrTable,
+                                                                                  self.dxList)
+        self.assertTrue(np.array_equal(eventSteps, eventSteps2))
+
+        # the atoms must be where the state says they are
+        for site in range(state.shape[0]):
+            if state[site] == self.NSpec - 1:
+                self.assertEqual(tracker.atomID[site], -1)
+            else:
+                self.assertEqual(tracker.atomSpec[tracker.atomID[site]], state[site])
+
+        msd = np.zeros(self.NSpec)
+        jumpSq = np.zeros(self.NSpec)
+        for spec in range(self.NSpec - 1):
+            atoms = tracker.atomSpec == spec
+            # the atom displacements must add up to the species displacement
+            self.assertTrue(np.allclose(np.sum(tracker.R[atoms], axis=0), X_steps[-1, spec]))
+            msd[spec] = np.mean(np.sum(tracker.R[atoms] ** 2, axis=1))
+            jumpSq[spec] = np.sum(tracker.Njumps[atoms]) * np.dot(self.dxList[0], self.dxList[0])
+        self.assertEqual(np.sum(tracker.Njumps), 500)
+        self.assertTrue(np.allclose(tracker.getTracerMSD(), msd))
+        f = np.zeros(self.NSpec)
+        f[jumpSq > 0] = msd[jumpSq > 0] * np.bincount(tracker.atomSpec, minlength=self.NSpec)[jumpSq > 0] / \
+                        jumpSq[jumpSq > 0]
+        self.assertTrue(np.allclose(tracker.getCorrelationFactor(), f))
+
+        # The tracer correlation factor for a single vacancy in a bcc lattice is 0.727 (the estimate from a single
+        # vacancy in a small supercell is noisy, hence the loose tolerance)
+        state = np.zeros_like(self.initState)
+        state[self.vacsiteInd] = self.NSpec - 1
+        tracker = Tracer.TracerTracker(state, self.NSpec)
+        seedJit(0)
+        LatGas.LatGasKMCTrajTable(state, SpecRates, 200000, nbrTable, self.dxList, self.vacsiteInd, True, tracker)
+        self.assertAlmostEqual(tracker.getCorrelationFactor()[0], 0.727, delta=0.1)
+
+    def test_CompactTraj(self):
+        N_unit = self.N_units
+        SpecRates = np.array(range(1, self.NSpec), dtype=float)
+        nbrTable = LatGas.makeNeighborTable(self.ijList, self.vacsiteInd, N_unit, self.siteIndtoR, self.RtoSiteInd)
+
+        Nsteps = 2550
+        state = self.initState.copy()
+        X_steps, t_steps, jmpSelectSteps, jmpFinSiteList = LatGas.LatGasKMCTrajTable(state, SpecRates, Nsteps,
+                                                                                     nbrTable, self.dxList,
+                                                                                     self.vacsiteInd, True)
+        with tempfile.TemporaryDirectory() as tmpDir:
+            with self.assertRaises(ValueError):
+                CompactTraj.CompactTrajWriter(tmpDir, self.initState, self.vacsiteInd, nbrTable, self.dxList,
+                                              self.NSpec, keyframeInterval=300, chunkSteps=1000)
+
+            writer = CompactTraj.CompactTrajWriter(tmpDir, self.initState, self.vacsiteInd, nbrTable, self.dxList,
+                                                   self.NSpec, keyframeInterval=100, chunkSteps=1000)
+            # feed the steps in uneven pieces
+            for start, stop in [(0, 37), (37, 1000), (1000, 1999), (1999, Nsteps)]:
+                writer.addSteps(jmpSelectSteps[start:stop], t_steps[start:stop])
+            writer.close()
+            self.assertEqual(len([fl for fl in os.listdir(tmpDir) if fl.startswith("chunk")]), 3)
+
+            reader = CompactTraj.CompactTrajReader(tmpDir)
+            self.assertEqual(reader.Nsteps, Nsteps)
+            self.assertTrue(np.allclose(reader.getX(0), 0.))
+            self.assertTrue(np.array_equal(reader.getState(0), self.initState))
+            for n in [1, 99, 100, 101, 999, 1000, 1001, 2000, 2549, Nsteps] + list(np.random.randint(1, Nsteps, 20)):
+                stateN, XN, tN, vacSiteN = reader.replay(n)
+                self.assertTrue(np.allclose(XN, X_steps[n - 1]))
+                self.assertAlmostEqual(tN, t_steps[n - 1], delta=1e-5 * t_steps[n - 1])
+                self.assertEqual(stateN[vacSiteN], self.NSpec - 1)
+            self.assertTrue(np.array_equal(reader.getState(Nsteps), state))
+            with self.assertRaises(ValueError):
+                reader.replay(Nsteps + 1)
+
+    def test_CompactTrajBlocked(self):
+        # species 0 cannot exchange with the vacancy - surround the vacancy with it so that it is blocked
+        N_unit = self.N_units
+        SpecRates = np.array([0.] + list(range(2, self.NSpec)), dtype=float)
+        nbrTable = LatGas.makeNeighborTable(self.ijList, self.vacsiteInd, N_unit, self.siteIndtoR, self.RtoSiteInd)
+        initState = self.initState.copy()
+        initState[nbrTable[self.vacsiteInd]] = 0
+
+        Nsteps = 30
+        state = initState.copy()
+        X_steps, t_steps, jmpSelectSteps, jmpFinSiteList = LatGas.LatGasKMCTraj(state, SpecRates, Nsteps, self.ijList,
+                                                                                self.dxList, self.vacsiteInd, N_unit,
+                                                                                self.siteIndtoR, self.RtoSiteInd)
+        self.assertTrue(np.all(jmpSelectSteps == -1))
+        self.assertTrue(np.all(np.isinf(t_steps)))
+        self.assertTrue(np.array_equal(state, initState))
+
+        carrier = LatGas.LatGasCarrier(initState, self.vacsiteInd, self.ijList, self.NSpec,
+                                       CounterRNG.makeStreamKey(7, 3))
+        X_ch, t_ch, jmpsChunk = LatGas.LatGasKMCTrajChunk(carrier, SpecRates, Nsteps, self.ijList, self.dxList,
+                                                          N_unit, self.siteIndtoR, self.RtoSiteInd)
+        self.assertTrue(np.all(jmpsChunk == -1))
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            writer = CompactTraj.CompactTrajWriter(tmpDir, initState, self.vacsiteInd, nbrTable, self.dxList,
+                                                   self.NSpec, keyframeInterval=10, chunkSteps=20)
+            writer.addSteps(jmpSelectSteps, t_steps)
+            writer.close()
+            self.assertTrue(np.array_equal(writer.state, initState))
+
+            reader = CompactTraj.CompactTrajReader(tmpDir)
+            for n in [1, 10, 15, 20, Nsteps]:
+                stateN, XN, tN, vacSiteN = reader.replay(n)
+                self.assertTrue(np.array_equal(stateN, initState))
+                self.assertTrue(np.allclose(XN, 0.))
+                self.assertEqual(vacSiteN, self.vacsiteInd)
+                self.assertTrue(np.isinf(tN))
+
+        # the vacancy also stays blocked in the table driver
+        state = initState.copy()
+        for specSelect in [False, True]:
+            X_steps, t_steps, jmpSelectSteps, _ = LatGas.LatGasKMCTrajTable(state, SpecRates, Nsteps, nbrTable,
+                                                                            self.dxList, self.vacsiteInd, specSelect)
+            self.assertTrue(np.all(jmpSelectSteps == -1))
+            self.assertTrue(np.array_equal(state, initState))
+
+    def test_SampleStore(self):
+        Nsamples = 250
+        Nsites = self.initState.shape[0]
+        states = np.array([np.random.permutation(self.initState) for i in range(Nsamples)])
+        energies = np.random.rand(Nsamples)
+        WBars = np.random.rand(Nsamples, 3, 3)
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            store = SampleStore.SampleStoreWriter(tmpDir, Nsites, self.NSpec, chunkSize=100)
+            for i in range(Nsamples):
+                store.append(states[i], energy=energies[i], WBar=WBars[i])
+            with self.assertRaises(ValueError):
+                store.append(states[0], energy=energies[0])
+            store.close()
+
+            reader = SampleStore.SampleStoreReader(tmpDir)
+            self.assertEqual(len(reader), Nsamples)
+            self.assertTrue(np.array_equal(reader.chunkRows, [100, 100, 50]))
+            # the states take ceil(log2(NSpec)) bits per site on disk
+            self.assertEqual(reader.loadChunk("states", 0).dtype, np.uint64)
+            self.assertLess(reader.loadChunk("states", 0).nbytes, states[:100].nbytes // 16)
+            self.assertIsInstance(reader.loadChunk("energy", 0), np.memmap)
+
+            start = 0
+            for stateChunk, enChunk, WBarChunk in reader.iterChunks("states", "energy", "WBar"):
+                stop = start + stateChunk.shape[0]
+                self.assertTrue(np.array_equal(stateChunk, states[start:stop]))
+                self.assertTrue(np.array_equal(enChunk, energies[start:stop]))
+                self.assertTrue(np.array_equal(WBarChunk, WBars[start:stop]))
+                start = stop
+            self.assertEqual(start, Nsamples)
+
+            for i in [0, 99, 100, 249]:
+                self.assertTrue(np.array_equal(reader.getSample("states", i), states[i]))
+                self.assertTrue(np.array_equal(reader.getSample("WBar", i), WBars[i]))
+            with self.assertRaises(IndexError):
+                reader.getSample("energy", Nsamples)
+
+    def test_MultiTraj(self):
+        Ntraj = 6
+        Nsteps = 20
+        states = np.zeros((Ntraj, self.initState.shape[0]), dtype=int)
+        for traj in range(Ntraj):
+            states[traj, :] = self.initState
+        statesCopy = states.copy()
+
+        SpecRates = np.array(range(1, self.NSpec), dtype=float)
+        N_unit = self.N_units
+
+        Xsq, tSum, diff = LatGas.LatGasKMCTrajMulti(states, SpecRates, Nsteps, self.ijList, self.dxList,
+                                                    self.vacsiteInd, N_unit, self.siteIndtoR, self.RtoSiteInd,
+                                                    1234, 1)
+
+        # the starting states must be left untouched
+        self.assertTrue(np.array_equal(states, statesCopy))
+
+        # The results must not depend on how the trajectories are divided among threads
+        Xsq2, tSum2, diff2 = LatGas.LatGasKMCTrajMulti(states, SpecRates, Nsteps, self.ijList, self.dxList,
+                                                       self.vacsiteInd, N_unit, self.siteIndtoR, self.RtoSiteInd,
+                                                       1234, 4)
+        self.assertTrue(np.allclose(Xsq, Xsq2))
+        self.assertTrue(np.allclose(tSum, tSum2))
+        self.assertTrue(np.allclose(diff, diff2))
+
+        # Check the accumulation against single trajectories run one at a time
+        XsqTest = np.zeros_like(Xsq)
+        tSumTest = np.zeros_like(tSum)
+        diffTest = np.zeros_like(diff)
+        for traj in range(Ntraj):
+            state = states[traj].copy()
+            key = CounterRNG.makeStreamKey(1234, traj)
+            XsqTraj = np.zeros_like(Xsq)
+            tTraj = np.zeros_like(tSum)
+            diffTraj = np.zeros_like(diff)
+            LatGas.LatGasTrajAccumulate(state, SpecRates, Nsteps, self.ijList, self.dxList, self.vacsiteInd, N_unit,
+                                        self.siteIndtoR, self.RtoSiteInd, key, XsqTraj, tTraj, diffTraj)
+            # the vacancy must be on the sites given by its displacement
+            self.assertEqual(np.sum(state == self.NSpec - 1), 1)
+            self.assertTrue(np.allclose(diffTraj, XsqTraj / (6 * tTraj)))
+            # after the first step, the vacancy has moved by one nearest neighbor jump
+            self.assertAlmostEqual(XsqTraj[-1, 0], np.dot(self.dxList[0], self.dxList[0]))
+            XsqTest += XsqTraj
+            tSumTest += tTraj
+            diffTest += diffTraj
+
+        self.assertTrue(np.allclose(Xsq, XsqTest))
+        self.assertTrue(np.allclose(tSum, tSumTest))
+        self.assertTrue(np.allclose(diff, diffTest))
+
+        # different seeds must give different trajectories
+        Xsq3, tSum3, diff3 = LatGas.LatGasKMCTrajMulti(states, SpecRates, Nsteps, self.ijList, self.dxList,
+                                                       self.vacsiteInd, N_unit, self.siteIndtoR, self.RtoSiteInd,
+                                                       4321, 1)
+        self.assertFalse(np.allclose(tSum, tSum3))
+
+        # accumulating only on a strided grid must pick out the same entries
+        sampleStrided = LatGas.makeSampleSteps(Nsteps, stride=3)
+        Xsq4, tSum4, diff4 = LatGas.LatGasKMCTrajMulti(states, SpecRates, Nsteps, self.ijList, self.dxList,
+                                                       self.vacsiteInd, N_unit, self.siteIndtoR, self.RtoSiteInd,
+                                                       1234, 2, sampleStrided)
+        self.assertTrue(np.allclose(Xsq4, Xsq[:, sampleStrided]))
+        self.assertTrue(np.allclose(tSum4, tSum[sampleStrided]))
+        self.assertTrue(np.allclose(diff4, diff[:, sampleStrided]))
+
+    def test_makeSampleSteps(self):
+        self.assertTrue(np.array_equal(LatGas.makeSampleSteps(10), np.arange(10)))
+        self.assertTrue(np.array_equal(LatGas.makeSampleSteps(10, stride=3), np.array([2, 5, 8])))
+        logSteps = LatGas.makeSampleSteps(10000, Nlog=20)
+        self.assertEqual(logSteps[0], 0)
+        self.assertEqual(logSteps[-1], 9999)
+        self.assertTrue(np.all(np.diff(logSteps) > 0))
+        with self.assertRaises(ValueError):
+            LatGas.makeSampleSteps(10, stride=2, Nlog=5)
+
+    def test_SampledTraj(self):
+        SpecRates = np.array(range(1, self.NSpec), dtype=float)
+        N_unit = self.N_units
+        Nsteps = 50
+
+        # First make the full trajectory
+        state = self.initState.copy()
+        seedJit(100)
+        X_steps, t_steps, jmpSelectSteps, jmpFinSiteList = LatGas.LatGasKMCTraj(state, SpecRates, Nsteps, self.ijList,
+                                                                                self.dxList, self.vacsiteInd, N_unit,
+                                                                                self.siteIndtoR, self.RtoSiteInd)
+
+        # Then sample the same trajectory
+        sampleSteps = LatGas.makeSampleSteps(Nsteps, Nlog=10)
+        sampleTimes = np.linspace(0., 1.5 * t_steps[-1], 40)
+        state2 = self.initState.copy()
+        seedJit(100)
+        X_samp, t_samp, X_times, NtimesDone, jmpFinSiteList2 = \
+            LatGas.LatGasKMCTrajSampled(state2, SpecRates, Nsteps, self.ijList, self.dxList, self.vacsiteInd, N_unit,
+                                        self.siteIndtoR, self.RtoSiteInd, sampleSteps, sampleTimes)
+
+        self.assertTrue(np.array_equal(state, state2))
+        self.assertTrue(np.array_equal(jmpFinSiteList, jmpFinSiteList2))
+        self.assertTrue(np.allclose(X_samp, X_steps[sampleSteps]))
+        self.assertTrue(np.allclose(t_samp, t_steps[sampleSteps]))
+
+        # only times up to the end of the trajectory can be sampled
+        self.assertEqual(NtimesDone, np.searchsorted(sampleTimes, t_steps[-1]))
+        for timeInd in range(NtimesDone):
+            T = sampleTimes[timeInd]
+            # find the last step that finished before T
+            step = np.searchsorted(t_steps, T, side="right") - 1
+            if step < 0:
+                self.assertTrue(np.allclose(X_times[timeInd], 0.))
+            else:
+                self.assertTrue(np.allclose(X_times[timeInd], X_steps[step]))
+
+    def test_MultiOriginMSD(self):
+        SpecRates = np.array(range(1, self.NSpec), dtype=float)
+        N_unit = self.N_units
+        Nsteps = 200
+        Ntraj = 4
+        dt = 0.05
+        lagInds = np.array([1, 2, 5, 10, 20])
+
+        msdEst = LatGas.MultiOriginMSD(self.NSpec, dt, lagInds, 2)
+        msdEstChunks = LatGas.MultiOriginMSD(self.NSpec, dt, lagInds, 2)
+
+        msdSumTest = np.zeros((2, self.NSpec, lagInds.shape[0]))
+        countTest = np.zeros((2, lagInds.shape[0]))
+
+        for traj in range(Ntraj):
+            state = self.initState.copy()
+            X_steps, t_steps, jmpSelectSteps, jmpFinSiteList = LatGas.LatGasKMCTraj(state, SpecRates, Nsteps,
+                                                                                    self.ijList, self.dxList,
+                                                                                    self.vacsiteInd, N_unit,
+                                                                                    self.siteIndtoR, self.RtoSiteInd)
+            msdEst.startTrajectory(traj)
+            msdEst.addChunk(X_steps, t_steps)
+
+            # feed the same trajectory in uneven chunks
+            msdEstChunks.startTrajectory(traj)
+            for (start, end) in [(0, 7), (7, 100), (100, 101), (101, Nsteps)]:
+                msdEstChunks.addChunk(X_steps[start:end], t_steps[start:end])
+
+            # Now evaluate the displacements on the grid explicitly
+            # grid points up to the last step time are determined
+            Ngrid = int(np.ceil(t_steps[-1] / dt))
+            X_grid = np.zeros((Ngrid, self.NSpec, 3))
+            for j in range(Ngrid):
+                step = np.searchsorted(t_steps, j * dt, side="right") - 1
+                if step >= 0:
+                    X_grid[j] = X_steps[step]
+
+            for lagInd, lag in enumerate(lagInds):
+                for j in range(lag, Ngrid):
+                    for spec in range(self.NSpec):
+                        dX = X_grid[j, spec] - X_grid[j - lag, spec]
+                        msdSumTest[traj % 2, spec, lagInd] += np.dot(dX, dX)
+                    countTest[traj % 2, lagInd] += 1
+
+        self.assertTrue(np.allclose(msdEst.msdSum, msdSumTest))
+        self.assertTrue(np.allclose(msdEst.originCount, countTest))
+        self.assertTrue(np.allclose(msdEstChunks.msdSum, msdSumTest))
+        self.assertTrue(np.allclose(msdEstChunks.originCount, countTest))
+
+        lagTimes, msd, msdErr = msdEst.getMSD()
+        self.assertTrue(np.allclose(lagTimes, lagInds * dt))
+        msdTest = np.sum(msdSumTest, axis=0) / np.sum(countTest, axis=0)
+        self.assertTrue(np.allclose(msd, msdTest))
+        blockMeans = msdSumTest / countTest[:, None, :]
+        errTest = np.sqrt(np.sum((blockMeans - msdTest) ** 2, axis=0) / 2)
+        self.assertTrue(np.allclose(msdErr, errTest))
+
+        # Data that is already on the grid must give the same results
+        msdEstGrid = LatGas.MultiOriginMSD(self.NSpec, dt, lagInds, 1)
+        msdEstGrid.startTrajectory(0)
+        msdEstGrid.addGridPoints(X_grid)
+        msdEstCheck = LatGas.MultiOriginMSD(self.NSpec, dt, lagInds, 1)
+        msdEstCheck.startTrajectory(0)
+        msdEstCheck.addChunk(X_steps, t_steps)
+        self.assertTrue(np.allclose(msdEstGrid.msdSum, msdEstCheck.msdSum))
+        self.assertTrue(np.allclose(msdEstGrid.originCount, msdEstCheck.originCount))
+
+    def test_ChunkedTraj(self):
+        SpecRates = np.array(range(1, self.NSpec), dtype=float)
+        N_unit = self.N_units
+        Nsteps = 60
+        key = CounterRNG.makeStreamKey(7, 3)
+
+        # Run in one go
+        carrier = LatGas.LatGasCarrier(self.initState, self.vacsiteInd, self.ijList, self.NSpec, key)
+        X_steps, t_steps, jmpSelectSteps = LatGas.LatGasKMCTrajChunk(carrier, SpecRates, Nsteps, self.ijList,
+                                                                     self.dxList, N_unit, self.siteIndtoR,
+                                                                     self.RtoSiteInd)
+        self.assertEqual(carrier.step, Nsteps)
+
+        # Run in chunks, going through a checkpoint file in between
+        carrier2 = LatGas.LatGasCarrier(self.initState, self.vacsiteInd, self.ijList, self.NSpec, key)
+        X_chunks, t_chunks = [], []
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fileName = os.path.join(tmpDir, "carrier.npz")
+            for Nchunk in [25, 1, 34]:
+                X_ch, t_ch, jmps = LatGas.LatGasKMCTrajChunk(carrier2, SpecRates, Nchunk, self.ijList, self.dxList,
+                                                             N_unit, self.siteIndtoR, self.RtoSiteInd)
+                X_chunks.append(X_ch)
+                t_chunks.append(t_ch)
+                LatGas.saveLatGasCarrier(carrier2, fileName)
+                carrier2 = LatGas.loadLatGasCarrier(fileName)
+
+        self.assertTrue(np.array_equal(np.concatenate(X_chunks), X_steps))
+        self.assertTrue(np.array_equal(np.concatenate(t_chunks), t_steps))
+        for field in LatGas.LatGasCarrierFields:
+            self.assertTrue(np.array_equal(getattr(carrier, field), getattr(carrier2, field)))
+
+        # The vacancy must be where the carrier says it is
+        self.assertEqual(carrier.state[carrier.vacSiteNow], self.NSpec - 1)
+
+        # The same stream must give the same trajectory as the online accumulator
+        Xsq = np.zeros((self.NSpec, Nsteps))
+        tSum = np.zeros(Nsteps)
+        diff = np.zeros((self.NSpec, Nsteps))
+        LatGas.LatGasTrajAccumulate(self.initState.copy(), SpecRates, Nsteps, self.ijList, self.dxList,
+                                    self.vacsiteInd, N_unit, self.siteIndtoR, self.RtoSiteInd, key, Xsq, tSum, diff)
+        self.assertTrue(np.allclose(tSum, t_steps))
+        self.assertTrue(np.allclose(Xsq, np.sum(X_steps ** 2, axis=2).T))
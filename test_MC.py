@@ -4,15 +4,44 @@ import itertools
 import Transitions
 import Cluster_Expansion
 import MC_JIT
+import CounterRNG
+import ShellTransport
+import Tracer
+import MC_Kernels
+import SharedTables
+import SiteOrdering
 import unittest
 import time
 import warnings
 import collections
+import tempfile
+import os
+import sys
+import subprocess
+import multiprocessing
+from numba import jit
 
 warnings.filterwarnings('error', category=RuntimeWarning)
 
 np.seterr(all='raise')
 
+
+@jit(nopython=True)
+def seedJit(seed):
+    # seed numba's random number generator
+    np.random.seed(seed)
+
+
+def sharedTablesWorker(args):
+    # build a KMC_JIT in a worker process from the shared tables, and get the energy changes of the vacancy jumps
+    tables, N_unit, state, vacSiteInd, ijList = args
+    KMC_jit = SharedTables.makeKMC(tables, N_unit)
+    offsc = KMC_jit.GetOffSite(state)
+    delE = KMC_jit.getEnergyChangeJumps(state, offsc, vacSiteInd, ijList)
+    tables.close()
+    return offsc, delE
+
+
 class Test_MC_Arrays(unittest.TestCase):
 
     def setUp(self):
@@ -472,6 +501,387 @@ class Test_MC(Test_MC_Arrays):
         self.assertAlmostEqual(EnSwap, En1+MCSampler_Jit.delEArray[0])
 
 
+    def test_TransInvariantMC(self):
+        numSitesReps, RepSiteOffsets, RepSpecs, Rep2En, numSpecRefs, SpecRefs = \
+            self.VclusExp.makeTransInvariantInteractionsData(self.Energies)
+        Nsites = self.initState.shape[0]
+        N_unit = self.KMC_Jit.N_unit
+
+        # every interaction is a translation of one of the stored clusters
+        self.assertEqual(numSitesReps.shape[0] * Nsites, self.numSitesInteracts.shape[0])
+        self.assertLess(RepSiteOffsets.nbytes, self.SupSitesInteracts.nbytes)
+
+        state = self.initState.copy()
+        offsc = self.KMC_Jit.GetOffSite(state)
+        offscTrans = MC_Kernels.countOffSitesTrans(state, numSitesReps, RepSiteOffsets, RepSpecs, self.siteIndtoR,
+                                                   self.RtoSiteInd, N_unit)
+        self.assertEqual(np.sum(offscTrans == 0), np.sum(offsc == 0))
+        En = np.sum(self.Interaction2En[offsc == 0])
+        self.assertAlmostEqual(MC_Kernels.getEnergyTrans(offscTrans, Rep2En), En)
+
+        # swap energies must match those from the full interaction tables
+        stateTrans = state.copy()
+        for trial in range(20):
+            siteA, siteB = np.random.choice(Nsites, 2, replace=False)
+            delE = self.KMC_Jit.getEnergyChangeJumps(state, offsc, siteA, np.array([siteB]))[0]
+            self.KMC_Jit.updateState(state, offsc, siteA, siteB)
+            delETrans = MC_Kernels.swapSitesTrans(stateTrans, offscTrans, siteA, siteB, RepSiteOffsets, Rep2En,
+                                                  numSpecRefs, SpecRefs, self.siteIndtoR, self.RtoSiteInd, N_unit)
+            self.assertAlmostEqual(delE, delETrans)
+        self.assertTrue(np.array_equal(state, stateTrans))
+        self.assertTrue(np.array_equal(offscTrans, MC_Kernels.countOffSitesTrans(state, numSitesReps, RepSiteOffsets,
+                                                                                 RepSpecs, self.siteIndtoR,
+                                                                                 self.RtoSiteInd, N_unit)))
+
+        # MC sweeps with the same random numbers must visit the same states
+        Nswaptrials = 200
+        randarr = np.log(np.random.rand(Nswaptrials))
+        state1, state2 = self.initState.copy(), self.initState.copy()
+        offsc1 = self.KMC_Jit.GetOffSite(state1)
+        offscTrans = MC_Kernels.countOffSitesTrans(state2, numSitesReps, RepSiteOffsets, RepSpecs, self.siteIndtoR,
+                                                   self.RtoSiteInd, N_unit)
+        seedJit(60)
+        acceptCount, badTrials, acceptInd = self.MCSampler_Jit.makeMCsweep(state1, offsc1,
+                                                                           self.KMC_Jit.GetTSOffSite(state1),
+                                                                           np.zeros((Nswaptrials, 2), dtype=int),
+                                                                           1.0, randarr, Nswaptrials,
+                                                                           self.vacSiteInd)
+        seedJit(60)
+        acceptCount2, badTrials2, acceptInd2, delEArray2 = \
+            MC_Kernels.mcSweepTrans(state2, offscTrans, np.zeros((Nswaptrials, 2), dtype=int), 1.0, randarr,
+                                    Nswaptrials, self.vacSiteInd, RepSiteOffsets, Rep2En, numSpecRefs, SpecRefs,
+                                    self.siteIndtoR, self.RtoSiteInd, N_unit)
+        self.assertEqual(acceptCount, acceptCount2)
+        self.assertEqual(badTrials, badTrials2)
+        self.assertTrue(np.array_equal(acceptInd, acceptInd2))
+        self.assertTrue(np.allclose(self.MCSampler_Jit.delEArray, delEArray2))
+        self.assertTrue(np.array_equal(state1, state2))
+
+    def test_PatternMC(self):
+        numSitesTuples, TupleSites, TupleGeom, GeomPatternEn, numTuplesSite, SiteTuples = \
+            self.VclusExp.makePatternInteractionsData(self.Energies)
+        Nsites = self.initState.shape[0]
+        NSpec = self.NSpec
+
+        # every species labeling of a site tuple is one of the interactions
+        self.assertLessEqual(numSitesTuples.shape[0], self.numSitesInteracts.shape[0])
+        self.assertEqual(np.sum(GeomPatternEn != 0) * Nsites, np.sum(self.Interaction2En != 0))
+        for tup in range(numSitesTuples.shape[0]):
+            for i in range(numSitesTuples[tup]):
+                site = TupleSites[tup, i]
+                self.assertIn([tup, NSpec**i], SiteTuples[site, :numTuplesSite[site]].tolist())
+
+        state = self.initState.copy()
+        offsc = self.KMC_Jit.GetOffSite(state)
+        codes = MC_Kernels.patternCodes(state, numSitesTuples, TupleSites, NSpec)
+        En = np.sum(self.Interaction2En[offsc == 0])
+        self.assertAlmostEqual(MC_Kernels.getEnergyPattern(codes, TupleGeom, GeomPatternEn), En)
+
+        # swap energies must match those from the full interaction tables
+        statePattern = state.copy()
+        for trial in range(20):
+            siteA, siteB = np.random.choice(Nsites, 2, replace=False)
+            delE = self.KMC_Jit.getEnergyChangeJumps(state, offsc, siteA, np.array([siteB]))[0]
+            self.KMC_Jit.updateState(state, offsc, siteA, siteB)
+            delEPattern = MC_Kernels.swapSitesPattern(statePattern, codes, siteA, siteB, TupleGeom, GeomPatternEn,
+                                                      numTuplesSite, SiteTuples)
+            self.assertAlmostEqual(delE, delEPattern)
+        self.assertTrue(np.array_equal(state, statePattern))
+        self.assertTrue(np.array_equal(codes, MC_Kernels.patternCodes(state, numSitesTuples, TupleSites, NSpec)))
+
+        # MC sweeps with the same random numbers must visit the same states
+        Nswaptrials = 200
+        randarr = np.log(np.random.rand(Nswaptrials))
+        state1, state2 = self.initState.copy(), self.initState.copy()
+        offsc1 = self.KMC_Jit.GetOffSite(state1)
+        codes = MC_Kernels.patternCodes(state2, numSitesTuples, TupleSites, NSpec)
+        seedJit(61)
+        acceptCount, badTrials, acceptInd = self.MCSampler_Jit.makeMCsweep(state1, offsc1,
+                                                                           self.KMC_Jit.GetTSOffSite(state1),
+                                                                           np.zeros((Nswaptrials, 2), dtype=int),
+                                                                           1.0, randarr, Nswaptrials,
+                                                                           self.vacSiteInd)
+        seedJit(61)
+        acceptCount2, badTrials2, acceptInd2, delEArray2 = \
+            MC_Kernels.mcSweepPattern(state2, codes, np.zeros((Nswaptrials, 2), dtype=int), 1.0, randarr,
+                                      Nswaptrials, self.vacSiteInd, TupleGeom, GeomPatternEn, numTuplesSite,
+                                      SiteTuples)
+        self.assertEqual(acceptCount, acceptCount2)
+        self.assertEqual(badTrials, badTrials2)
+        self.assertTrue(np.array_equal(acceptInd, acceptInd2))
+        self.assertTrue(np.allclose(self.MCSampler_Jit.delEArray, delEArray2))
+        self.assertTrue(np.array_equal(state1, state2))
+
+    def test_evaluateStates(self):
+        Interaction2Orbit = self.VclusExp.makeInteractionOrbits(self.InteractionIndexDict, self.InteractionRepClusDict)
+        self.assertTrue(np.allclose(self.Energies[Interaction2Orbit], self.Interaction2En))
+
+        Nstates = 20
+        states = np.zeros((Nstates, self.initState.shape[0]), dtype=int)
+        sites = np.array([site for site in range(self.initState.shape[0]) if site != self.vacSiteInd])
+        for stateInd in range(Nstates):
+            states[stateInd, :] = self.initState
+            states[stateInd, sites] = self.initState[np.random.permutation(sites)]
+
+        energies, design = MC_JIT.evaluateStates(states, self.numSitesInteracts, self.SupSitesInteracts,
+                                                 self.SpecOnInteractSites, Interaction2Orbit, self.Energies)
+        self.assertEqual(design.shape, (Nstates, len(self.Energies)))
+        self.assertTrue(np.allclose(design @ self.Energies, energies))
+        for stateInd in range(Nstates):
+            offsc = self.KMC_Jit.GetOffSite(states[stateInd])
+            self.assertAlmostEqual(energies[stateInd], np.sum(self.Interaction2En[offsc == 0]))
+            onCounts = np.bincount(Interaction2Orbit[offsc == 0], minlength=len(self.Energies))
+            self.assertTrue(np.array_equal(design[stateInd].toarray()[0], onCounts))
+
+    def test_MCsweepOrbitCounts(self):
+        Interaction2Orbit = self.VclusExp.makeInteractionOrbits(self.InteractionIndexDict, self.InteractionRepClusDict)
+        Norbits = len(self.Energies)
+        Nswaptrials = 100
+        state1, state2 = self.initState.copy(), self.initState.copy()
+        offsc1, offsc2 = self.KMC_Jit.GetOffSite(state1), self.KMC_Jit.GetOffSite(state2)
+        OrbitCounts = MC_JIT.makeOrbitCounts(offsc2, Interaction2Orbit, Norbits)
+        EnPerturbed = self.Energies + 0.1 * np.random.rand(Norbits)
+
+        for sweep in range(5):
+            randarr = np.log(np.random.rand(Nswaptrials))
+            seedJit(70 + sweep)
+            acceptCount, badTrials, acceptInd = self.MCSampler_Jit.makeMCsweep(state1, offsc1,
+                                                                               self.KMC_Jit.GetTSOffSite(state1),
+                                                                               np.zeros((Nswaptrials, 2), dtype=int),
+                                                                               1.0, randarr, Nswaptrials,
+                                                                               self.vacSiteInd)
+            seedJit(70 + sweep)
+            acceptCount2, badTrials2, acceptInd2 = \
+                self.MCSampler_Jit.makeMCsweep(state2, offsc2, self.KMC_Jit.GetTSOffSite(state2),
+                                               np.zeros((Nswaptrials, 2), dtype=int), 1.0, randarr, Nswaptrials,
+                                               self.vacSiteInd, Interaction2Orbit, OrbitCounts)
+
+            # tracking the orbits must not change the sweep
+            self.assertEqual(acceptCount, acceptCount2)
+            self.assertTrue(np.array_equal(state1, state2))
+            self.assertTrue(np.array_equal(offsc1, offsc2))
+
+            self.assertTrue(np.array_equal(OrbitCounts, MC_JIT.makeOrbitCounts(self.KMC_Jit.GetOffSite(state2),
+                                                                               Interaction2Orbit, Norbits)))
+            self.assertAlmostEqual(OrbitCounts @ self.Energies, np.sum(self.Interaction2En[offsc2 == 0]))
+            self.assertAlmostEqual(OrbitCounts @ EnPerturbed, np.sum(EnPerturbed[Interaction2Orbit[offsc2 == 0]]))
+
+    def test_SGC(self):
+        Nsites = self.initState.shape[0]
+        state = self.initState.copy()
+        offsc = self.KMC_Jit.GetOffSite(state)
+        TSoffsc = np.zeros_like(self.KMC_Jit.GetTSOffSite(state))
+        specCounts = np.bincount(state, minlength=self.NSpec)
+        mu = np.zeros(self.NSpec)
+        mu[0] = 0.2
+
+        # single flips - the energy changes must match the full energies
+        for trial in range(50):
+            En = np.sum(self.Interaction2En[offsc == 0])
+            stateOld = state.copy()
+            FlipTrials = np.zeros((1, 2), dtype=int)
+            acceptCount, acceptInd = self.MCSampler_Jit.makeSGCsweep(state, offsc, TSoffsc, FlipTrials, 1.0, mu,
+                                                                     np.log(np.random.rand(1)), 1, specCounts,
+                                                                     np.zeros(self.NSpec), self.vacSiteInd)
+            site, specNew = FlipTrials[0]
+            self.assertNotEqual(site, self.vacSiteInd)
+            self.assertNotEqual(specNew, stateOld[site])
+            self.assertLess(specNew, self.NSpec - 1)
+            if acceptCount == 1:
+                self.assertEqual(state[site], specNew)
+                self.assertAlmostEqual(np.sum(self.Interaction2En[offsc == 0]) - En, self.MCSampler_Jit.delEArray[0])
+            else:
+                self.assertTrue(np.array_equal(state, stateOld))
+            self.assertTrue(np.array_equal(offsc, self.KMC_Jit.GetOffSite(state)))
+            self.assertTrue(np.array_equal(TSoffsc, self.KMC_Jit.GetTSOffSite(state)))
+            self.assertTrue(np.array_equal(specCounts, np.bincount(state, minlength=self.NSpec)))
+
+        # a large chemical potential of a species must fill the lattice with it
+        muList = np.zeros((2, self.NSpec))
+        muList[0, 0] = 50.
+        muList[1, 1] = 50.
+        comps, accepts = MC_JIT.sgcScan(self.MCSampler_Jit, state, offsc, muList, 1.0, 5, 5, 2 * Nsites,
+                                        self.vacSiteInd)
+        self.assertTrue(np.allclose(np.sum(comps, axis=1), 1.))
+        self.assertGreater(comps[0, 0], 0.95)
+        self.assertGreater(comps[1, 1], 0.95)
+        self.assertAlmostEqual(comps[1, self.NSpec - 1], 1. / Nsites)
+        self.assertTrue(np.array_equal(offsc, self.KMC_Jit.GetOffSite(state)))
+
+    def test_SGCSingleSpecies(self):
+        # keep only the first mobile species and the vacancy - there is then nothing to flip to
+        Nsites = self.initState.shape[0]
+        numInteractsSiteSpec = self.numInteractsSiteSpec[:, [0, self.NSpec - 1]].copy()
+        SiteSpecInterArray = self.SiteSpecInterArray[:, [0, self.NSpec - 1], :].copy()
+        state = np.zeros(Nsites, dtype=int)
+        state[self.vacSiteInd] = 1
+        offsc = self.KMC_Jit.GetOffSite(state)
+        offsc0 = offsc.copy()
+        TSoffsc = np.zeros(self.numSitesTSInteracts.shape[0], dtype=int)
+        specCounts = np.bincount(state, minlength=2)
+        compSum = np.zeros(2)
+        Nfliptrials = 20
+        FlipTrials = np.zeros((Nfliptrials, 2), dtype=int)
+
+        acceptCount, acceptInd, delEArray = \
+            MC_Kernels.sgcSweep(state, offsc, TSoffsc, FlipTrials, 1.0, np.zeros(2), np.zeros(Nfliptrials),
+                                Nfliptrials, self.vacSiteInd, numInteractsSiteSpec, SiteSpecInterArray,
+                                self.Interaction2En, self.numSitesTSInteracts, self.TSInteractSites,
+                                self.TSInteractSpecs, specCounts, compSum)
+        self.assertEqual(acceptCount, 0)
+        self.assertTrue(np.all(acceptInd == 0))
+        self.assertTrue(np.all(FlipTrials == -1))
+        self.assertTrue(np.array_equal(state, np.bincount([self.vacSiteInd], minlength=Nsites)))
+        self.assertTrue(np.array_equal(offsc, offsc0))
+        self.assertTrue(np.array_equal(specCounts, [Nsites - 1, 1]))
+        self.assertTrue(np.array_equal(compSum, Nfliptrials * specCounts))
+
+    def test_OccupancyBits(self):
+        Nsites = self.initState.shape[0]
+        occBits = MC_JIT.OccupancyBits(self.numSitesInteracts, self.SupSitesInteracts, self.SpecOnInteractSites,
+                                       Nsites, self.NSpec)
+        TSoccBits = MC_JIT.OccupancyBits(self.numSitesTSInteracts, self.TSInteractSites, self.TSInteractSpecs,
+                                         Nsites, self.NSpec)
+
+        state = self.initState.copy()
+        occ = occBits.makeOccupancy(state)
+        self.assertEqual(occ.shape, (self.NSpec, (Nsites + 63) // 64))
+        self.assertEqual(sum(MC_JIT.popCount64(w) for w in occ.flatten()), Nsites)
+
+        for trial in range(10):
+            offsc = self.KMC_Jit.GetOffSite(state)
+            self.assertTrue(np.array_equal(occBits.GetOffSite(occ), offsc))
+            self.assertTrue(np.array_equal(TSoccBits.GetOffSite(occ), self.KMC_Jit.GetTSOffSite(state)))
+            self.assertAlmostEqual(occBits.getEnergy(occ, self.Interaction2En),
+                                   np.sum(self.Interaction2En[offsc == 0]))
+
+            # swap energies must match those from the off site counts, and leave the occupancy unchanged
+            siteA, siteB = np.random.choice(Nsites, 2, replace=False)
+            delE = self.KMC_Jit.getEnergyChangeJumps(state, offsc, siteA, np.array([siteB]))[0]
+            hashBefore = occBits.hashOccupancy(occ)
+            delEBits = occBits.getSwapEnergyChange(occ, siteA, siteB, self.numInteractsSiteSpec,
+                                                   self.SiteSpecInterArray, self.Interaction2En)
+            self.assertAlmostEqual(delE, delEBits)
+            self.assertEqual(occBits.hashOccupancy(occ), hashBefore)
+
+            occBits.swapOccupancy(occ, siteA, siteB, state[siteA], state[siteB])
+            state[siteA], state[siteB] = state[siteB], state[siteA]
+            self.assertTrue(np.array_equal(occ, occBits.makeOccupancy(state)))
+            if not np.array_equal(state, self.initState):
+                self.assertNotEqual(occBits.hashOccupancy(occ), occBits.hashOccupancy(occBits.makeOccupancy(
+                    self.initState)))
+
+    def test_OccupancyBitsSampler(self):
+        occBits, TSoccBits = MC_JIT.makeOccupancyBits(self.MCSampler_Jit)
+        Nsites = self.initState.shape[0]
+        Nswaptrials = Nsites
+
+        # evaluate the states along an MC chain both ways
+        state = self.initState.copy()
+        OffSiteCount = self.KMC_Jit.GetOffSite(state)
+        TransOffSiteCount = self.KMC_Jit.GetTSOffSite(state)
+        hashes = {}
+        for sweep in range(5):
+            randarr = np.log(np.random.rand(Nswaptrials))
+            self.MCSampler_Jit.makeMCsweep(state, OffSiteCount, TransOffSiteCount,
+                                           np.zeros((Nswaptrials, 2), dtype=int), 1.0, randarr, Nswaptrials,
+                                           self.vacSiteInd)
+            self.assertTrue(np.array_equal(self.KMC_Jit.GetOffSite(state, occBits), OffSiteCount))
+            self.assertTrue(np.array_equal(self.KMC_Jit.GetTSOffSite(state, TSoccBits), TransOffSiteCount))
+            self.assertAlmostEqual(self.KMC_Jit.getEnergy(state, occBits), self.KMC_Jit.getEnergy(state))
+            self.assertAlmostEqual(self.KMC_Jit.getEnergy(state), np.sum(self.Interaction2En[OffSiteCount == 0]))
+
+            h = self.KMC_Jit.hashState(state, occBits)
+            self.assertEqual(h, self.KMC_Jit.hashState(state.copy(), occBits))
+            hashes[state.tobytes()] = h
+        # different states must get different hashes
+        self.assertEqual(len(set(hashes.values())), len(hashes))
+
+        # the shells must not depend on how the off sites are counted
+        state = self.initState.copy()
+        offsc = self.KMC_Jit.GetOffSite(state)
+        TSoffsc = self.KMC_Jit.GetTSOffSite(state)
+        ijList = self.VclusExp.KRAexpander.ijList
+        dxList = self.VclusExp.KRAexpander.dxList
+        shells = MC_JIT.makeShells(self.MCSampler_Jit, self.KMC_Jit, state, offsc, TSoffsc, ijList, dxList, 1.0,
+                                   Nsites, self.NSpec, Nshells=2)
+        shellsBits = MC_JIT.makeShells(self.MCSampler_Jit, self.KMC_Jit, state, offsc, TSoffsc, ijList, dxList, 1.0,
+                                       Nsites, self.NSpec, Nshells=2, occBits=occBits, TSoccBits=TSoccBits)
+        self.assertEqual(shells[0], shellsBits[0])
+        self.assertEqual(shells[2].keys(), shellsBits[2].keys())
+        for key, (rate, jumpInd) in shells[2].items():
+            self.assertAlmostEqual(rate, shellsBits[2][key][0])
+            self.assertEqual(jumpInd, shellsBits[2][key][1])
+
+    def test_MC_chunks(self):
+        state = self.initState.copy()
+        OffSiteCount = self.KMC_Jit.GetOffSite(state)
+        TransOffSiteCount = self.KMC_Jit.GetTSOffSite(state)
+        key = CounterRNG.makeStreamKey(5, 0)
+        beta = 1.0
+        Ntrials = 300
+
+        carrier = MC_JIT.MCCarrier(state, OffSiteCount, TransOffSiteCount, key)
+        accepted = self.MCSampler_Jit.makeMCsweepChunk(carrier, beta, Ntrials, self.vacSiteInd)
+        self.assertEqual(accepted, carrier.acceptCount)
+        self.assertEqual(carrier.trialCount, Ntrials)
+        self.assertEqual(carrier.drawCount, 3 * Ntrials + 2 * carrier.badTrials)
+
+        # the input arrays must be left alone
+        self.assertTrue(np.array_equal(state, self.initState))
+
+        # The counters must match the new state
+        self.assertTrue(np.array_equal(carrier.OffSiteCount, self.KMC_Jit.GetOffSite(carrier.mobOcc)))
+        self.assertTrue(np.array_equal(carrier.TransOffSiteCount, self.KMC_Jit.GetTSOffSite(carrier.mobOcc)))
+        # The composition must not change
+        self.assertTrue(np.array_equal(np.sort(carrier.mobOcc), np.sort(state)))
+        self.assertEqual(carrier.mobOcc[self.vacSiteInd], self.NSpec - 1)
+
+        # Now do the same trials in chunks, going through checkpoint files
+        carrier2 = MC_JIT.MCCarrier(state, OffSiteCount, TransOffSiteCount, key)
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fileName = os.path.join(tmpDir, "carrier.npz")
+            for Nchunk in [100, 1, 199]:
+                self.MCSampler_Jit.makeMCsweepChunk(carrier2, beta, Nchunk, self.vacSiteInd)
+                MC_JIT.saveMCCarrier(carrier2, fileName)
+                carrier2 = MC_JIT.loadMCCarrier(fileName)
+
+        for field in MC_JIT.MCCarrierFields:
+            self.assertTrue(np.array_equal(getattr(carrier, field), getattr(carrier2, field)))
+
+    def test_MC_checkpoint(self):
+        state = self.initState.copy()
+        OffSiteCount = self.KMC_Jit.GetOffSite(state)
+        TransOffSiteCount = self.KMC_Jit.GetTSOffSite(state)
+        key = CounterRNG.makeStreamKey(6, 0)
+        beta = 1.0
+        Nswaptrials = 50
+        tableHash = MC_JIT.hashMCTables(self.MCSampler_Jit)
+        self.assertEqual(tableHash, MC_JIT.hashMCTables(self.MCSampler_Jit))
+
+        carrier = MC_JIT.MCCarrier(state, OffSiteCount, TransOffSiteCount, key)
+        MC_JIT.runMCSweeps(self.MCSampler_Jit, carrier, beta, 8, Nswaptrials, self.vacSiteInd)
+        self.assertEqual(carrier.trialCount, 8 * Nswaptrials)
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fileName = os.path.join(tmpDir, "mc.npz")
+            # stop after 5 sweeps (checkpointed at 2, 4 and 5), then restart from the checkpoint
+            carrier2 = MC_JIT.MCCarrier(state, OffSiteCount, TransOffSiteCount, key)
+            MC_JIT.runMCSweeps(self.MCSampler_Jit, carrier2, beta, 5, Nswaptrials, self.vacSiteInd,
+                               checkpointFile=fileName, checkpointInterval=2)
+            carrier2 = MC_JIT.loadMCCarrier(fileName, tableHash)
+            self.assertEqual(carrier2.trialCount, 5 * Nswaptrials)
+            self.assertTrue(np.array_equal(carrier2.OffSiteCount, self.KMC_Jit.GetOffSite(carrier2.mobOcc)))
+            MC_JIT.runMCSweeps(self.MCSampler_Jit, carrier2, beta, 8, Nswaptrials, self.vacSiteInd,
+                               checkpointFile=fileName, checkpointInterval=2)
+
+            # a checkpoint must not be restored with different interaction tables
+            with self.assertRaises(ValueError):
+                MC_JIT.loadMCCarrier(fileName, tableHash[::-1])
+
+        for field in MC_JIT.MCCarrierFields:
+            self.assertTrue(np.array_equal(getattr(carrier, field), getattr(carrier2, field)))
+
     def test_MultiSwap(self):
         initCopy = self.initState.copy()
 
@@ -1103,8 +1513,473 @@ class Test_KMC(Test_MC_Arrays):
             self.assertTrue(np.array_equal(state, stateNew))
             self.assertTrue(np.array_equal(offscnew, OffSiteCount))
 
+    def test_MultiTraj(self):
+        Ntraj = 4
+        Nsteps = 5
+        beta = 1.0
+        NSpec = self.NSpec
+        ijList = self.VclusExp.KRAexpander.ijList
+        dxList = self.VclusExp.KRAexpander.dxList
+
+        states = np.zeros((Ntraj, self.initState.shape[0]), dtype=int)
+        for traj in range(Ntraj):
+            states[traj, :] = np.random.permutation(self.initState)
+            # put the vacancy back at the origin
+            vacNow = np.where(states[traj] == NSpec - 1)[0][0]
+            states[traj, vacNow] = states[traj, self.vacSiteInd]
+            states[traj, self.vacSiteInd] = NSpec - 1
+        statesCopy = states.copy()
+
+        Xsq, tSum, diff = MC_JIT.getTrajMulti(self.KMC_Jit, states, self.vacSiteInd, ijList, dxList, NSpec, Nsteps,
+                                              beta, 10, 1)
+        self.assertTrue(np.array_equal(states, statesCopy))
+
+        Xsq2, tSum2, diff2 = MC_JIT.getTrajMulti(self.KMC_Jit, states, self.vacSiteInd, ijList, dxList, NSpec, Nsteps,
+                                                 beta, 10, 3)
+        self.assertTrue(np.allclose(Xsq, Xsq2))
+        self.assertTrue(np.allclose(tSum, tSum2))
+        self.assertTrue(np.allclose(diff, diff2))
+
+        # accumulating only on a subset of the steps must pick out the same entries
+        sampleSteps = np.array([1, 3])
+        Xsq3, tSum3, diff3 = MC_JIT.getTrajMulti(self.KMC_Jit, states, self.vacSiteInd, ijList, dxList, NSpec, Nsteps,
+                                                 beta, 10, 2, sampleSteps)
+        self.assertTrue(np.allclose(Xsq3, Xsq[:, sampleSteps]))
+        self.assertTrue(np.allclose(tSum3, tSum[sampleSteps]))
+        self.assertTrue(np.allclose(diff3, diff[:, sampleSteps]))
+
+        # Now run the trajectories one by one and check the accumulation
+        XsqTest = np.zeros_like(Xsq)
+        tSumTest = np.zeros_like(tSum)
+        diffTest = np.zeros_like(diff)
+        for traj in range(Ntraj):
+            state = states[traj].copy()
+            offsc = self.KMC_Jit.GetOffSite(state)
+            key = CounterRNG.makeStreamKey(10, traj)
+            XsqTraj = np.zeros_like(Xsq)
+            tTraj = np.zeros_like(tSum)
+            diffTraj = np.zeros_like(diff)
+            MC_JIT.getTrajAccumulate(self.KMC_Jit, state, offsc, self.vacSiteInd, ijList, dxList, NSpec, Nsteps, beta,
+                                     key, XsqTraj, tTraj, diffTraj)
+            # the off site counts must be updated along with the state
+            self.assertTrue(np.array_equal(offsc, self.KMC_Jit.GetOffSite(state)))
+            self.assertTrue(np.allclose(diffTraj, XsqTraj / (6 * tTraj)))
+            self.assertAlmostEqual(XsqTraj[-1, 0], np.dot(dxList[0], dxList[0]))
+            XsqTest += XsqTraj
+            tSumTest += tTraj
+            diffTest += diffTraj
+
+        self.assertTrue(np.allclose(Xsq, XsqTest))
+        self.assertTrue(np.allclose(tSum, tSumTest))
+        self.assertTrue(np.allclose(diff, diffTest))
+
+    def test_TrajChunks(self):
+        Nsteps = 8
+        beta = 1.0
+        NSpec = self.NSpec
+        ijList = self.VclusExp.KRAexpander.ijList
+        dxList = self.VclusExp.KRAexpander.dxList
+        state = self.initState.copy()
+        offsc = self.KMC_Jit.GetOffSite(state)
+        key = CounterRNG.makeStreamKey(3, 1)
+
+        carrier = MC_JIT.KMCCarrier(state, offsc, self.vacSiteInd, NSpec, key)
+        X_steps, t_steps = self.KMC_Jit.getTrajChunk(carrier, ijList, dxList, NSpec, Nsteps, beta)
+        self.assertEqual(carrier.step, Nsteps)
+        self.assertEqual(carrier.state[carrier.vacIndNow], NSpec - 1)
+        self.assertTrue(np.array_equal(carrier.offsc, self.KMC_Jit.GetOffSite(carrier.state)))
+
+        carrier2 = MC_JIT.KMCCarrier(state, offsc, self.vacSiteInd, NSpec, key)
+        X_chunks, t_chunks = [], []
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fileName = os.path.join(tmpDir, "carrier.npz")
+            for Nchunk in [3, 5]:
+                X_ch, t_ch = self.KMC_Jit.getTrajChunk(carrier2, ijList, dxList, NSpec, Nchunk, beta)
+                X_chunks.append(X_ch)
+                t_chunks.append(t_ch)
+                MC_JIT.saveKMCCarrier(carrier2, fileName)
+                carrier2 = MC_JIT.loadKMCCarrier(fileName)
+
+        self.assertTrue(np.array_equal(np.concatenate(X_chunks), X_steps))
+        self.assertTrue(np.array_equal(np.concatenate(t_chunks), t_steps))
+        for field in MC_JIT.KMCCarrierFields:
+            self.assertTrue(np.array_equal(getattr(carrier, field), getattr(carrier2, field)))
+
+        # The same stream must give the same trajectory as the online accumulator
+        Xsq = np.zeros((NSpec, Nsteps))
+        tSum = np.zeros(Nsteps)
+        diff = np.zeros((NSpec, Nsteps))
+        MC_JIT.getTrajAccumulate(self.KMC_Jit, state.copy(), offsc.copy(), self.vacSiteInd, ijList, dxList, NSpec,
+                                 Nsteps, beta, key, Xsq, tSum, diff)
+        self.assertTrue(np.allclose(tSum, t_steps))
+        self.assertTrue(np.allclose(Xsq, np.sum(X_steps ** 2, axis=2).T))
+
+    def test_SampledTraj(self):
+        Nsteps = 10
+        beta = 1.0
+        NSpec = self.NSpec
+        ijList = self.VclusExp.KRAexpander.ijList
+        dxList = self.VclusExp.KRAexpander.dxList
+
+        state = self.initState.copy()
+        offsc = self.KMC_Jit.GetOffSite(state)
+        seedJit(20)
+        X_steps, t_steps = self.KMC_Jit.getTraj(state, offsc, self.vacSiteInd, ijList, dxList, NSpec, Nsteps, beta)
+
+        sampleSteps = np.array([0, 3, 4, 9])
+        sampleTimes = np.linspace(0., 1.2 * t_steps[-1], 15)
+        state2 = self.initState.copy()
+        offsc2 = self.KMC_Jit.GetOffSite(state2)
+        seedJit(20)
+        X_samp, t_samp, X_times, NtimesDone = self.KMC_Jit.getTrajSampled(state2, offsc2, self.vacSiteInd, ijList,
+                                                                          dxList, NSpec, Nsteps, beta, sampleSteps,
+                                                                          sampleTimes)
+        self.assertTrue(np.array_equal(state, state2))
+        self.assertTrue(np.array_equal(offsc, offsc2))
+        self.assertTrue(np.allclose(X_samp, X_steps[sampleSteps]))
+        self.assertTrue(np.allclose(t_samp, t_steps[sampleSteps]))
+
+        self.assertEqual(NtimesDone, np.searchsorted(sampleTimes, t_steps[-1]))
+        for timeInd in range(NtimesDone):
+            step = np.searchsorted(t_steps, sampleTimes[timeInd], side="right") - 1
+            if step < 0:
+                self.assertTrue(np.allclose(X_times[timeInd], 0.))
+            else:
+                self.assertTrue(np.allclose(X_times[timeInd], X_steps[step]))
+
+    def test_MultiVacTraj(self):
+        Nsteps = 20
+        beta = 1.0
+        NSpec = self.NSpec
+        ijList = self.VclusExp.KRAexpander.ijList
+        dxList = self.VclusExp.KRAexpander.dxList
+        z = ijList.shape[0]
+
+        # With a single vacancy, the trajectory must be the same as that from getTraj
+        state = self.initState.copy()
+        offsc = self.KMC_Jit.GetOffSite(state)
+        seedJit(30)
+        X_steps, t_steps = self.KMC_Jit.getTraj(state, offsc, self.vacSiteInd, ijList, dxList, NSpec, Nsteps, beta)
+        state2 = self.initState.copy()
+        offsc2 = self.KMC_Jit.GetOffSite(state2)
+        seedJit(30)
+        X_steps2, t_steps2, eventSteps, vacSites = MC_JIT.getMultiVacTraj(self.KMC_Jit, state2, offsc2,
+                                                                          self.vacSiteInd, ijList, dxList, NSpec,
+                                                                          Nsteps, beta)
+        self.assertTrue(np.allclose(X_steps, X_steps2))
+        self.assertTrue(np.allclose(t_steps, t_steps2))
+        self.assertTrue(np.array_equal(state, state2))
+        self.assertTrue(np.array_equal(offsc, offsc2))
+
+        # With several vacancies, some next to each other, check the rates against a full recomputation
+        state = self.initState.copy()
+        vacSitesInit = np.random.choice(state.shape[0], 6, replace=False)
+        state[vacSitesInit] = NSpec - 1
+        state[ijList[:2]] = NSpec - 1
+        state0 = state.copy()
+        offsc = self.KMC_Jit.GetOffSite(state)
+        X_steps, t_steps, eventSteps, vacSites = MC_JIT.getMultiVacTraj(self.KMC_Jit, state, offsc, self.vacSiteInd,
+                                                                        ijList, dxList, NSpec, Nsteps, beta)
+        self.assertTrue(np.array_equal(offsc, self.KMC_Jit.GetOffSite(state)))
+
+        vacSites0 = np.where(state0 == NSpec - 1)[0]
+        X = np.zeros((NSpec, 3))
+        t = 0.
+        for step in range(Nsteps):
+            offsc0 = self.KMC_Jit.GetOffSite(state0)
+            rateTot = 0.
+            finSitesAll = []
+            for vacSite in vacSites0:
+                stateTrans = self.KMC_Jit.TranslateState(state0, self.vacSiteInd, vacSite)
+                delEKRA = self.KMC_Jit.getKRAEnergies(stateTrans, self.KMC_Jit.GetTSOffSite(stateTrans), ijList)
+                siteMap = self.KMC_Jit.TranslateState(np.arange(state0.shape[0]), self.vacSiteInd, vacSite)
+                finSites = siteMap[ijList]
+                delE = self.KMC_Jit.getEnergyChangeJumps(state0, offsc0, vacSite, finSites)
+                for jmp in range(z):
+                    if state0[finSites[jmp]] != NSpec - 1:
+                        rateTot += np.exp(-(0.5 * delE[jmp] + delEKRA[jmp]) * beta)
+                finSitesAll.append(finSites)
+            t += 1. / rateTot
+            self.assertAlmostEqual(t, t_steps[step])
+
+            vacInd, jmp = eventSteps[step] // z, eventSteps[step] % z
+            siteA, siteB = vacSites0[vacInd], finSitesAll[vacInd][jmp]
+            specB = state0[siteB]
+            self.assertNotEqual(specB, NSpec - 1)
+            X[NSpec - 1] += dxList[jmp]
+            X[specB] -= dxList[jmp]
+            self.assertTrue(np.allclose(X, X_steps[step]))
+            state0[siteA], state0[siteB] = specB, NSpec - 1
+            vacSites0[vacInd] = siteB
+
+        self.assertTrue(np.array_equal(state0, state))
+        self.assertTrue(np.array_equal(vacSites0, vacSites))
+
+        # With only vacancies, no jump is possible - the trajectory must stop instead of selecting a jump
+        state = np.full_like(self.initState, NSpec - 1)
+        offsc = self.KMC_Jit.GetOffSite(state)
+        X_steps, t_steps, eventSteps, vacSites = MC_JIT.getMultiVacTraj(self.KMC_Jit, state, offsc, self.vacSiteInd,
+                                                                        ijList, dxList, NSpec, Nsteps, beta)
+        self.assertTrue(np.all(eventSteps == -1))
+        self.assertTrue(np.all(np.isinf(t_steps)))
+        self.assertTrue(np.allclose(X_steps, 0.))
+        self.assertTrue(np.all(state == NSpec - 1))
+
+    def test_TracerTraj(self):
+        Nsteps = 50
+        beta = 1.0
+        NSpec = self.NSpec
+        ijList = self.VclusExp.KRAexpander.ijList
+        dxList = self.VclusExp.KRAexpander.dxList
+
+        state = self.initState.copy()
+        offsc = self.KMC_Jit.GetOffSite(state)
+        tracker = Tracer.TracerTracker(state, NSpec)
+        seedJit(40)
+        X_steps, t_steps = self.KMC_Jit.getTraj(state, offsc, self.vacSiteInd, ijList, dxList, NSpec, Nsteps, beta,
+                                                tracker)
+        state2 = self.initState.copy()
+        offsc2 = self.KMC_Jit.GetOffSite(state2)
+        seedJit(40)
+        X_steps2, t_steps2 = self.KMC_Jit.getTraj(state2, offsc2, self.vacSiteInd, ijList, dxList, NSpec, Nsteps,
+                                                  beta)
+        self.assertTrue(np.allclose(X_steps, X_steps2))
+        self.assertTrue(np.array_equal(state, state2))
+
+        self.assertEqual(np.sum(tracker.Njumps), Nsteps)
+        for site in range(state.shape[0]):
+            if state[site] == NSpec - 1:
+                self.assertEqual(tracker.atomID[site], -1)
+            else:
+                self.assertEqual(tracker.atomSpec[tracker.atomID[site]], state[site])
+        msd = tracker.getTracerMSD()
+        for spec in range(NSpec - 1):
+            atoms = tracker.atomSpec == spec
+            self.assertTrue(np.allclose(np.sum(tracker.R[atoms], axis=0), X_steps[-1, spec]))
+            self.assertAlmostEqual(msd[spec], np.mean(np.sum(tracker.R[atoms] ** 2, axis=1)))
+
+    def test_SharedTables(self):
+        ijList = self.VclusExp.KRAexpander.ijList
+        tables = SharedTables.SharedTables.publish(**{name: getattr(self, name)
+                                                       for name in SharedTables.KMCTableNames})
+        try:
+            KMC_jit = SharedTables.makeKMC(tables, self.KMC_Jit.N_unit)
+            state = self.initState.copy()
+            offsc = KMC_jit.GetOffSite(state)
+            self.assertTrue(np.array_equal(offsc, self.KMC_Jit.GetOffSite(state)))
+            delE = KMC_jit.getEnergyChangeJumps(state, offsc, self.vacSiteInd, ijList)
+            self.assertTrue(np.array_equal(delE, self.KMC_Jit.getEnergyChangeJumps(state, offsc, self.vacSiteInd,
+                                                                                   ijList)))
+
+            # the jitclass must use the shared arrays, not copies of them
+            tables["Interaction2En"][0] += 1.0
+            self.assertEqual(KMC_jit.Interaction2En[0], tables["Interaction2En"][0])
+            tables["Interaction2En"][0] -= 1.0
+
+            states = [np.random.permutation(self.initState) for i in range(4)]
+            for state in states:
+                vacSite = np.where(state == self.NSpec - 1)[0][0]
+                state[[vacSite, self.vacSiteInd]] = state[[self.vacSiteInd, vacSite]]
+            with multiprocessing.get_context("fork").Pool(2) as pool:
+                results = pool.map(sharedTablesWorker, [(tables, self.KMC_Jit.N_unit, state, self.vacSiteInd, ijList)
+                                                        for state in states])
+            for state, (offsc, delE) in zip(states, results):
+                offsc0 = self.KMC_Jit.GetOffSite(state)
+                self.assertTrue(np.array_equal(offsc, offsc0))
+                self.assertTrue(np.array_equal(delE, self.KMC_Jit.getEnergyChangeJumps(state, offsc0,
+                                                                                       self.vacSiteInd, ijList)))
+            del KMC_jit
+        finally:
+            tables.unlink()
+
+    def test_CachedKernels(self):
+        Nsteps = 50
+        beta = 1.0
+        NSpec = self.NSpec
+        ijList = self.VclusExp.KRAexpander.ijList
+        dxList = self.VclusExp.KRAexpander.dxList
+
+        # the cached trajectory kernel must give the same trajectory as the jitclass
+        state = self.initState.copy()
+        offsc = self.KMC_Jit.GetOffSite(state)
+        seedJit(50)
+        X_steps, t_steps = self.KMC_Jit.getTraj(state, offsc, self.vacSiteInd, ijList, dxList, NSpec, Nsteps, beta)
+        state2 = self.initState.copy()
+        offsc2 = MC_Kernels.countOffSites(state2, self.numSitesInteracts, self.SupSitesInteracts,
+                                          self.SpecOnInteractSites)
+        seedJit(50)
+        X = np.zeros((NSpec, 3))
+        X_steps2, t_steps2, jumpRecord, t, vacIndNow = \
+            MC_Kernels.kmcTraj(state2, offsc2, X, 0., self.vacSiteInd, self.vacSiteInd, ijList, dxList, Nsteps, beta,
+                               None, 0, self.siteIndtoR, self.RtoSiteInd, self.KMC_Jit.N_unit,
+                               self.numSitesTSInteracts, self.TSInteractSites, self.TSInteractSpecs,
+                               self.FinSiteFinSpecJumpInd, self.numJumpPointGroups, self.numTSInteractsInPtGroups,
+                               self.JumpInteracts, self.Jump2KRAEng, self.numInteractsSiteSpec,
+                               self.SiteSpecInterArray, self.Interaction2En)
+        self.assertTrue(np.array_equal(X_steps, X_steps2))
+        self.assertTrue(np.array_equal(t_steps, t_steps2))
+        self.assertTrue(np.array_equal(state, state2))
+        self.assertTrue(np.array_equal(offsc, offsc2))
+        self.assertTrue(np.array_equal(X, X_steps[-1]))
+        self.assertEqual(t, t_steps[-1])
+        self.assertEqual(state2[vacIndNow], NSpec - 1)
+
+        # the jump record must chain the vacancy sites and give back the displacements
+        self.assertEqual(jumpRecord[0, 0], self.vacSiteInd)
+        self.assertTrue(np.array_equal(jumpRecord[1:, 0], jumpRecord[:-1, 1]))
+        self.assertEqual(jumpRecord[-1, 1], vacIndNow)
+        self.assertTrue(np.allclose(np.cumsum(dxList[jumpRecord[:, 2]], axis=0), X_steps[:, NSpec - 1, :]))
+
+        # After a warm up, a new process must load every kernel from the cache instead of compiling it
+        MC_Kernels.warmUp()
+        script = "import MC_Kernels\n" \
+                 "MC_Kernels.warmUp()\n" \
+                 "print(sum(sum(getattr(MC_Kernels, f).stats.cache_misses.values()) for f in\n" \
+                 "          ['translateState', 'countOffSites', 'mcSweep', 'mcSweepStream', 'multiSwapMC',\n" \
+                 "           'newRandState', 'expand', 'exitData', 'kmcTraj', 'kmcTrajSampled']))\n"
+        out = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(MC_Kernels.__file__)),
+                             capture_output=True, text=True, check=True)
+        self.assertEqual(int(out.stdout.strip().split()[-1]), 0)
+
+        # the fast start path - a new process that loads the tables and calls the sweep kernel directly (without
+        # building the jitclasses) must reach the end of its first sweep well within a second of importing it
+        names = ["numSitesInteracts", "SupSitesInteracts", "SpecOnInteractSites", "numInteractsSiteSpec",
+                 "SiteSpecInterArray", "Interaction2En", "numSitesTSInteracts", "TSInteractSites", "TSInteractSpecs"]
+        with tempfile.TemporaryDirectory() as tmpDir:
+            tableFile = os.path.join(tmpDir, "tables.npz")
+            np.savez(tableFile, state=self.initState, **{name: getattr(self, name) for name in names})
+            script = "import time\n" \
+                     "import numpy as np\n" \
+                     "import MC_Kernels\n" \
+                     "start = time.time()\n" \
+                     "tb = np.load({!r})\n" \
+                     "state = tb['state']\n" \
+                     "offsc = MC_Kernels.countOffSites(state, tb['numSitesInteracts'], tb['SupSitesInteracts'],\n" \
+                     "                                 tb['SpecOnInteractSites'])\n" \
+                     "TSoffsc = np.zeros(tb['numSitesTSInteracts'].shape[0], dtype=np.int64)\n" \
+                     "N = state.shape[0]\n" \
+                     "MC_Kernels.mcSweep(state, offsc, TSoffsc,\n" \
+                     "                   np.zeros((N, 2), dtype=np.int64), 1.0, np.log(np.random.rand(N)), N,\n" \
+                     "                   {}, tb['numInteractsSiteSpec'], tb['SiteSpecInterArray'],\n" \
+                     "                   tb['Interaction2En'], tb['numSitesTSInteracts'], tb['TSInteractSites'],\n" \
+                     "                   tb['TSInteractSpecs'], np.zeros(0, dtype=np.int64),\n" \
+                     "                   np.zeros(0, dtype=np.int64))\n" \
+                     "print(time.time() - start)\n".format(tableFile, self.vacSiteInd)
+            out = subprocess.run([sys.executable, "-c", script],
+                                 cwd=os.path.dirname(os.path.abspath(MC_Kernels.__file__)), capture_output=True,
+                                 text=True, check=True)
+        self.assertLess(float(out.stdout.strip().split()[-1]), 1.0)
+
+    def test_SiteOrdering(self):
+        tables = {name: getattr(self, name) for name in SharedTables.KMCTableNames}
+        Nsites = self.initState.shape[0]
+        N_unit = self.KMC_Jit.N_unit
+        for curve in ["hilbert", "morton"]:
+            siteOrder, siteNew = SiteOrdering.makeSiteOrder(self.siteIndtoR, curve=curve)
+            self.assertTrue(np.array_equal(np.sort(siteOrder), np.arange(Nsites)))
+            self.assertTrue(np.array_equal(siteNew[siteOrder], np.arange(Nsites)))
+            if curve == "hilbert":
+                # consecutive sites along the Hilbert curve are nearest neighbor unit cells
+                dR = np.abs(np.diff(self.siteIndtoR[siteOrder], axis=0))
+                self.assertTrue(np.all(np.sum(dR, axis=1) == 1))
+
+            newTables, interactOrder, vacSiteIndNew = SiteOrdering.reorderTables(tables, siteOrder, siteNew,
+                                                                                 self.vacSiteInd)
+            self.assertEqual(siteOrder[vacSiteIndNew], self.vacSiteInd)
+            anchors = [min(newTables["SupSitesInteracts"][i, :newTables["numSitesInteracts"][i]])
+                       for i in range(interactOrder.shape[0])]
+            self.assertTrue(np.all(np.diff(anchors) >= 0))
+
+            KMC_jit = SharedTables.makeKMC(newTables, N_unit)
+            state = self.initState.copy()
+            stateNew = SiteOrdering.stateToNew(state, siteOrder)
+            self.assertTrue(np.array_equal(SiteOrdering.stateToOld(stateNew, siteNew), state))
+
+            # the same state must give the same off site counts, energy changes and KRA energies in both orders
+            offsc = self.KMC_Jit.GetOffSite(state)
+            offscNew = KMC_jit.GetOffSite(stateNew)
+            self.assertTrue(np.array_equal(offscNew, SiteOrdering.offSiteCountToNew(offsc, interactOrder)))
+            TSoffsc = self.KMC_Jit.GetTSOffSite(state)
+            self.assertTrue(np.array_equal(KMC_jit.GetTSOffSite(stateNew), TSoffsc))
+
+            ijList = self.jumpFinSites
+            delE = self.KMC_Jit.getEnergyChangeJumps(state, offsc, self.vacSiteInd, ijList)
+            delENew = KMC_jit.getEnergyChangeJumps(stateNew, offscNew, vacSiteIndNew, siteNew[ijList])
+            self.assertTrue(np.allclose(delE, delENew))
+            self.assertTrue(np.allclose(self.KMC_Jit.getKRAEnergies(state, TSoffsc, ijList),
+                                        KMC_jit.getKRAEnergies(stateNew, TSoffsc, siteNew[ijList])))
+
+            # and swaps must keep the off site counts in step
+            for trial in range(10):
+                siteA, siteB = np.random.choice(Nsites, 2, replace=False)
+                self.KMC_Jit.updateState(state, offsc, siteA, siteB)
+                KMC_jit.updateState(stateNew, offscNew, siteNew[siteA], siteNew[siteB])
+            self.assertTrue(np.array_equal(SiteOrdering.stateToOld(stateNew, siteNew), state))
+            self.assertTrue(np.array_equal(offscNew, SiteOrdering.offSiteCountToNew(offsc, interactOrder)))
+
+
 class test_shells(Test_MC_Arrays):
 
+    def test_Superbasin(self):
+        Nsteps = 40
+        beta = 1.0
+        NSpec = self.NSpec
+        ijList = self.VclusExp.KRAexpander.ijList
+        dxList = self.VclusExp.KRAexpander.dxList
+        z = ijList.shape[0]
+
+        state = self.initState.copy()
+        offsc = self.KMC_Jit.GetOffSite(state)
+        seedJit(30)
+        X_steps, t_steps = self.KMC_Jit.getTraj(state, offsc, self.vacSiteInd, ijList, dxList, NSpec, Nsteps, beta)
+
+        # If no state is revisited often enough, or the basins contain single states, the trajectory must be the
+        # same as that from getTraj
+        for fastRate, Nrevisit in [(0., Nsteps + 1), (np.inf, 1)]:
+            state2 = self.initState.copy()
+            offsc2 = self.KMC_Jit.GetOffSite(state2)
+            seedJit(30)
+            X_steps2, t_steps2, basinSizes = MC_JIT.getTrajSuperbasin(self.KMC_Jit, state2, offsc2, self.vacSiteInd,
+                                                                      ijList, dxList, NSpec, Nsteps, beta, fastRate,
+                                                                      20, Nrevisit, Nsteps)
+            self.assertTrue(np.allclose(X_steps, X_steps2))
+            self.assertTrue(np.allclose(t_steps, t_steps2))
+            self.assertTrue(np.array_equal(state, state2))
+            self.assertTrue(np.array_equal(offsc, offsc2))
+            self.assertTrue(np.all(basinSizes == (1 if Nrevisit == 1 else 0)))
+
+        # Check the exit statistics against those from the embedded jump chain of a small random basin
+        Nbasin = 5
+        edgeRates = np.random.rand(Nbasin, z)
+        edgeTargets = np.random.randint(-1, Nbasin, size=(Nbasin, z))
+        edgeTargets[:, 0] = -1
+        exitProbs, residence = MC_JIT.solveBasinExit(Nbasin, edgeRates, edgeTargets, 0)
+        escape = np.sum(edgeRates, axis=1)
+        P = np.zeros((Nbasin, Nbasin))
+        for i in range(Nbasin):
+            for jmp in range(z):
+                if edgeTargets[i, jmp] >= 0:
+                    P[i, edgeTargets[i, jmp]] += edgeRates[i, jmp] / escape[i]
+        visits = np.linalg.inv(np.eye(Nbasin) - P)[0]
+        self.assertTrue(np.allclose(residence, visits / escape))
+        for i in range(Nbasin):
+            for jmp in range(z):
+                pExit = visits[i] * edgeRates[i, jmp] / escape[i] if edgeTargets[i, jmp] == -1 else 0.
+                self.assertAlmostEqual(exitProbs[i, jmp], pExit)
+        self.assertAlmostEqual(np.sum(exitProbs), 1.)
+
+        # With every jump fast, revisits must trigger escapes out of the largest allowed basins
+        state = self.initState.copy()
+        offsc = self.KMC_Jit.GetOffSite(state)
+        X_steps, t_steps, basinSizes = MC_JIT.getTrajSuperbasin(self.KMC_Jit, state, offsc, self.vacSiteInd, ijList,
+                                                                dxList, NSpec, Nsteps, beta, 0., 20, 2, Nsteps)
+        self.assertTrue(np.any(basinSizes == 20))
+        self.assertTrue(np.array_equal(offsc, self.KMC_Jit.GetOffSite(state)))
+        self.assertTrue(np.all(np.diff(t_steps) > 0))
+        # every jump moves the vacancy and one atom in opposite directions
+        self.assertTrue(np.allclose(np.sum(X_steps, axis=1), 0.))
+        self.assertTrue(np.array_equal(np.sort(state), np.sort(self.initState)))
+
     def test_ShellBuild(self):
         state = self.initState.copy()
         offsc = self.KMC_Jit.GetOffSite(state)
@@ -1241,4 +2116,200 @@ class test_shells(Test_MC_Arrays):
 
         # Check that all jumps have been accounted for including diagonal elements
         for key, item in exitcounts.items():
-            self.assertEqual(item, ijList.shape[0]+1)
\ No newline at end of file
+            self.assertEqual(item, ijList.shape[0]+1)
+
+    def test_ShellBuildJit(self):
+        state = self.initState.copy()
+        offsc = self.KMC_Jit.GetOffSite(state)
+        TSoffsc = self.KMC_Jit.GetTSOffSite(state)
+        beta = 1.0
+        ijList = self.VclusExp.KRAexpander.ijList
+        dxList = self.VclusExp.KRAexpander.dxList
+        Nsites = len(state)
+        Nspec = len(self.VclusExp.mobCountList)
+        Nshells = 2
+
+        identity = np.arange(Nsites).reshape(1, Nsites)
+        stateSet, depth, indptr, colInds, rates, jumpInds, velocities, energies = \
+            MC_JIT.makeShellsJit(self.KMC_Jit, state, ijList, dxList, beta, self.vacSiteInd, Nshells, identity)
+        # the states must be packed with as few bits as possible
+        self.assertEqual(stateSet.bitsPerSite, 2)
+
+        Nstates = stateSet.count
+        self.assertEqual(depth.shape[0], Nstates)
+        self.assertEqual(indptr.shape[0], Nstates + 1)
+        self.assertEqual(indptr[-1], colInds.shape[0])
+        self.assertTrue(np.array_equal(stateSet.unpack(0), state))
+        self.assertEqual(depth[0], 0)
+
+        # Check the states against those from makeShells
+        state2Index, Index2State, TransitionRates, TransitionsZero, vels = \
+            MC_JIT.makeShells(self.MCSampler_Jit, self.KMC_Jit, state, offsc, TSoffsc, ijList, dxList, beta, Nsites,
+                              Nspec, Nshells=Nshells)
+        self.assertEqual(len(state2Index), Nstates)
+        for stateBytes, ind in state2Index.items():
+            stateFound = Index2State[ind]
+            self.assertNotEqual(stateSet.find(stateFound), -1)
+
+        En0 = np.sum(self.Interaction2En[offsc == 0])
+        for stateInd in range(Nstates):
+            state1 = stateSet.unpack(stateInd)
+            self.assertEqual(stateSet.find(state1), stateInd)
+            self.assertEqual(state1[self.vacSiteInd], Nspec - 1)
+            offscState = self.KMC_Jit.GetOffSite(state1)
+            self.assertAlmostEqual(np.sum(self.Interaction2En[offscState == 0]) - En0, energies[stateInd])
+
+            rowStart, rowEnd = indptr[stateInd], indptr[stateInd + 1]
+            if depth[stateInd] == Nshells:
+                self.assertEqual(rowStart, rowEnd)
+                self.assertTrue(np.allclose(velocities[stateInd], 0.))
+                continue
+
+            self.assertTrue(depth[stateInd] < Nshells)
+            self.assertEqual(rowEnd - rowStart, ijList.shape[0] + 1)
+
+            offsc1 = self.KMC_Jit.GetOffSite(state1)
+            TSoffsc1 = self.KMC_Jit.GetTSOffSite(state1)
+            exitstates, exitRates, Specdisps = self.MCSampler_Jit.getExitData(state1, ijList, dxList, offsc1, TSoffsc1,
+                                                                              beta, Nsites)
+            # the diagonal comes first
+            self.assertEqual(colInds[rowStart], stateInd)
+            self.assertEqual(jumpInds[rowStart], -1)
+            self.assertAlmostEqual(rates[rowStart], -np.sum(exitRates))
+
+            vel = np.zeros(3)
+            for edge in range(rowStart + 1, rowEnd):
+                jmp = jumpInds[edge]
+                self.assertAlmostEqual(rates[edge], exitRates[jmp])
+                exitOrig = self.KMC_Jit.TranslateState(exitstates[jmp], self.vacSiteInd, ijList[jmp])
+                self.assertTrue(np.array_equal(stateSet.unpack(colInds[edge]), exitOrig))
+                self.assertTrue(depth[colInds[edge]] <= depth[stateInd] + 1)
+                vel += exitRates[jmp] * dxList[jmp]
+            self.assertTrue(np.allclose(vel, velocities[stateInd]))
+            self.assertTrue(np.allclose(vel, vels[state2Index[state1.tobytes()]]))
+
+    def test_ShellBuildSym(self):
+        state = self.initState.copy()
+        beta = 1.0
+        ijList = self.VclusExp.KRAexpander.ijList
+        dxList = self.VclusExp.KRAexpander.dxList
+        Nsites = len(state)
+        Nshells = 2
+
+        sitePerms = self.VclusExp.makeVacSitePerms()
+        self.assertEqual(sitePerms.shape, (len(self.crys.G), Nsites))
+        for perm in sitePerms:
+            self.assertEqual(perm[self.vacSiteInd], self.vacSiteInd)
+            self.assertEqual(len(set(perm)), Nsites)
+            # The energy of a state must not change under the operations
+            stateRot = np.zeros_like(state)
+            stateRot[perm] = state
+            offsc = self.KMC_Jit.GetOffSite(state)
+            offscRot = self.KMC_Jit.GetOffSite(stateRot)
+            self.assertAlmostEqual(np.sum(self.Interaction2En[offsc == 0]), np.sum(self.Interaction2En[offscRot == 0]))
+
+        identity = np.arange(Nsites).reshape(1, Nsites)
+        stateSet, depth, indptr, colInds, rates, jumpInds, velocities, energies = \
+            MC_JIT.makeShellsJit(self.KMC_Jit, state, ijList, dxList, beta, self.vacSiteInd, Nshells, identity)
+        stateSetSym, depthSym, indptrSym, colIndsSym, ratesSym, jumpIndsSym, velocitiesSym, energiesSym = \
+            MC_JIT.makeShellsJit(self.KMC_Jit, state, ijList, dxList, beta, self.vacSiteInd, Nshells, sitePerms)
+
+        self.assertTrue(stateSetSym.count <= stateSet.count)
+
+        # Every state must have its canonical form in the reduced set, in the same shell, with the same escape rate
+        for stateInd in range(stateSet.count):
+            state1 = stateSet.unpack(stateInd)
+            symInd = stateSetSym.findPacked(stateSetSym.canonicalPack(state1, sitePerms))
+            self.assertNotEqual(symInd, -1)
+            # an image of the state may be reachable in fewer jumps
+            self.assertTrue(depthSym[symInd] <= depth[stateInd])
+            if depth[stateInd] < Nshells:
+                self.assertAlmostEqual(rates[indptr[stateInd]], ratesSym[indptrSym[symInd]])
+                self.assertAlmostEqual(np.linalg.norm(velocities[stateInd]), np.linalg.norm(velocitiesSym[symInd]))
+
+        # and every canonical state must be an image of a state in the full set
+        for symInd in range(stateSetSym.count):
+            state1 = stateSetSym.unpack(symInd)
+            images = [stateSet.find(state1[perm]) for perm in sitePerms]
+            self.assertTrue(any(ind != -1 for ind in images))
+
+    def test_ShellTransport(self):
+        state = self.initState.copy()
+        beta = 1.0
+        ijList = self.VclusExp.KRAexpander.ijList
+        dxList = self.VclusExp.KRAexpander.dxList
+        Nsites = len(state)
+        Nshells = 2
+
+        identity = np.arange(Nsites).reshape(1, Nsites)
+        stateSet, depth, indptr, colInds, rates, jumpInds, velocities, energies = \
+            MC_JIT.makeShellsJit(self.KMC_Jit, state, ijList, dxList, beta, self.vacSiteInd, Nshells, identity)
+
+        for boundary in ["dirichlet", "reflecting"]:
+            # Make the dense rate matrix over the inner states
+            inner = np.where(depth < Nshells)[0]
+            innerIndex = {s: i for i, s in enumerate(inner)}
+            Ninner = len(inner)
+            G = np.zeros((Ninner, Ninner))
+            vel = np.zeros((Ninner, 3))
+            L0 = np.zeros((3, 3))
+            pi = np.exp(-beta * (energies[inner] - np.min(energies[inner])))
+            pi /= np.sum(pi)
+            for i, s in enumerate(inner):
+                for edge in range(indptr[s] + 1, indptr[s + 1]):
+                    if boundary == "reflecting" and depth[colInds[edge]] == Nshells:
+                        continue
+                    dx = dxList[jumpInds[edge]]
+                    G[i, i] -= rates[edge]
+                    if depth[colInds[edge]] < Nshells:
+                        G[i, innerIndex[colInds[edge]]] += rates[edge]
+                    vel[i] += rates[edge] * dx
+                    L0 += 0.5 * pi[i] * rates[edge] * np.outer(dx, dx)
+
+            # detailed balance within the network
+            flux = pi[:, None] * G
+            self.assertTrue(np.allclose(flux - np.diag(np.diag(flux)), (flux - np.diag(np.diag(flux))).T))
+
+            if boundary == "dirichlet":
+                etaDense = np.linalg.solve(-G, vel)
+            else:
+                etaDense = np.linalg.pinv(-G) @ vel
+                etaDense -= pi @ etaDense
+            LDense = L0 - np.einsum("s,si,sj->ij", pi, vel, etaDense)
+
+            for method in ["cg", "gmres"]:
+                L, L0calc, eta, innerStates = ShellTransport.solveShellTransport(depth, indptr, colInds, rates,
+                                                                                 jumpInds, energies, dxList, beta,
+                                                                                 Nshells, boundary=boundary,
+                                                                                 method=method)
+                self.assertTrue(np.array_equal(innerStates, inner))
+                self.assertTrue(np.allclose(L0calc, L0))
+                self.assertTrue(np.allclose(L, LDense, atol=1e-8), msg="{} {}".format(boundary, method))
+                self.assertTrue(np.allclose(L, L.T, atol=1e-8))
+                # correlations can only reduce transport
+                self.assertTrue(np.all(np.linalg.eigvalsh(0.5 * (L0 - L + (L0 - L).T)) > -1e-8))
+
+        with self.assertRaises(ValueError):
+            ShellTransport.solveShellTransport(depth, indptr, colInds, rates, jumpInds, energies, dxList, beta,
+                                               Nshells, boundary="periodic")
+
+        # with energies that do not match the rates, the symmetrized matrix is not symmetric - conjugate gradients
+        # must not be used on it
+        energiesWrong = energies + 0.5 * np.random.rand(energies.shape[0])
+        with self.assertWarns(UserWarning):
+            L, L0calc, eta, innerStates = ShellTransport.solveShellTransport(depth, indptr, colInds, rates, jumpInds,
+                                                                             energiesWrong, dxList, beta, Nshells,
+                                                                             method="cg")
+        Lgmres, L0calc, eta, innerStates = ShellTransport.solveShellTransport(depth, indptr, colInds, rates, jumpInds,
+                                                                              energiesWrong, dxList, beta, Nshells,
+                                                                              method="gmres")
+        self.assertTrue(np.allclose(L, Lgmres))
+
+        # networks reduced by symmetry are rejected
+        sitePerms = self.VclusExp.makeVacSitePerms()
+        self.assertGreater(sitePerms.shape[0], 1)
+        with self.assertRaises(ValueError):
+            ShellTransport.solveShellTransport(depth, indptr, colInds, rates, jumpInds, energies, dxList, beta,
+                                               Nshells, sitePerms=sitePerms)
+        ShellTransport.solveShellTransport(depth, indptr, colInds, rates, jumpInds, energies, dxList, beta,
+                                           Nshells, sitePerms=identity)